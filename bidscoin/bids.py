@@ -8,39 +8,48 @@ https://github.com/dangom/dac2bids/blob/master/dac2bids.py
 @author: Marcel Zwiers
 """
 
-import copy
 import inspect
+import itertools
 import ast
 import re
 import logging
-import coloredlogs
 import subprocess
-import pydicom
-import nibabel
 import tempfile
 import tarfile
 import zipfile
 import fnmatch
-try:
-    from bidscoin import dicomsort
-except ImportError:
-    import dicomsort  # This should work if bidscoin was not pip-installed
-from distutils.dir_util import copy_tree
-from typing import Union, List, Tuple
+import threading
+import hashlib
+import mmap
+import os
+import socket
+import json
+import atexit
+import shutil
+import io
+import time
+from typing import Union, List, Tuple, Iterable
+from collections import OrderedDict
 from pathlib import Path
 from importlib import util
-from ruamel.yaml import YAML
-yaml = YAML()
 
 logger = logging.getLogger('bidscoin')
+_yaml  = None
 
 bidsmodalities  = ('fmap', 'anat', 'func', 'dwi', 'beh', 'pet')                                         # NB: get_matching_run() uses this order to search for a match
 ignoremodality  = 'leave_out'
 unknownmodality = 'extra_data'
 bidslabels      = ('task', 'acq', 'ce', 'rec', 'dir', 'run', 'mod', 'echo', 'suffix', 'IntendedFor')    # This is not really something from BIDS, but these are the BIDS-labels used in the bidsmap
+parsuffixes     = ('.PAR', '.par', '.XML', '.xml')
+
+DICOM_DEFERSIZE = '32 KB'                                                                                # DICOM header elements larger than this are read from disk only when they are accessed
+ZIP_CHUNKSIZE   = 64*1024**2                                                                            # The (uncompressed) number of bytes per parallel extraction task of a zip-file
+SNAPSHOT_FILES  = 32                                                                                    # The maximum number of bidsmap snapshots that are kept in the snapshotfolder
+RESERVATION_AGE = 24*3600                                                                               # The age (in seconds) after which the runindex reservations of other hosts are considered stale
 
 heuristics_folder = Path(__file__).parents[1]/'heuristics'
 bidsmap_template  = heuristics_folder/'bidsmap_template.yaml'
+snapshotfolder    = Path(os.getenv('XDG_CACHE_HOME') or Path.home()/'.cache')/'bidscoin'                  # The user's cache folder with the JSON snapshots of the (read-only) bidsmaps
 
 
 def bidsversion() -> str:
@@ -90,6 +99,7 @@ def setup_logging(log_file: Path=Path(), debug: bool=False) -> logging.Logger:
         logger.setLevel(logging.INFO)
 
     # Set & add the streamhandler and add some color to those boring terminal logs! :-)
+    import coloredlogs
     coloredlogs.install(level=logger.level, fmt=fmt, datefmt=datefmt)
 
     if not log_file.name:
@@ -258,28 +268,89 @@ def lsdirs(folder: Path, wildcard: str='*') -> List[Path]:
     :return:            A list with all directories in the folder
     """
 
-    return [fname for fname in sorted(folder.glob(wildcard)) if fname.is_dir()]
+    if '/' in wildcard or os.sep in wildcard or '**' in wildcard:
+        return [fname for fname in sorted(folder.glob(wildcard)) if fname.is_dir()]
+
+    try:
+        names = dircache.get(folder).dirs
+    except OSError:
+        names = []
+    virtualdirs = archivetree.dirs(folder)
+    if virtualdirs:
+        names = sorted(set(names).union(virtualdirs), key=lambda name: folder/name)
+
+    return [folder/name for name in names if fnmatch.fnmatch(name, wildcard)]        # NB: Like Path.glob(), this also matches hidden folders
+
+
+_DICOMVRS = (b'AE', b'AS', b'AT', b'CS', b'DA', b'DS', b'DT', b'FD', b'FL', b'IS', b'LO', b'LT', b'OB', b'OD', b'OF', b'OL', b'OV',
+             b'OW', b'PN', b'SH', b'SL', b'SQ', b'SS', b'ST', b'SV', b'TM', b'UC', b'UI', b'UL', b'UN', b'UR', b'US', b'UT', b'UV')
+
+
+def _sniff_dicom(head: bytes) -> Union[bool, None]:
+    """
+    Sniffs the first bytes of a file to see if it is a DICOM file
+
+    :param head:    The first 0x84 (or more) bytes of the file
+    :return:        True if the file has the DICM prefix, None if the file starts with a plausible explicit or implicit VR
+                    data element (e.g. an anonymized DICOM file without preamble, which needs a header read to be sure)
+                    and False otherwise
+    """
+
+    if head[0x80:0x84] == b'DICM':
+        return True
+    if len(head) < 8:
+        return False
+    if head[4:6] in _DICOMVRS:                                          # Explicit VR (little or big endian)
+        return None
+    group  = int.from_bytes(head[0:2], 'little')
+    length = int.from_bytes(head[4:8], 'little')
+    if group % 2 == 0 and 0x0002 <= group <= 0x7fe0 and (length < 0x10000 or length == 0xffffffff):     # Implicit VR little endian
+        return None
+
+    return False
+
+
+def _is_dicomdataset(dicomdict) -> bool:
+    """Checks whether a (forcefully) read dataset has one of the mandatory image attributes of a DICOM file"""
+
+    return 'Modality' in dicomdict or 'SeriesInstanceUID' in dicomdict
 
 
 def is_dicomfile(file: Path) -> bool:
     """
     Checks whether a file is a DICOM-file. It uses the feature that Dicoms have the string DICM hardcoded at offset 0x80.
+    Files without the DICM string are only read (as anonymized DICOM files) if they start with a plausible DICOM data
+    element (see _sniff_dicom). The verdicts are memoized in the classcache for as long as the file does not change
 
     :param file:    The full pathname of the file
     :return:        Returns true if a file is a DICOM-file
     """
 
+    if archivetree.get(file) is not None:
+        return True                             # Only DICOM files are mounted
+
+    try:
+        verdict = classcache.get(file)          # NB: This is the only stat call if the verdict is memoized
+    except OSError:
+        return False
+    if verdict is not None:
+        return verdict
+
     if file.is_file():
         if file.stem.startswith('.'):
             logger.warning(f'File is hidden: {file}')
         with file.open('rb') as dcmfile:
-            dcmfile.seek(0x80, 1)
-            if dcmfile.read(4) == b'DICM':
-                return True
-            else:
-                logger.debug(f"Reading non-standard DICOM file: {file}")
-                dicomdict = pydicom.dcmread(str(file), force=True)       # The DICM tag may be missing for anonymized DICOM files
-                return 'Modality' in dicomdict
+            head = dcmfile.read(0x84)
+        verdict = _sniff_dicom(head)
+        if verdict is None:
+            logger.debug(f"Reading non-standard DICOM file: {file}")
+            try:
+                verdict = _is_dicomdataset(read_dicomfile(file))        # The DICM tag may be missing for anonymized DICOM files
+            except Exception as readerror:
+                logger.debug(f"Could not read the header: {readerror}")
+                verdict = False
+        classcache.put(file, verdict)
+        return verdict
     else:
         return False
 
@@ -294,7 +365,7 @@ def is_dicomfile_siemens(file: Path) -> bool:
     :return:        Returns true if a file is a Siemens DICOM-file
     """
 
-    return b'ASCCONV BEGIN' in file.open('rb').read()
+    return bool(read_x_protocol(file))
 
 
 def is_parfile(file: Path) -> bool:
@@ -306,7 +377,7 @@ def is_parfile(file: Path) -> bool:
     """
 
     # TODO: Implement a proper check, e.g. using nibabel
-    if file.is_file() and file.suffix in ('.PAR', '.par', '.XML', '.xml'):
+    if file.suffix in parsuffixes and file.is_file():
         return True
     else:
         return False
@@ -341,7 +412,136 @@ def is_niftifile(file: Path) -> bool:
         return False
 
 
-def unpack(sourcefolder: Path, subprefix: str='sub-', sesprefix: str='ses-', wildcard: str='*', workfolder: Path='') -> (Path, bool):
+def stage_folder(sourcefolder: Path, stagefolder: Path, staging: str='link') -> Tuple[int, int, int]:
+    """
+    Mirrors the directory tree of sourcefolder in stagefolder and hardlinks, symlinks or copies the files into it. The linked
+    files share their data with the files in sourcefolder, i.e. they may be renamed or removed, but must not be modified in place
+
+    :param sourcefolder:    The full pathname of the folder with the source data
+    :param stagefolder:     The full pathname of the (new) folder with the staged data
+    :param staging:         'link' to hardlink the files (falling back to symlinks and copies if that is not possible) or 'copy' to copy the files
+    :return:                A (number of staged files, number of bytes written, number of bytes in sourcefolder) tuple
+    """
+
+    nfiles = byteswritten = sourcebytes = 0
+    for root, dirnames, filenames in os.walk(sourcefolder):
+        stageroot = stagefolder/Path(root).relative_to(sourcefolder)
+        stageroot.mkdir(parents=True, exist_ok=True)
+        for filename in filenames:
+            sourcefile, stagefile = Path(root)/filename, stageroot/filename
+            size         = sourcefile.stat().st_size
+            sourcebytes += size
+            nfiles      += 1
+            if staging == 'link':
+                try:
+                    os.link(sourcefile, stagefile)
+                    continue
+                except OSError:                     # E.g. a different file system or protected hardlinks
+                    pass
+                try:
+                    stagefile.symlink_to(sourcefile.resolve())
+                    continue
+                except OSError:                     # E.g. Windows without the symlink privilege
+                    pass
+            shutil.copy2(sourcefile, stagefile)
+            byteswritten += size
+
+    return nfiles, byteswritten, sourcebytes
+
+
+def extract_archives(archives: List[Path], folder: Path, workers: int=0) -> Tuple[List[Path], int]:
+    """
+    Extracts tarballs and zip-files concurrently with a bounded pool of worker threads, each archive in a (hidden)
+    folder of its own, so that the extractions cannot collide. The members of large zip-files are extracted in parallel
+    chunks (of ZIP_CHUNKSIZE bytes) as well
+
+    :param archives:    The full pathnames of the tarballs and zip-files
+    :param folder:      The folder in which the (hidden) extraction folders are created
+    :param workers:     The maximum number of concurrent extractions (default: the number of CPUs, up to 8)
+    :return:            A tuple with the extraction folders (in the same order as archives) and the number of extracted bytes
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    def is_safe(membername: str) -> bool:
+        """Checks that a member name is relative and has no '..' parts, i.e. that the member stays in the extraction folder"""
+        member = Path(membername)
+        return not member.is_absolute() and not member.drive and '..' not in member.parts
+
+    def extract_zip(archive: Path, extractfolder: Path, members: list) -> int:
+        with zipfile.ZipFile(archive, 'r') as zip_fid:          # NB: Each worker reads the zip-file with its own file handle
+            for member in members:
+                zip_fid.extract(member, extractfolder)
+        return sum(member.file_size for member in members)
+
+    def extract_tar(archive: Path, extractfolder: Path) -> int:
+        with tarfile.open(archive, 'r') as tar_fid:
+            members = []
+            for member in tar_fid.getmembers():
+                if not is_safe(member.name) or member.isdev() or (member.issym() and not is_safe(os.path.join(os.path.dirname(member.name), member.linkname))) \
+                        or (member.islnk() and not is_safe(member.linkname)):
+                    logger.warning(f"Skipping the unsafe member '{member.name}' in: {archive}")
+                    continue
+                members.append(member)
+            if hasattr(tarfile, 'data_filter'):         # Python versions with extraction filters also block other unsafe metadata (e.g. setuid bits)
+                tar_fid.extractall(extractfolder, members, filter='data')
+            else:
+                tar_fid.extractall(extractfolder, members)
+            return sum(member.size for member in members if member.isfile())
+
+    extractfolders, tasks = [], []
+    with ThreadPoolExecutor(max_workers=workers or min(8, os.cpu_count() or 1)) as pool:
+        for archive in archives:
+            extractfolder = Path(tempfile.mkdtemp(prefix='.unpack_', dir=folder))
+            extractfolders.append(extractfolder)
+            if archive.suffix == '.zip':
+                with zipfile.ZipFile(archive, 'r') as zip_fid:
+                    members = zip_fid.infolist()
+
+                # Create the folders upfront (to avoid race conditions) and split up the members in chunks if the names are safe
+                chunks, chunksize = [[]], 0
+                if all(is_safe(member.filename) for member in members):
+                    for member in members:
+                        membername = extractfolder/member.filename
+                        (membername if member.is_dir() else membername.parent).mkdir(parents=True, exist_ok=True)
+                        if chunksize >= ZIP_CHUNKSIZE:
+                            chunks.append([])
+                            chunksize = 0
+                        chunks[-1].append(member)
+                        chunksize += member.file_size
+                else:
+                    chunks = [members]
+                logger.info(f"Unpacking: {archive.name} ({len(chunks)} chunks)")
+                tasks.extend(pool.submit(extract_zip, archive, extractfolder, chunk) for chunk in chunks)
+            else:
+                logger.info(f"Unpacking: {archive.name}")
+                tasks.append(pool.submit(extract_tar, archive, extractfolder))
+        extractedbytes = sum(task.result() for task in tasks)
+
+    return extractfolders, extractedbytes
+
+
+def merge_folder(sourcefolder: Path, targetfolder: Path) -> None:
+    """
+    Moves the content of sourcefolder into targetfolder, merging the subfolders that are already there. Existing files
+    (or links) in targetfolder are replaced, i.e. never written to
+
+    :param sourcefolder:    The full pathname of the folder that is moved
+    :param targetfolder:    The full pathname of the destination folder
+    :return:
+    """
+
+    for source in sourcefolder.iterdir():
+        target = targetfolder/source.name
+        if source.is_dir() and not source.is_symlink() and target.is_dir() and not target.is_symlink():
+            merge_folder(source, target)
+        elif (source.is_dir() or target.is_dir()) and (target.exists() or target.is_symlink()):
+            logger.warning(f"Cannot merge {source} with {target}")
+        else:
+            os.replace(source, target)
+
+
+def unpack(sourcefolder: Path, subprefix: str='sub-', sesprefix: str='ses-', wildcard: str='*', workfolder: Path='', staging: str='link', virtual: bool=False, scratchdir: Path='', workers: int=0) -> (Path, bool):
     """
     Unpacks and sorts DICOM files in sourcefolder to a temporary folder if sourcefolder contains a DICOMDIR file or .tar.gz, .gz or .zip files
 
@@ -350,6 +550,10 @@ def unpack(sourcefolder: Path, subprefix: str='sub-', sesprefix: str='ses-', wil
     :param sesprefix:       The optional sesprefix (e.g. 'ses-'). Used to parse the sesid
     :param wildcard:        A glob search pattern to select the tarballed/zipped files
     :param workfolder:      A root folder for temporary data
+    :param staging:         'link' to link the (non-packed) source files into the temporary folder or 'copy' to make a full copy (see stage_folder())
+    :param virtual:         If True, tarballs and zip-files with DICOM data are not unpacked but mounted as a virtual source tree in sourcefolder (see ArchiveTree). Use archivetree.unmount(sourcefolder) to clean up
+    :param scratchdir:      The folder in which the temporary workfolder is created if no workfolder is given, e.g. a local SSD or tmpfs. Default: the system's temporary folder
+    :param workers:         The maximum number of concurrent extractions (see extract_archives())
     :return:                A tuple with the full pathname of the source or workfolder and a workdir-path or False when the data is not unpacked in a temporary folder
     """
 
@@ -360,37 +564,53 @@ def unpack(sourcefolder: Path, subprefix: str='sub-', sesprefix: str='ses-', wil
     packedfiles.extend(sourcefolder.glob(f"{wildcard}.tar.bz2"))
     packedfiles.extend(sourcefolder.glob(f"{wildcard}.zip"))
 
+    # Check if we can read the packed DICOM files straight from the archives, i.e. if there is nothing else to sort
+    if virtual and packedfiles and not (sourcefolder/'DICOMDIR').is_file():
+        loosefiles = [name for name in dircache.get(sourcefolder).files if re.match(r'.*\.(IMA|dcm)$', name)]
+        if not loosefiles and archivetree.mount(sourcefolder, packedfiles):
+            return sourcefolder, False
+
     # Check if we are going to do unpacking and/or sorting
     if packedfiles or (sourcefolder/'DICOMDIR').is_file():
 
         # Create a (temporary) sub/ses workfolder for unpacking the data
         if not workfolder:
-            workfolder = tempfile.mkdtemp()
+            workfolder = tempfile.mkdtemp(dir=scratchdir or None)
         workfolder   = Path(workfolder)
+        if _HEADERINDEX:
+            _HEADERINDEX.exclude(workfolder)
         subid, sesid = get_subid_sesid(sourcefolder/'dum.my', subprefix=subprefix, sesprefix=sesprefix)
         subid, sesid = subid.replace('sub-', subprefix), sesid.replace('ses-', sesprefix)
         worksubses   = workfolder/subid/sesid
         worksubses.mkdir(parents=True, exist_ok=True)
 
-        # Copy everything over to the workfolder
-        logger.info(f"Making temporary copy: {sourcefolder} -> {worksubses}")
-        copy_tree(str(sourcefolder), str(worksubses))     # Older python versions don't support PathLib
-
-        # Unpack the zip/tarballed files in the temporary folder
-        for packedfile in [worksubses/packedfile.name for packedfile in packedfiles]:
-            logger.info(f"Unpacking: {packedfile.name} -> {worksubses}")
-            ext = packedfile.suffixes
-            if ext[-1] == '.zip':
-                with zipfile.ZipFile(packedfile, 'r') as zip_fid:
-                    zip_fid.extractall(worksubses)
-            elif '.tar' in ext:
-                with tarfile.open(packedfile, 'r') as tar_fid:
-                    tar_fid.extractall(worksubses)
-
-            # Sort the DICOM files immediately (to avoid name collisions)
-            dicomsort.sortsessions(worksubses)
-
-        # Sort the DICOM files if not sorted yet (e.g. DICOMDIR)
+        # Link (or copy) everything over to the workfolder
+        try:
+            from bidscoin import dicomsort
+        except ImportError:
+            import dicomsort        # This should work if bidscoin was not pip-installed
+        logger.info(f"Staging the source data ({staging}): {sourcefolder} -> {worksubses}")
+        nstaged, byteswritten, sourcebytes = stage_folder(sourcefolder, worksubses, staging)
+
+        # Unpack the zip/tarballed files straight from the sourcefolder (in parallel)
+        starttime = time.time()
+        extractfolders, extractedbytes = extract_archives(packedfiles, worksubses, workers)
+        elapsed   = max(time.time() - starttime, 1e-6)
+        if packedfiles:
+            logger.info(f"Unpacked {len(packedfiles)} archives: {extractedbytes/1e6:.1f} MB in {elapsed:.1f}s ({extractedbytes/1e6/elapsed:.1f} MB/s)")
+
+        # Sort the DICOM files in the root of the archives and move everything into the workfolder (one archive at a time to avoid name collisions)
+        for extractfolder in extractfolders:
+            if not (extractfolder/'DICOMDIR').is_file():
+                dicomfiles = [dcmfile for dcmfile in extractfolder.iterdir() if dcmfile.is_file() and re.match(r'.*\.(IMA|dcm)$', str(dcmfile))]
+                if dicomfiles:
+                    dicomsort.sortsession(worksubses, dicomfiles, 'SeriesDescription', rename=False, ext='', nosort=False, dryrun=False)
+            merge_folder(extractfolder, worksubses)
+            shutil.rmtree(extractfolder)
+        logger.info(f"Staged {nstaged} files and wrote {(byteswritten+extractedbytes)/1e6:.1f} MB to scratch in {workfolder} (a full copy would have written "
+                    f"{(sourcebytes+extractedbytes)/1e6:.1f} MB, {shutil.disk_usage(str(workfolder)).free/1e9:.1f} GB free)")
+
+        # Sort the (staged) DICOM files in the root of the workfolder (e.g. DICOMDIR)
         dicomsort.sortsessions(worksubses)
 
         return worksubses, workfolder
@@ -409,27 +629,48 @@ def get_dicomfile(folder: Path, index: int=0) -> Path:
     :return:        The filename of the first dicom-file in the folder.
     """
 
-    if (folder/'DICOMDIR').is_file():
+    virtualfiles = archivetree.dicomfiles(folder)
+    try:
+        snapshot = dircache.get(folder)
+    except OSError:
+        return virtualfiles[index] if index < len(virtualfiles) else Path()
+
+    if 'DICOMDIR' in snapshot.files:
+        import pydicom
         dicomdir = pydicom.filereader.read_dicomdir(str(folder/'DICOMDIR'))
         files    = [folder.joinpath(*image.ReferencedFileID) for patient in dicomdir.patient_records
                                                              for study   in patient.children
                                                              for series  in study.children
                                                              for image   in series.children]
-    else:
-        files = sorted(folder.iterdir())
+        idx = 0
+        for file in files:
+            if file.stem.startswith('.'):
+                logger.warning(f'Ignoring hidden file: {file}')
+                continue
+            if is_dicomfile(file):
+                if idx == index:
+                    return file
+                else:
+                    idx += 1
 
-    idx = 0
-    for file in files:
-        if file.stem.startswith('.'):
-            logger.warning(f'Ignoring hidden file: {file}')
-            continue
-        if is_dicomfile(file):
-            if idx == index:
-                return file
-            else:
-                idx += 1
+        return Path()
 
-    return Path()
+    # Continue the (incremental) scan of the snapshot until the index-th dicom file is found
+    with snapshot.lock:
+        while len(snapshot.dicomfiles) <= index and snapshot.scanned < len(snapshot.files):
+            file = folder/snapshot.files[snapshot.scanned]
+            snapshot.scanned += 1
+            if file.stem.startswith('.'):
+                logger.warning(f'Ignoring hidden file: {file}')
+                continue
+            if is_dicomfile(file):
+                snapshot.dicomfiles.append(file)
+
+        if index < len(snapshot.dicomfiles):
+            return snapshot.dicomfiles[index]
+        index -= len(snapshot.dicomfiles)
+
+    return virtualfiles[index] if index < len(virtualfiles) else Path()
 
 
 def get_parfiles(folder: Path) -> List[Path]:
@@ -440,12 +681,12 @@ def get_parfiles(folder: Path) -> List[Path]:
     :return:        The filename of the first PAR-file in the folder.
     """
 
-    parfiles = []
-    for file in sorted(folder.iterdir()):
-        if is_parfile(file):
-            parfiles.append(file)
+    try:
+        snapshot = dircache.get(folder)
+    except OSError:
+        return []
 
-    return parfiles
+    return [folder/name for name in snapshot.files if Path(name).suffix in parsuffixes]
 
 
 def get_p7file(folder: Path) -> Path:
@@ -472,7 +713,110 @@ def get_niftifile(folder: Path) -> Path:
     return Path()
 
 
-def load_bidsmap(yamlfile: Path, folder: Path=Path(), report: bool=True) -> Tuple[dict, Path]:
+def get_yaml():
+    """
+    Gets the ruamel.yaml round-trip (i.e. comment-preserving) parser. It is created on first use, such that ruamel.yaml
+    is not imported by tools that only read the JSON bidsmap snapshots
+
+    :return:    The YAML() instance
+    """
+
+    global _yaml
+    if _yaml is None:
+        from ruamel.yaml import YAML
+        _yaml = YAML()
+
+    return _yaml
+
+
+def plain_bidsmap(node):
+    """
+    Converts a (ruamel.yaml round-trip) bidsmap structure into plain (builtin) dicts, lists and scalars, i.e. with all
+    anchors and merge keys resolved and without the comments and layout information
+
+    :param node:    The (sub)structure of the bidsmap
+    :return:        The plain (sub)structure
+    """
+
+    if isinstance(node, dict):
+        return {key: plain_bidsmap(value) for key, value in node.items()}
+    if isinstance(node, (list, tuple)):
+        return [plain_bidsmap(value) for value in node]
+    if isinstance(node, bool) or node is None:
+        return node
+    if isinstance(node, int):
+        return int(node)
+    if isinstance(node, float):
+        return float(node)
+    if isinstance(node, str):
+        return str(node)
+
+    return node
+
+
+def get_snapshotfile(yamlfile: Path, content: bytes=None) -> Path:
+    """
+    Returns the pathname of the JSON snapshot of the bidsmap yaml-file in the user's cache folder. The snapshot is named
+    after the checksum of the content of the yaml-file and the version of BIDScoin, i.e. it is outdated when one of them changes
+
+    :param yamlfile:    The full pathname of the bidsmap yaml-file
+    :param content:     The content of the yaml-file (if it has already been read)
+    :return:            The full pathname of the snapshot
+    """
+
+    if content is None:
+        content = yamlfile.read_bytes()
+
+    checksum = hashlib.sha1(version().encode() + b'\n' + content).hexdigest()
+
+    return snapshotfolder/f"bidsmap_{checksum}.json"
+
+
+def load_bidsmapsnapshot(yamlfile: Path) -> dict:
+    """
+    Reads the resolved bidsmap from its JSON snapshot, or from the yaml-file if the snapshot is missing or outdated, in
+    which case the snapshot is written. The snapshots are kept in the user's cache folder (never next to the yaml-file,
+    which may be a shared bidsfolder or an installed template) and contain only plain data, i.e. no code can be loaded
+
+    :param yamlfile:    The full pathname of the bidsmap yaml-file
+    :return:            The plain bidsmap (without comments, i.e. it is not suited for editing and saving)
+    """
+
+    content      = yamlfile.read_bytes()
+    snapshotfile = get_snapshotfile(yamlfile, content)
+
+    # Read the snapshot if there is one
+    try:
+        with snapshotfile.open('r') as snapshot_fid:
+            return json.load(snapshot_fid)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as snapshoterror:
+        logger.debug(f"Could not read the bidsmap snapshot {snapshotfile}: {snapshoterror}")
+
+    # Parse the yaml-file and (atomically) write the snapshot for the next time, if the bidsmap survives the JSON round-trip
+    bidsmap = plain_bidsmap(get_yaml().load(content.decode('utf-8')))
+    try:
+        snapshot = json.dumps(bidsmap)
+        if json.loads(snapshot) != bidsmap:
+            logger.debug(f"Cannot make a JSON snapshot of {yamlfile}")
+            return bidsmap
+        snapshotfolder.mkdir(parents=True, exist_ok=True)
+        tmpfile = snapshotfile.with_name(f"{snapshotfile.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmpfile.write_text(snapshot)
+        os.replace(tmpfile, snapshotfile)
+
+        # Remove the oldest snapshots
+        snapshots = sorted(snapshotfolder.glob('bidsmap_*.json'), key=lambda snapshot_: (snapshot_ == snapshotfile, snapshot_.stat().st_mtime_ns))
+        for snapshot_ in snapshots[:-SNAPSHOT_FILES]:
+            snapshot_.unlink()
+    except (OSError, TypeError, ValueError) as snapshoterror:
+        logger.debug(f"Could not write the bidsmap snapshot {snapshotfile}: {snapshoterror}")
+
+    return bidsmap
+
+
+def load_bidsmap(yamlfile: Path, folder: Path=Path(), report: bool=True, roundtrip: bool=True) -> Tuple[dict, Path]:
     """
     Read the mapping heuristics from the bidsmap yaml-file. If yamlfile is not fullpath, then 'folder' is first searched before
     the default 'heuristics'. If yamfile is empty, then first 'bidsmap.yaml' is searched for, them 'bidsmap_template.yaml'. So fullpath
@@ -481,6 +825,7 @@ def load_bidsmap(yamlfile: Path, folder: Path=Path(), report: bool=True) -> Tupl
     :param yamlfile:    The full pathname or basename of the bidsmap yaml-file. If None, the default bidsmap_template.yaml file in the heuristics folder is used
     :param folder:      Only used when yamlfile=basename or None: yamlfile is then first searched for in folder and then falls back to the ./heuristics folder (useful for centrally managed template yaml-files)
     :param report:      Report log.info when reading a file
+    :param roundtrip:   Read the comment-preserving (ruamel.yaml round-trip) structure that is needed for editing and saving. If False, a plain (read-only) bidsmap is loaded fast from its JSON snapshot
     :return:            Tuple with (1) ruamel.yaml dict structure, with all options, BIDS mapping heuristics, labels and attributes, etc and (2) the fullpath yaml-file
     """
 
@@ -511,8 +856,11 @@ def load_bidsmap(yamlfile: Path, folder: Path=Path(), report: bool=True) -> Tupl
         logger.info(f"Reading: {yamlfile}")
 
     # Read the heuristics from the bidsmap file
-    with yamlfile.open('r') as stream:
-        bidsmap = yaml.load(stream)
+    if roundtrip:
+        with yamlfile.open('r') as stream:
+            bidsmap = get_yaml().load(stream)
+    else:
+        bidsmap = load_bidsmapsnapshot(yamlfile)
 
     # Issue a warning if the version in the bidsmap YAML-file is not the same as the bidscoin version
     if 'bidscoin' in bidsmap['Options'] and 'version' in bidsmap['Options']['bidscoin']:
@@ -530,34 +878,97 @@ def load_bidsmap(yamlfile: Path, folder: Path=Path(), report: bool=True) -> Tupl
         bidsmap['PlugIns'] = []
     bidsmap['PlugIns'] = [plugin for plugin in bidsmap['PlugIns'] if plugin]
 
+    # Precompile the run attributes for matching
+    compile_bidsmap(bidsmap)
+
     return bidsmap, yamlfile
 
 
-def save_bidsmap(filename: Path, bidsmap: dict) -> None:
+def save_bidsmap(filename: Path, bidsmap: dict) -> bool:
     """
-    Save the BIDSmap as a YAML text file
+    Save the BIDSmap as a YAML text file. The bidsmap is serialized and validated in memory and then written to a temporary
+    file that atomically replaces the bidsmap file, i.e. the bidsmap file is never left behind in a corrupted state. This
+    function is thread-safe, so it can be run in the background (NB: as long as the bidsmap is not modified meanwhile)
 
-    :param filename:
+    :param filename:        The full pathname of the bidsmap file
     :param bidsmap:         Full bidsmap data structure, with all options, BIDS labels and attributes, etc
-    :return:
+    :return:                True if the bidsmap was successfully saved
     """
 
     logger.info(f"Writing bidsmap to: {filename}")
-    filename.parent.mkdir(parents=True, exist_ok=True)
-    with filename.open('w') as stream:
-        yaml.dump(bidsmap, stream)
 
-    # See if we can reload it, i.e. whether it is valid yaml...
+    # Serialize the bidsmap and see if we can reload it, i.e. whether it is valid yaml... NB: YAML() instances are not thread-safe
+    from ruamel.yaml import YAML
+    yaml_   = YAML()
+    stream  = io.StringIO()
     try:
-        load_bidsmap(filename, report=False)
-    except:
-        # Just trying again seems to help? :-)
-        with filename.open('w') as stream:
-            yaml.dump(bidsmap, stream)
-        try:
-            load_bidsmap(filename, report=False)
-        except:
-            logger.exception(f'The saved output bidsmap does not seem to be valid YAML, please check {filename}, e.g. by way of an online yaml validator, such as https://yamlchecker.com/')
+        yaml_.dump(bidsmap, stream)
+        content = stream.getvalue()
+        yaml_.load(content)
+    except Exception:
+        logger.exception(f'The bidsmap could not be serialized to valid YAML, the existing {filename} is left as is')
+        return False
+
+    # Atomically replace the bidsmap file
+    filename.parent.mkdir(parents=True, exist_ok=True)
+    tmpfile = filename.with_name(f".{filename.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with tmpfile.open('w') as stream:
+            stream.write(content)
+            stream.flush()
+            os.fsync(stream.fileno())
+        if filename.is_file():
+            shutil.copymode(filename, tmpfile)
+        os.replace(tmpfile, filename)
+    except OSError:
+        logger.exception(f'Could not write the bidsmap to: {filename}')
+        if tmpfile.is_file():
+            tmpfile.unlink()
+        return False
+
+    return True
+
+
+def read_x_protocol(dicomfile: Path) -> dict:
+    """
+    Reads all the 'key\t = \tvalue' lines of the Siemens protocol structure (the ASCCONV blocks) from a DICOM file in
+    a single pass. The file is memory-mapped and only the header part up to the pixel data is searched, so that just the
+    pages around the protocol blocks are actually read from disk. The results are kept in the protocolcache
+
+    :param dicomfile:   The full pathname of the dicom-file
+    :return:            A dictionary with the (raw string) protocol values, or an empty dictionary if there is no protocol
+    """
+
+    protocol = protocolcache.get(dicomfile)
+    if protocol is not None:
+        return protocol
+
+    protocol = {}
+
+    def search(mapped):
+        stop  = mapped.find(b'\xe0\x7f\x10\x00')                # The (little-endian) PixelData tag
+        stop  = len(mapped) if stop < 0 else stop
+        begin = mapped.find(b'### ASCCONV BEGIN', 0, stop)
+        while begin >= 0:
+            end = mapped.find(b'### ASCCONV END', begin, stop)
+            if end < 0:
+                end = stop
+            block = mapped[mapped.find(b'\n', begin, end) + 1:end]
+            for match in re.finditer(rb'^([^\s=#]+)\t = \t(.*?)\r?$', block, re.MULTILINE):
+                protocol.setdefault(match.group(1).decode('utf-8', 'replace'), match.group(2).decode('utf-8', 'replace'))
+            begin = mapped.find(b'### ASCCONV BEGIN', end, stop)
+
+    if archivetree.get(dicomfile) is not None:
+        search(archivetree.read(dicomfile))
+    else:
+        with dicomfile.open('rb') as fid:
+            if os.fstat(fid.fileno()).st_size:
+                with mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    search(mapped)
+
+    protocolcache.put(dicomfile, protocol, sum(len(key) + len(value) for key, value in protocol.items()))
+
+    return protocol
 
 
 def parse_x_protocol(pattern: str, dicomfile: Path) -> str:
@@ -566,101 +977,801 @@ def parse_x_protocol(pattern: str, dicomfile: Path) -> str:
     This structure is necessary to recreate a scanning protocol from a DICOM,
     since the DICOM information alone wouldn't be sufficient.
 
-    :param pattern:     A regexp expression: '^' + pattern + '\t = \t(.*)\\n'
+    :param pattern:     A protocol key (e.g. 'sKSpace.lBaseResolution') or a regexp expression that fully matches a key
     :param dicomfile:   The full pathname of the dicom-file
     :return:            The string extracted values from the dicom-file according to the given pattern
     """
 
-    if not is_dicomfile_siemens(dicomfile):
+    protocol = read_x_protocol(dicomfile)
+    if not protocol:
         logger.warning(f"Parsing {pattern} may fail because {dicomfile} does not seem to be a Siemens DICOM file")
 
-    regexp = '^' + pattern + '\t = \t(.*)\n'
-    regex  = re.compile(regexp.encode('utf-8'))
+    if pattern in protocol:
+        return protocol[pattern]
 
-    with dicomfile.open('rb') as openfile:
-        for line in openfile:
-            match = regex.match(line)
-            if match:
-                return match.group(1).decode('utf-8')
+    regex = re.compile(pattern)
+    for key, value in protocol.items():
+        if regex.fullmatch(key):
+            return value
 
-    logger.warning(f"Pattern: '{regexp.encode('unicode_escape').decode()}' not found in: {dicomfile}")
+    logger.warning(f"Pattern: '{pattern}' not found in: {dicomfile}")
     return None
 
 
-# Profiling shows this is currently the most expensive function, so therefore the (primitive but effective) _DICOMDICT_CACHE optimization
-_DICOMDICT_CACHE = None
-_DICOMFILE_CACHE = None
+def read_dicomfile(dicomfile: Path, pixeldata: bool=False, tags: tuple=()) -> 'pydicom.dataset.FileDataset':
+    """
+    Reads the header of a DICOM file. The pixel data is only read when explicitly asked for and large header elements
+    (e.g. the private Siemens CSA headers) are read from disk only when they are accessed. Virtual files are read from
+    their archive (see ArchiveTree)
+
+    :param dicomfile:   The full pathname of the dicom-file
+    :param pixeldata:   If True, the full DICOM file including the pixel data is read
+    :param tags:        If not empty, only these DICOM keywords (and the Modality and SeriesInstanceUID) are read from the header
+    :return:            The pydicom dataset
+    """
+
+    import pydicom
+
+    specific_tags = None
+    if tags:
+        specific_tags = [tag for tag in set(tags) | {'Modality', 'SeriesInstanceUID'} if pydicom.datadict.tag_for_keyword(tag)]
+
+    if archivetree.get(dicomfile) is not None:         # NB: There is nothing to defer, the header bytes are already in memory
+        return pydicom.dcmread(io.BytesIO(archivetree.read(dicomfile, pixeldata)), stop_before_pixels=not pixeldata, specific_tags=specific_tags, force=True)
+
+    if pixeldata:
+        return pydicom.dcmread(str(dicomfile), force=True)
+
+    return pydicom.dcmread(str(dicomfile), stop_before_pixels=True, defer_size=DICOM_DEFERSIZE, specific_tags=specific_tags, force=True)     # The DICM tag may be missing for anonymized DICOM files
+
+
+def get_bidsmaptags(bidsmap: dict, dataformat: str) -> set:
+    """
+    Collects the names of all the source attributes that are referenced in bidsmap[dataformat], i.e. the run
+    attributes and the <dynamic> bids values
+
+    :param bidsmap:     Full bidsmap data structure, with all options, BIDS labels and attributes, etc
+    :param dataformat:  The information source in the bidsmap that is used, e.g. 'DICOM'
+    :return:            The set of attribute names
+    """
+
+    def dynamic_tag(value) -> str:
+        return value[1:-1] if is_dynamic_value(value) else ''
+
+    tags = set()
+    if not bidsmap or not bidsmap.get(dataformat):
+        return tags
+
+    for key in ('subject', 'session'):
+        tags.add(dynamic_tag(bidsmap[dataformat].get(key)))
+    for modality in bidsmodalities + (unknownmodality, ignoremodality):
+        for run in bidsmap[dataformat].get(modality) or []:
+            tags.update(run['attributes'].keys())
+            for bidsvalue in run['bids'].values():
+                tags.add(dynamic_tag(bidsvalue))
+    tags.discard('')
+
+    return tags
+
+
+class HeaderCache:
+    """
+    A thread-safe least-recently-used (LRU) cache for parsed source file headers (or for other per-file results, such as
+    the file classifications). The entries are keyed by the file path
+    and are only valid for as long as the modification time and size of the file remain the same. The cache is bounded
+    by the number of entries and by their approximate total size in bytes
+    """
+
+    def __init__(self, maxentries: int=256, maxbytes: int=256*1024**2):
+        """
+        :param maxentries:  The maximum number of headers that are kept in the cache
+        :param maxbytes:    The maximum (approximate) total size of the cached headers
+        """
+
+        self.maxentries = maxentries
+        self.maxbytes   = maxbytes
+        self.hits       = 0
+        self.misses     = 0
+        self.evictions  = 0
+        self.nbytes     = 0
+        self._entries   = OrderedDict()
+        self._lock      = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __str__(self):
+        return f"{len(self)} entries ({self.nbytes/1024**2:.1f} MB), {self.hits} hits, {self.misses} misses, {self.evictions} evictions"
+
+    @staticmethod
+    def _stamp(sourcefile: Path) -> tuple:
+        member = archivetree.get(sourcefile)
+        if member is not None:
+            stat = member.archive.stat()        # The virtual file is valid for as long as its archive does not change
+            return stat.st_mtime_ns, stat.st_size, member.name
+        stat = sourcefile.stat()
+        return stat.st_mtime_ns, stat.st_size
+
+    def get(self, sourcefile: Path):
+        """
+        Gets the cached header of a source file
+
+        :param sourcefile:  The full pathname of the source file
+        :return:            The cached header or None if the header is not (or no longer validly) cached
+        """
+
+        key = str(sourcefile)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == self._stamp(sourcefile):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+
+        return None
+
+    def put(self, sourcefile: Path, header, nbytes: int=0) -> None:
+        """
+        Stores the header of a source file in the cache and evicts the least recently used headers if the cache is full
+
+        :param sourcefile:  The full pathname of the source file
+        :param header:      The parsed header
+        :param nbytes:      The approximate size of the header in bytes
+        :return:
+        """
+
+        key = str(sourcefile)
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (self._stamp(sourcefile), nbytes, header)
+            self.nbytes       += nbytes
+            while len(self._entries) > max(self.maxentries, 1) or (self.nbytes > self.maxbytes and len(self._entries) > 1):
+                _, (_, evicted, _) = self._entries.popitem(last=False)
+                self.nbytes       -= evicted
+                self.evictions    += 1
+
+    def discard(self, sourcefile: Path) -> None:
+        """Removes the header of a source file from the cache (if it is there)"""
+
+        with self._lock:
+            entry = self._entries.pop(str(sourcefile), None)
+            if entry is not None:
+                self.nbytes -= entry[1]
+
+    def clear(self) -> None:
+        """Removes all the headers from the cache (the hit/miss/eviction counters are kept)"""
+
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+
+class DirSnapshot:
+    """
+    A sorted os.scandir listing of a folder, split in subdirectories and files using the type information of the
+    directory entries (i.e. without stat calls on most filesystems). The dicom files that are found in the folder
+    by get_dicomfile are collected incrementally
+    """
+
+    def __init__(self, folder: Path, stamp: tuple):
+        """
+        :param folder:  The full pathname of the folder
+        :param stamp:   The (modification time, inode) stamp of the folder
+        """
+
+        dirs, files = [], []
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    dirs.append(entry.name)
+                elif entry.is_file():
+                    files.append(entry.name)
+
+        self.stamp      = stamp
+        self.dirs       = sorted(dirs,  key=lambda name: folder/name)       # Sort in the same (Path) order as sorted(folder.glob(wildcard))
+        self.files      = sorted(files, key=lambda name: folder/name)
+        self.dicomfiles = []
+        self.scanned    = 0
+        self.lock       = threading.RLock()
+
+
+class DirCache:
+    """
+    A thread-safe cache of DirSnapshot folder listings that are shared by lsdirs, get_dicomfile, get_parfiles and
+    get_dataformat. A snapshot is refreshed when the modification time of its folder changes. The number of scandir
+    and stat calls is counted, so that the reduction of filesystem calls can be verified
+    """
+
+    def __init__(self, maxentries: int=4096):
+        """
+        :param maxentries:  The maximum number of folder snapshots that are kept in the cache
+        """
+
+        self.maxentries = maxentries
+        self.scandirs   = 0
+        self.stats      = 0
+        self.hits       = 0
+        self.entries    = 0
+        self._snapshots = OrderedDict()
+        self._lock      = threading.RLock()
+
+    def __len__(self):
+        return len(self._snapshots)
+
+    def __str__(self):
+        return f"{len(self)} folders, {self.scandirs} scandirs ({self.entries} entries), {self.stats} stats, {self.hits} hits"
+
+    def get(self, folder: Path) -> DirSnapshot:
+        """
+        Gets the (cached) snapshot of a folder
+
+        :param folder:  The full pathname of the folder
+        :return:        The DirSnapshot of the folder. Raises an OSError if the folder cannot be listed
+        """
+
+        key = str(folder)
+        with self._lock:
+            stat        = os.stat(key)
+            stamp       = (stat.st_mtime_ns, stat.st_ino)
+            snapshot    = self._snapshots.get(key)
+            self.stats += 1
+            if snapshot is not None and snapshot.stamp == stamp:
+                self._snapshots.move_to_end(key)
+                self.hits += 1
+                return snapshot
+
+            snapshot             = DirSnapshot(folder, stamp)
+            self._snapshots[key] = snapshot
+            self.scandirs       += 1
+            self.entries        += len(snapshot.dirs) + len(snapshot.files)
+            while len(self._snapshots) > max(self.maxentries, 1):
+                self._snapshots.popitem(last=False)
+
+        return snapshot
+
+    def clear(self) -> None:
+        """Removes all the snapshots from the cache (the counters are kept)"""
+
+        with self._lock:
+            self._snapshots.clear()
+
+
+class _HeaderStream:
+    """
+    A read-only file-like view of an archive member stream that buffers all the bytes that are read, so that pydicom
+    can seek back in a forward-only (e.g. compressed tarball) stream and so that the header bytes can be kept
+    """
+
+    def __init__(self, fileobj, size: int):
+        """
+        :param fileobj: The (forward-only) file object of the archive member
+        :param size:    The size of the archive member in bytes
+        """
+
+        self.fileobj = fileobj
+        self.size    = size
+        self.buffer  = bytearray()
+        self.pos     = 0
+
+    def read(self, size: int=-1) -> bytes:
+        end = self.size if size is None or size < 0 else self.pos + size
+        while len(self.buffer) < min(end, self.size):
+            chunk = self.fileobj.read(max(end - len(self.buffer), 4096))
+            if not chunk:
+                break
+            self.buffer += chunk
+        data     = bytes(self.buffer[self.pos:end])
+        self.pos = min(end, len(self.buffer))
+        return data
+
+    def seek(self, offset: int, whence: int=0) -> int:
+        self.pos = (offset, self.pos + offset, self.size + offset)[whence]
+        return self.pos
+
+    def tell(self) -> int:
+        return self.pos
+
+
+class ArchiveMember:
+    """A DICOM file in a tarball or zip-file that is presented as a (virtual) file in the source tree"""
+
+    def __init__(self, archive: Path, name: str, size: int, index: int):
+        """
+        :param archive: The full pathname of the tarball or zip-file
+        :param name:    The name of the member in the archive
+        :param size:    The (uncompressed) size of the member in bytes
+        :param index:   The position of the member in the (streamed) archive
+        """
+
+        self.archive = archive
+        self.name    = name
+        self.size    = size
+        self.index   = index
+
+
+class _ArchiveCursor:
+    """
+    A forward-only read position in the stream of a (compressed) tarball. Members that are read in archive order are
+    served from the same stream, such that reading all the members costs a single pass over the archive. Reading a
+    member that lies before the current position restarts the stream
+    """
+
+    def __init__(self, archive: Path):
+        """
+        :param archive: The full pathname of the tarball
+        """
+
+        self.archive  = archive
+        self.stream   = None
+        self.position = 0               # The index of the next member in the stream
+        self.pending  = 0               # The number of bytes of the current member that have not been read
+        self.lock     = threading.Lock()
+
+    def seek(self, index: int):
+        """
+        Advances the stream to a member
+
+        :param index:   The position of the member in the archive
+        :return:        The (name, size, fileobj, skipped) tuple of the member, where skipped is the number of bytes that were streamed past
+        """
+
+        if self.stream is None or index < self.position:
+            self.close()
+            self.stream = ArchiveTree._stream(self.archive)
+        skipped      = self.pending
+        self.pending = 0
+        for name, size, fileobj in self.stream:
+            self.position += 1
+            if self.position - 1 == index:
+                return name, size, fileobj, skipped
+            skipped += size
+        self.close()
+
+        raise FileNotFoundError(f"Member {index} not found in {self.archive}")
+
+    def close(self) -> None:
+        """Closes the stream (and the archive)"""
+
+        if self.stream is not None:
+            self.stream.close()
+        self.stream   = None
+        self.position = 0
+        self.pending  = 0
+
+
+class ArchiveTree:
+    """
+    A thread-safe virtual source tree of the DICOM files in the tarballs and zip-files of a session folder. The archive
+    members are enumerated in a single streaming pass, without extracting them. Members in the root of an archive are
+    grouped into (virtual) SeriesNumber-SeriesDescription folders (as dicomsort would do) and the other members keep
+    their folder. The header bytes of the first DICOM file in each folder are kept in memory, all other members are
+    read from the archive when they are accessed. Zip-file members are read directly, tarball members are read from an
+    open stream per archive (see _ArchiveCursor), so members are best read in archive order. lsdirs, get_dicomfile, is_dicomfile, read_dicomfile and get_dicomfield
+    transparently support the (virtual) paths of the mounted members
+    """
+
+    def __init__(self):
+
+        self.mounts     = 0
+        self.members    = 0
+        self.bytesread  = 0
+        self._files     = {}        # The virtual folder -> list of DICOM file names
+        self._dirs      = {}        # The (virtual) folder -> set of virtual subfolder names
+        self._members   = {}        # The virtual file path -> ArchiveMember
+        self._headers   = {}        # The virtual file path -> the kept header bytes
+        self._mounted   = {}        # The session folder -> list of the virtual folders
+        self._cursors   = {}        # The tarball -> _ArchiveCursor
+        self._lock      = threading.RLock()
+
+    def __len__(self):
+        return len(self._members)
+
+    def __str__(self):
+        return f"{self.mounts} mounts, {self.members} members, {self.bytesread/1e6:.1f} MB read from the archives"
+
+    @staticmethod
+    def _stream(archive: Path) -> Iterable[Tuple[str, int, object]]:
+        """Yields the (name, size, fileobj) tuples of the regular files in a zip-file or (compressed) tarball in a single forward pass"""
+
+        if archive.suffix == '.zip':
+            with zipfile.ZipFile(archive, 'r') as zip_fid:
+                for member in zip_fid.infolist():
+                    if not member.is_dir():
+                        with zip_fid.open(member) as fileobj:
+                            yield member.filename, member.file_size, fileobj
+        else:
+            with tarfile.open(archive, 'r|*') as tar_fid:
+                for member in tar_fid:
+                    if member.isfile():
+                        yield member.name, member.size, tar_fid.extractfile(member)
+
+    @staticmethod
+    def _read(stream: _HeaderStream, stopgroup: int=0x7fe0):
+        """Parses the header of a member stream up to the stopgroup (i.e. up to the pixel data), or returns None if it is not a DICOM file"""
+
+        import pydicom
+
+        stream.seek(0)
+        sniff = _sniff_dicom(stream.read(0x84))
+        stream.seek(0)
+        if sniff is False:
+            return None
+        try:
+            dicomdict = pydicom.filereader.read_partial(stream, stop_when=lambda tag, vr, length: tag.group >= stopgroup, force=True)
+        except Exception as readerror:
+            logger.debug(f"Could not read the header: {readerror}")
+            return None
+
+        return dicomdict if sniff or _is_dicomdataset(dicomdict) else None
+
+    def mount(self, folder: Path, archives: List[Path]) -> bool:
+        """
+        Enumerates the members of the archives in folder and presents the DICOM files as a virtual source tree in folder.
+        Archives that contain other files than DICOM files (e.g. PAR/XML, DICOMDIR or NIfTI files) are not mounted
+
+        :param folder:      The full pathname of the session folder with the archives
+        :param archives:    The full pathnames of the tarballs and zip-files in folder
+        :return:            True if the archives were mounted, False if they need to be unpacked
+        """
+
+        try:
+            from bidscoin import dicomsort
+        except ImportError:
+            import dicomsort        # This should work if bidscoin was not pip-installed
+
+        files, dirs, members, headers = {}, {}, {}, {}
+        for archive in archives:
+            try:
+                for index, (name, size, fileobj) in enumerate(self._stream(archive)):
+                    member = Path(name)
+                    if member.is_absolute() or '..' in member.parts:
+                        logger.info(f"Cannot mount {archive} because of the unsafe member: {name}")
+                        return False
+                    if not member.name or member.name.startswith('.'):
+                        continue
+                    stream    = _HeaderStream(fileobj, size)
+                    dicomdict = self._read(stream, 0x0021) if member.name != 'DICOMDIR' else None        # Read just enough to get the SeriesNumber
+                    if dicomdict is None:
+                        logger.info(f"Cannot mount {archive} because of the non-DICOM member: {name}")
+                        return False
+
+                    # Put the root members in SeriesNumber-SeriesDescription folders and keep the folder of the other members
+                    if len(member.parts) == 1:
+                        seriesnr    = cast_value(dicomdict.get('SeriesNumber'))
+                        seriesdescr = cast_value(dicomdict.get('SeriesDescription')) or cast_value(dicomdict.get('ProtocolName')) or 'unknown_protocol'
+                        if not re.match(r'.*\.(IMA|dcm)$', member.name) or not isinstance(seriesnr, int):
+                            logger.info(f"Cannot mount {archive} because of the unsortable member: {name}")
+                            return False
+                        virtualdir = folder/dicomsort.cleanup(f"{seriesnr:03d}-{seriesdescr}")
+                    else:
+                        virtualdir = folder/member.parent
+                    virtualfile = virtualdir/member.name
+                    if str(virtualfile) in members:
+                        logger.warning(f"File already exists, cannot mount {name} from {archive} as {virtualfile}")
+                        continue
+
+                    # Register the member, its (parent) folders and keep the header bytes of the first file in each folder
+                    members[str(virtualfile)] = ArchiveMember(archive, name, size, index)
+                    files.setdefault(str(virtualdir), []).append(member.name)
+                    first = headers.get(str(virtualdir))
+                    if first is None or virtualfile < first[0]:
+                        self._read(stream)
+                        headers[str(virtualdir)] = (virtualfile, bytes(stream.buffer))
+                    self.bytesread += len(stream.buffer)
+                    while virtualdir != folder:
+                        dirs.setdefault(str(virtualdir.parent), set()).add(virtualdir.name)
+                        virtualdir = virtualdir.parent
+
+            except (OSError, tarfile.TarError, zipfile.BadZipFile) as readerror:
+                logger.warning(f"Cannot mount {archive}: {readerror}")
+                return False
+
+        if not members:
+            return False
+
+        with self._lock:
+            self.unmount(folder)
+            for virtualdir, names in files.items():
+                self._files[virtualdir] = sorted(names, key=lambda name: Path(virtualdir)/name)
+            for virtualdir, names in dirs.items():
+                self._dirs[virtualdir] = names
+            for virtualfile, header in headers.values():
+                self._headers[str(virtualfile)] = header
+            self._members.update(members)
+            self._mounted[str(folder)] = (list(files), list(dirs), list(members))
+            self.mounts  += 1
+            self.members += len(members)
+
+        logger.info(f"Mounted {len(members)} DICOM files in {len(files)} folders from: {', '.join(archive.name for archive in archives)}")
+
+        return True
+
+    def unmount(self, folder: Path) -> None:
+        """
+        Removes the virtual source tree of a session folder (if any)
+
+        :param folder:  The full pathname of the session folder
+        """
+
+        with self._lock:
+            files, dirs, members = self._mounted.pop(str(folder), ((), (), ()))
+            for virtualdir in files:
+                self._files.pop(virtualdir, None)
+            for virtualdir in dirs:
+                self._dirs.pop(virtualdir, None)
+            archives = set()
+            for virtualfile in members:
+                member = self._members.pop(virtualfile, None)
+                if member is not None:
+                    archives.add(str(member.archive))
+                self._headers.pop(virtualfile, None)
+            cursors = [self._cursors.pop(archive) for archive in archives if archive in self._cursors]
+        for cursor in cursors:
+            with cursor.lock:
+                cursor.close()
+        if files:
+            formatcache.discard(folder)
+
+    def is_mounted(self, folder: Path) -> bool:
+        """Returns True if folder contains a virtual source tree"""
+
+        return str(folder) in self._mounted
+
+    def get(self, file: Path) -> Union[ArchiveMember, None]:
+        """Returns the ArchiveMember of a virtual file, or None if file is not a virtual file"""
+
+        return self._members.get(str(file)) if self._members else None
+
+    def dirs(self, folder: Path) -> List[str]:
+        """Returns the names of the virtual subfolders of a (virtual or real) folder"""
+
+        return list(self._dirs.get(str(folder), ())) if self._dirs else []
+
+    def dicomfiles(self, folder: Path) -> List[Path]:
+        """Returns the sorted paths of the virtual DICOM files in a virtual folder"""
+
+        return [folder/name for name in self._files.get(str(folder), ())] if self._files else []
+
+    def read(self, file: Path, pixeldata: bool=False) -> bytes:
+        """
+        Reads the header bytes (or the full data) of a virtual file. The header bytes of the first file in a folder are
+        kept in memory, the other members are read from the zip-file or streamed from the (open) tarball until their header
+        has been read. The bytes that are streamed past in the tarball are included in self.bytesread
+
+        :param file:        The full pathname of the virtual file
+        :param pixeldata:   If True, all the data of the archive member is read
+        :return:            The (header) bytes of the archive member
+        """
+
+        member = self.get(file)
+        if member is None:
+            raise FileNotFoundError(f"{file} is not a mounted archive member")
+        if not pixeldata and str(file) in self._headers:
+            return self._headers[str(file)]
+
+        if member.archive.suffix == '.zip':
+            with zipfile.ZipFile(member.archive, 'r') as zip_fid, zip_fid.open(member.name) as fileobj:
+                return self._readmember(_HeaderStream(fileobj, member.size), pixeldata, 0)
+
+        with self._lock:
+            cursor = self._cursors.get(str(member.archive))
+            if cursor is None:
+                cursor = self._cursors[str(member.archive)] = _ArchiveCursor(member.archive)
+        with cursor.lock:
+            name, size, fileobj, skipped = cursor.seek(member.index)
+            if name != member.name:
+                raise FileNotFoundError(f"{member.name} not found in {member.archive}")
+            data           = self._readmember(_HeaderStream(fileobj, size), pixeldata, skipped)
+            cursor.pending = size - len(data)
+
+        return data
+
+    def _readmember(self, stream: _HeaderStream, pixeldata: bool, skipped: int) -> bytes:
+        """Reads the header bytes (or the full data) from the stream of an archive member"""
+
+        if pixeldata:
+            stream.read()
+        else:
+            self._read(stream)
+        with self._lock:
+            self.bytesread += skipped + len(stream.buffer)
+
+        return bytes(stream.buffer)
+
+    def extract(self, file: Path, targetfile: Path) -> Path:
+        """
+        Extracts a virtual file from its archive (e.g. to store it as a provenance sample)
+
+        :param file:        The full pathname of the virtual file
+        :param targetfile:  The full pathname of the extracted file
+        :return:            The targetfile
+        """
+
+        targetfile.write_bytes(self.read(file, pixeldata=True))
+
+        return targetfile
+
+
+# Profiling shows that reading the headers is the most expensive operation, so therefore the headercache optimization
+headercache   = HeaderCache()
+protocolcache = HeaderCache(maxentries=1024, maxbytes=64*1024**2)
+classcache    = HeaderCache(maxentries=262144)                    # The memoized is_dicomfile verdicts
+formatcache   = HeaderCache(maxentries=16384)                     # The memoized get_dataformat results of the session folders and source files
+dircache      = DirCache()
+archivetree   = ArchiveTree()
+_HEADERINDEX = None
+
+
+def open_headerindex(dbfile: Path):
+    """
+    Opens (or creates) a persistent header index that is consulted and refreshed by get_dicomfield and get_parfield
+
+    :param dbfile:  The full pathname of the SQLite index file, e.g. bidsfolder/code/bidscoin/headerindex.db
+    :return:        The headerindex.HeaderIndex object
+    """
+
+    global _HEADERINDEX
+
+    try:
+        from bidscoin import headerindex
+    except ImportError:
+        import headerindex      # This should work if bidscoin was not pip-installed
+
+    close_headerindex()
+    _HEADERINDEX = headerindex.HeaderIndex(dbfile)
+    logger.info(f"Using header index: {dbfile}")
+
+    return _HEADERINDEX
+
+
+def close_headerindex() -> None:
+    """Closes the persistent header index (if any)"""
+
+    global _HEADERINDEX
+
+    if _HEADERINDEX:
+        logger.debug(f"Header index: {_HEADERINDEX}")
+        _HEADERINDEX.close()
+        _HEADERINDEX = None
+
+
+def cast_value(value) -> Union[str, int]:
+    """
+    Casts a source (e.g. DICOM) datatype to int or str, i.e. to something that yaml.dump can handle
+
+    :param value:   The source value
+    :return:        The int or str value ('' if the value is None)
+    """
+
+    if value is None:
+        return ''
+
+    elif isinstance(value, int):
+        return int(value)
+
+    else:                               # Assume it's a MultiValue type and flatten it
+        return str(value)
+
+
 def get_dicomfield(tagname: str, dicomfile: Path) -> Union[str, int]:
     """
-    Robustly extracts a DICOM field/tag from a dictionary or from vendor specific fields
+    Robustly extracts a DICOM field/tag from a dictionary or from vendor specific fields. Only the DICOM header is read
 
     :param tagname:     Name of the DICOM field
     :param dicomfile:   The full pathname of the dicom-file
     :return:            Extracted tag-values from the dicom-file
     """
 
-    global _DICOMDICT_CACHE, _DICOMFILE_CACHE
+    return get_dicomfields((tagname,), dicomfile)[tagname]
+
+
+def get_dicomfields(tagnames: Iterable[str], dicomfile: Path, restrict: bool=False) -> dict:
+    """
+    Robustly extracts a batch of DICOM fields/tags from a dictionary or from vendor specific fields, using one validity
+    check and (at most) one header read. Only the DICOM header is read
+
+    :param tagnames:    Names of the DICOM fields
+    :param dicomfile:   The full pathname of the dicom-file
+    :param restrict:    If True, only the tagnames are read from the header, provided they are all DICOM keywords (e.g.
+                        bids.get_bidsmaptags(bidsmap, 'DICOM')). Otherwise the full header is read. Keywords that are absent
+                        from the top level of the header are then cached as empty values, except in enhanced (multi-frame)
+                        DICOM files, where they may be nested in the functional groups and the full header is read
+    :return:            A tagname -> extracted tag-value dictionary
+    """
 
+    tagnames = list(dict.fromkeys(tagnames))
     if not dicomfile.name:
-        return ''
+        return {tagname: '' for tagname in tagnames}
+
+    values = _HEADERINDEX.get_many(dicomfile, tagnames) if _HEADERINDEX else {}
+    missing = [tagname for tagname in tagnames if tagname not in values]
+    if not missing:
+        return values
 
-    if not dicomfile.is_file():
+    parsed = {}
+
+    member = archivetree.get(dicomfile)
+    if member is None and not dicomfile.is_file():
         logger.warning(f"{dicomfile} not found")
-        value = None
 
     elif not is_dicomfile(dicomfile):
-        logger.warning(f"{dicomfile} is not a DICOM file, cannot read {tagname}")
-        value = None
+        logger.warning(f"{dicomfile} is not a DICOM file, cannot read {', '.join(missing)}")
 
     else:
         try:
-            if dicomfile != _DICOMFILE_CACHE:
-                dicomdict = pydicom.dcmread(str(dicomfile), force=True)      # The DICM tag may be missing for anonymized DICOM files
-                if 'Modality' not in dicomdict:
+            header = headercache.get(dicomfile)
+            if header is None or (header['tags'] and not set(missing).issubset(header['tags'])):
+                tags = ()
+                if restrict and header is None:
+                    import pydicom
+                    if all(pydicom.datadict.tag_for_keyword(tagname) for tagname in missing):
+                        tags = tuple(missing)
+                dicomdict = read_dicomfile(dicomfile, tags=tags + ('SharedFunctionalGroupsSequence',) if tags else ())
+                if tags and 'SharedFunctionalGroupsSequence' in dicomdict and not all(tag in dicomdict for tag in tags):     # Absent keywords may be nested in the functional groups of enhanced DICOM files
+                    tags      = ()
+                    dicomdict = read_dicomfile(dicomfile)
+                if not _is_dicomdataset(dicomdict):
                     raise ValueError(f'Cannot read {dicomfile}')
-                _DICOMDICT_CACHE = dicomdict
-                _DICOMFILE_CACHE = dicomfile
-            else:
-                dicomdict = _DICOMDICT_CACHE
-
-            value = dicomdict.get(tagname)
-
-            # Try a recursive search
-            if not value:
-                for elem in dicomdict.iterall():
-                    if elem.name==tagname:
-                        value = elem.value
-                        continue
+                pixelsize = (dicomdict.get('Rows') or 0) * (dicomdict.get('Columns') or 0) * (dicomdict.get('BitsAllocated') or 0)//8     # The (first frame) pixel data is not read
+                header    = dict(dicomdict=dicomdict, tags=tags, fields={}, names=None)
+                headercache.put(dicomfile, header, max((member.size if member else dicomfile.stat().st_size) - pixelsize, 0))
 
         except OSError:
-            logger.warning(f'Cannot read {tagname} from {dicomfile}')
-            value = None
+            logger.warning(f"Cannot read {', '.join(missing)} from {dicomfile}")
+            header = None
+            missing = []
 
         except Exception:
+            header = None
+
+        for tagname in missing:
             try:
-                value = parse_x_protocol(tagname, dicomfile)
+                if header is None:
+                    raise ValueError(f'Cannot read {dicomfile}')
 
-            except Exception:
-                logger.warning(f'Could not parse {tagname} from {dicomfile}')
-                value = None
+                # Look-up the value in the flat field index (NB: this also contains the known-missing fields)
+                if tagname in header['fields']:
+                    value = header['fields'][tagname]
 
-    # Cast the dicom datatype to int or str (i.e. to something that yaml.dump can handle)
-    if value is None:
-        return ''
+                else:
+                    value = header['dicomdict'].get(tagname)
 
-    elif isinstance(value, int):
-        return int(value)
+                    # Try a recursive search (by name or by keyword) using a flat index of all the (nested) elements that is built only once.
+                    # The top-level elements take precedence over the nested elements, otherwise the first (nested) element wins
+                    if not value:
+                        if header['names'] is None:
+                            header['names'] = {}
+                            for elem in itertools.chain(header['dicomdict'], header['dicomdict'].iterall()):
+                                header['names'].setdefault(elem.name, elem.value)
+                                if elem.keyword:
+                                    header['names'].setdefault(elem.keyword, elem.value)
+                        value = header['names'].get(tagname, value)
 
-    elif not isinstance(value, str):    # Assume it's a MultiValue type and flatten it
-        return str(value)
+                    header['fields'][tagname] = value
+                parsed[tagname] = value
 
-    else:
-        return str(value)
+            except OSError:
+                logger.warning(f'Cannot read {tagname} from {dicomfile}')
+
+            except Exception:
+                try:
+                    parsed[tagname] = parse_x_protocol(tagname, dicomfile)
+
+                except Exception:
+                    logger.warning(f'Could not parse {tagname} from {dicomfile}')
+
+    # Cast the dicom datatypes and store the parsed values in the persistent header index
+    for tagname in tagnames:
+        if tagname not in values:
+            values[tagname] = cast_value(parsed.get(tagname))
+    if parsed and _HEADERINDEX:
+        _HEADERINDEX.put_many(dicomfile, {tagname: values[tagname] for tagname in parsed})
+
+    return values
 
 
-# Profiling shows this is currently the most expensive function, so therefore the (primitive but effective) _PARDICT_CACHE optimization
-_PARDICT_CACHE = None
-_PARFILE_CACHE = None
 def get_parfield(tagname: str, parfile: Path) -> Union[str, int]:
     """
     Extracts the value from a PAR/XML field
@@ -670,51 +1781,62 @@ def get_parfield(tagname: str, parfile: Path) -> Union[str, int]:
     :return:        Extracted tag-values from the PAR/XML file
     """
 
-    global _PARDICT_CACHE, _PARFILE_CACHE
+    return get_parfields((tagname,), parfile)[tagname]
+
+
+def get_parfields(tagnames: Iterable[str], parfile: Path) -> dict:
+    """
+    Extracts a batch of values from the PAR/XML fields, using one validity check and (at most) one header read
+
+    :param tagnames:    Names of the PAR/XML fields
+    :param parfile:     The full pathname of the PAR/XML file
+    :return:            A tagname -> extracted tag-value dictionary
+    """
 
+    tagnames = list(dict.fromkeys(tagnames))
     if not parfile.name:
-        return ''
+        return {tagname: '' for tagname in tagnames}
+
+    values = _HEADERINDEX.get_many(parfile, tagnames) if _HEADERINDEX else {}
+    missing = [tagname for tagname in tagnames if tagname not in values]
+    if not missing:
+        return values
+
+    parsed = {}
 
     if not parfile.is_file():
         logger.warning(f"{parfile} not found")
-        value = None
 
     elif not is_parfile(parfile):
-        logger.warning(f"{parfile} is not a PAR/XML file, cannot read {tagname}")
-        value = None
+        logger.warning(f"{parfile} is not a PAR/XML file, cannot read {', '.join(missing)}")
 
     else:
         try:
-            if parfile != _PARFILE_CACHE:
-                pardict = nibabel.parrec.parse_PAR_header(parfile.open('r'))
+            pardict = headercache.get(parfile)
+            if pardict is None:
+                import nibabel.parrec
+                with parfile.open('r') as parfid:
+                    pardict = nibabel.parrec.parse_PAR_header(parfid)
                 if 'series_type' not in pardict[0]:
                     raise ValueError(f'Cannot read {parfile}')
-                _PARDICT_CACHE = pardict
-                _PARFILE_CACHE = parfile
-            else:
-                pardict = _PARDICT_CACHE
-            value = pardict[0].get(tagname)
+                headercache.put(parfile, pardict, parfile.stat().st_size)
+            for tagname in missing:
+                parsed[tagname] = pardict[0].get(tagname)
 
         except OSError:
-            logger.warning(f'Cannot read {tagname} from {parfile}')
-            value = None
+            logger.warning(f"Cannot read {', '.join(missing)} from {parfile}")
 
         except Exception:
-            logger.warning(f'Could not parse {tagname} from {parfile}')
-            value = None
-
-    # Cast the dicom datatype to int or str (i.e. to something that yaml.dump can handle)
-    if value is None:
-        return ''
-
-    elif isinstance(value, int):
-        return int(value)
+            logger.warning(f"Could not parse {', '.join(missing)} from {parfile}")
 
-    elif not isinstance(value, str):  # Assume it's a MultiValue type and flatten it
-        return str(value)
+    # Cast the PAR datatypes and store the parsed values in the persistent header index
+    for tagname in tagnames:
+        if tagname not in values:
+            values[tagname] = cast_value(parsed.get(tagname))
+    if parsed and _HEADERINDEX:
+        _HEADERINDEX.put_many(parfile, {tagname: values[tagname] for tagname in parsed})
 
-    else:
-        return str(value)
+    return values
 
 
 def get_dataformat(source: Path) -> str:
@@ -726,7 +1848,18 @@ def get_dataformat(source: Path) -> str:
     """
 
 
+    # Get the memoized dataformat, if the source has not changed since it was last classified
+    try:
+        dataformat = formatcache.get(source)
+        if dataformat is not None:
+            return dataformat
+    except OSError as nosource:
+        logger.warning(nosource)
+        logger.warning(f"Cannot determine the dataformat of: {source}")
+        return ''
+
     # If source is a session directory, get a sourcefile
+    dataformat = ''
     try:
         if source.is_dir():
 
@@ -735,19 +1868,23 @@ def get_dataformat(source: Path) -> str:
             for sourcedir in sourcedirs:
                 sourcefile = get_dicomfile(sourcedir)
                 if sourcefile.name:
-                    return 'DICOM'
+                    dataformat = 'DICOM'
+                    break
 
             # Try to see if we can find PAR/XML files
-            sourcefiles = get_parfiles(source)
-            if sourcefiles:
-                return 'PAR'
+            if not dataformat and get_parfiles(source):
+                dataformat = 'PAR'
 
         # If we don't know the dataformat, just try
-        if is_dicomfile(source):
-            return 'DICOM'
+        if not dataformat and is_dicomfile(source):
+            dataformat = 'DICOM'
 
-        if is_parfile(source):
-            return 'PAR'
+        if not dataformat and is_parfile(source):
+            dataformat = 'PAR'
+
+        if dataformat:
+            formatcache.put(source, dataformat)
+            return dataformat
 
     except OSError as nosource:
         logger.warning(nosource)
@@ -776,6 +1913,28 @@ def get_sourcefield(tagname: str, sourcefile: Path=Path(), dataformat: str='') -
         return get_parfield(tagname, sourcefile)
 
 
+def get_sourcefields(tagnames: Iterable[str], sourcefile: Path=Path(), dataformat: str='') -> dict:
+    """
+    Wrapper around get_dicomfields and get_parfields to read a batch of fields from the same sourcefile at once
+
+    :param tagnames:    Names of the fields in the sourcefile
+    :param sourcefile:  The full pathname of the (e.g. DICOM or PAR/XML) sourcefile
+    :param dataformat:  The information source in the bidsmap that is used, e.g. 'DICOM'
+    :return:            A tagname -> value dictionary
+    """
+
+    if not dataformat:
+        dataformat = get_dataformat(sourcefile)
+
+    if dataformat=='DICOM':
+        return get_dicomfields(tagnames, sourcefile)
+
+    if dataformat=='PAR':
+        return get_parfields(tagnames, sourcefile)
+
+    return {tagname: None for tagname in tagnames}
+
+
 def add_prefix(prefix: str, tag: str) -> str:
     """
     Simple function to account for optional BIDS tags in the bids file names, i.e. it prefixes 'prefix' only when tag is not empty
@@ -824,12 +1983,13 @@ def cleanup_value(label: str) -> str:
     convert other spaces, special BIDS characters and anything that is not an alphanumeric to a ''. This will for
     example map "Joe's reward_task" to "Joesrewardtask"
 
-    :param label:   The given label that potentially contains undesired characters
+    :param label:   The given label that potentially contains undesired characters (e.g. an int value is converted to str)
     :return:        The cleaned-up / BIDS-valid label
     """
 
     if label is None:
         return ''
+    label = str(label)
 
     special_characters = (' ', '_', '-','.')
 
@@ -862,6 +2022,29 @@ def dir_bidsmap(bidsmap: dict, dataformat: str) -> List[Path]:
     return provenance
 
 
+def find_run(bidsmap: dict, dataformat: str, provenance, modality: str='') -> Tuple[str, str, Union[int, None]]:
+    """
+    Looks up a run in the bidsmap by its provenance, using the provenance index of the bidsmap
+
+    :param bidsmap:     Full bidsmap data structure, with all options, BIDS labels and attributes, etc
+    :param dataformat:  The information source in the bidsmap that is used, e.g. 'DICOM'. If empty then it is determined from the provenance
+    :param provenance:  The unique provenance that is used to identify the run
+    :param modality:    The modality that is searched, e.g. 'anat'. Empty values will search through all modalities
+    :return:            A (dataformat, modality, index) tuple, such that run = bidsmap[dataformat][modality][index], or index = None if the run is not found
+    """
+
+    if not dataformat:
+        dataformat = get_dataformat(Path(provenance))
+
+    bidsmapindex = get_bidsmapindex(bidsmap, dataformat)
+    for modality_ in [modality] if modality else bidsmodalities + (unknownmodality, ignoremodality):
+        indices = bidsmapindex.find(modality_, provenance)
+        if indices:
+            return dataformat, modality_, indices[0]
+
+    return dataformat, modality, None
+
+
 def get_run(bidsmap: dict, dataformat: str, modality: str, suffix_idx: Union[int, str], sourcefile: Path='') -> dict:
     """
     Find the (first) run in bidsmap[dataformat][bidsmodality] with run['bids']['suffix_idx'] == suffix_idx
@@ -882,16 +2065,20 @@ def get_run(bidsmap: dict, dataformat: str, modality: str, suffix_idx: Union[int
 
             run_ = dict(provenance={}, attributes={}, bids={})
 
+            # Read all the source attributes and dynamic bids values in one go
+            if sourcefile.name:
+                sourcefields = get_sourcefields(list(run['attributes']) + [bidsvalue[1:-1] for bidsvalue in run['bids'].values() if is_dynamic_value(bidsvalue)], sourcefile, dataformat)
+
             for attrkey, attrvalue in run['attributes'].items():
                 if sourcefile.name:
-                    run_['attributes'][attrkey] = get_sourcefield(attrkey, sourcefile, dataformat)
+                    run_['attributes'][attrkey] = sourcefields[attrkey]
                     run_['provenance']          = str(sourcefile.resolve())
                 else:
                     run_['attributes'][attrkey] = attrvalue
 
             for bidskey, bidsvalue in run['bids'].items():
                 if sourcefile.name:
-                    run_['bids'][bidskey] = get_dynamic_value(bidsvalue, sourcefile)
+                    run_['bids'][bidskey] = get_dynamic_value(bidsvalue, sourcefile, sourcefields)
                 else:
                     run_['bids'][bidskey] = bidsvalue
 
@@ -914,9 +2101,11 @@ def delete_run(bidsmap: dict, dataformat: str, modality: str, provenance: Path)
     if not dataformat:
         dataformat = get_dataformat(provenance)
 
-    for index, run in enumerate(bidsmap[dataformat][modality]):
-        if run['provenance'] == str(provenance):
-            del bidsmap[dataformat][modality][index]
+    bidsmapindex = get_bidsmapindex(bidsmap, dataformat)
+    for index in reversed(bidsmapindex.find(modality, provenance)):
+        run = bidsmap[dataformat][modality][index]
+        del bidsmap[dataformat][modality][index]
+        bidsmapindex.remove(modality, run, index)
 
     return bidsmap
 
@@ -953,6 +2142,7 @@ def append_run(bidsmap: dict, dataformat: str, modality: str, run: dict, clean:
         bidsmap[dataformat][modality] = [run]
     else:
         bidsmap[dataformat][modality].append(run)
+    get_bidsmapindex(bidsmap, dataformat).add(modality, run)
 
     return bidsmap
 
@@ -980,7 +2170,11 @@ def update_bidsmap(bidsmap: dict, source_modality: str, provenance: Path, target
     if not dataformat:
         dataformat = get_dataformat(run['provenance'])
 
-    num_runs_in = len(dir_bidsmap(bidsmap, dataformat))
+    # Count the runs in the affected modalities only
+    def num_runs() -> int:
+        return sum(len(bidsmap[dataformat].get(modality) or []) for modality in {source_modality, target_modality})
+
+    num_runs_in = num_runs()
 
     # Warn the user if the target run already exists when the run is moved to another modality
     if source_modality!=target_modality:
@@ -994,18 +2188,133 @@ def update_bidsmap(bidsmap: dict, source_modality: str, provenance: Path, target
         bidsmap = append_run(bidsmap, dataformat, target_modality, run, clean)
 
     else:
-        for index, run_ in enumerate(bidsmap[dataformat][target_modality]):
-            if run_['provenance'] == str(provenance):
-                bidsmap[dataformat][target_modality][index] = run
-                break
+        bidsmapindex = get_bidsmapindex(bidsmap, dataformat)
+        for index in bidsmapindex.find(target_modality, provenance)[0:1]:
+            run_ = bidsmap[dataformat][target_modality][index]
+            bidsmap[dataformat][target_modality][index] = run
+            bidsmapindex.replace(target_modality, index, run_, run)
 
-    num_runs_out = len(dir_bidsmap(bidsmap, dataformat))
+    num_runs_out = num_runs()
     if num_runs_out != num_runs_in:
         logger.error(f"Number of runs in bidsmap['{dataformat}'] changed unexpectedly: {num_runs_in} -> {num_runs_out}")
 
     return bidsmap
 
 
+def cast2list(string: str):
+    """
+    Interprets attribute lists (e.g. "['*mprage*', '*MPRAGE*']") as lists
+
+    :param string:  The attribute string
+    :return:        The list or, if the string is not a list, the unmodified string
+    """
+
+    if string.startswith('[') and string.endswith(']'):
+        try:
+            string = ast.literal_eval(string)
+            if not isinstance(string, list):
+                logger.error(f"Attribute value '{string}' is not a list")
+        except:
+            logger.error(f"Could not interpret attribute value '{string}'")
+    return string
+
+
+def compile_attribute(values):
+    """
+    Compiles a (bidsmap) attribute value into a predicate function that matches source values in the same way as
+    match_attribute(longvalue, values) does. The literal_eval'd lists are parsed only once, the wildcard items are
+    combined into a single regular expression and the literal items are matched with a set look-up. The predicates
+    are memoized, i.e. attribute values that are shared by many runs (or source files) are only compiled once
+
+    :param values:  Either a list with search items or a string that is matched one-to-one
+    :return:        A predicate(longvalue) -> bool function
+    """
+
+    key = (type(values).__name__, str(values))
+    predicate = _attributepredicates.get(key)
+    if predicate is not None:
+        return predicate
+
+    # Consider it a match if both longvalue and values are empty / None
+    if not values:
+        def predicate(longvalue) -> bool:
+            return longvalue==values or not longvalue
+
+    else:
+
+        # Account for lists in the template (to combine similar mappings)
+        items = cast2list(str(values))
+        if isinstance(items, list):
+            liststr = str(items)
+        else:
+            liststr = None
+            items   = [items]
+
+        # Split the items in literals and (combined) wildcard patterns, using the same case normalization as fnmatch.fnmatch
+        literals = set()
+        patterns = []
+        for item in items:
+            item = os.path.normcase(str(item))
+            if any(char in item for char in '*?['):
+                patterns.append(fnmatch.translate(item))
+            else:
+                literals.add(item)
+        regex = re.compile('|'.join(f"(?:{pattern})" for pattern in patterns)).match if patterns else None
+
+        def predicate(longvalue) -> bool:
+
+            # Consider it a match if both longvalue and values are identical
+            if longvalue==values:
+                return True
+            if not longvalue:
+                return False
+
+            # If they are both lists, compare them as they are
+            longvalue = cast2list(str(longvalue))
+            if isinstance(longvalue, list):
+                if liststr is not None:
+                    return str(longvalue)==liststr
+            else:
+                longvalue = [longvalue]
+
+            # Compare the value items (with / without wildcard) with the longvalue string items
+            for item in longvalue:
+                item = os.path.normcase(str(item))
+                if item in literals or (regex and regex(item)):
+                    return True
+
+            return False
+
+    if len(_attributepredicates) > 65536:
+        _attributepredicates.clear()
+    _attributepredicates[key] = predicate
+
+    return predicate
+
+
+_attributepredicates = {}
+
+
+def compile_bidsmap(bidsmap: dict) -> dict:
+    """
+    Compiles the attribute values of all runs in the bidsmap into predicate functions (see compile_attribute), so that
+    get_matching_run and exist_run do not have to parse them again for every source file
+
+    :param bidsmap: Full bidsmap data structure, with all options, BIDS labels and attributes, etc
+    :return:        The (unmodified) bidsmap
+    """
+
+    for dataformat in bidsmap or {}:
+        if dataformat in ('Options', 'PlugIns') or not isinstance(bidsmap[dataformat], dict):
+            continue
+        for modality in bidsmodalities + (unknownmodality, ignoremodality):
+            for run in bidsmap[dataformat].get(modality) or []:
+                for attrvalue in (run.get('attributes') or {}).values():
+                    compile_attribute(attrvalue)
+
+    return bidsmap
+
+
 def match_attribute(longvalue, values) -> bool:
     """
     Compare the value items with / without *wildcard* with the longvalue string. If both longvalue
@@ -1024,47 +2333,226 @@ def match_attribute(longvalue, values) -> bool:
                         empty / None. False otherwise
     """
 
-    # Consider it a match if both longvalue and values are identical or empty / None
-    if longvalue==values or (not longvalue and not values):
-        return True
+    return compile_attribute(values)(longvalue)
 
-    if not longvalue or not values:
-        return False
 
-    # Make sure we start with string types
-    longvalue = str(longvalue)
-    values    = str(values)
+class BidsmapIndex:
+    """
+    An index of the runs in a bidsmap[dataformat] section that is kept up-to-date by append_run, delete_run and
+    update_bidsmap. For every modality it holds a provenance -> list-index map and the canonical attribute signatures
+    of the runs, grouped by their set of attribute keys, such that find_run, delete_run, update_bidsmap and exist_run
+    can look up a run in O(1). Runs with wildcard or list attribute values cannot be canonicalized and are kept aside
+    for the (slow) match_attribute path. Runs that are edited in-place (e.g. in the bidseditor) must be followed by a
+    call to invalidate(), after which the index of the modality is rebuilt when it is used
+    """
 
-    # Interpret attribute lists as lists
-    def cast2list(string: str):
-        if string.startswith('[') and string.endswith(']'):
-            try:
-                string = ast.literal_eval(string)
-                if not isinstance(string, list):
-                    logger.error(f"Attribute value '{string}' is not a list")
-            except:
-                logger.error(f"Could not interpret attribute value '{string}'")
-        return string
-
-    longvalue = cast2list(longvalue)
-    values    = cast2list(values)
-
-    # Account for lists in the template (to combine similar mappings)
-    if not isinstance(values, list):
-        values = [values]
-
-    # If they are both lists, compare them as they are
-    elif isinstance(longvalue, list):
-        return str(longvalue)==str(values)
-
-    # Compare the value items (with / without wildcard) with the longvalue string items
-    if not isinstance(longvalue, list):
-        longvalue = [longvalue]
-    for value in values:
-        if any([fnmatch.fnmatch(str(item), str(value)) for item in longvalue]):
-            return True
+    def __init__(self, section: dict):
+        """
+        :param section: The bidsmap[dataformat] section that is indexed
+        """
 
-    return False
+        self.section    = section
+        self.modalities = {}            # modality -> dict(runs=list, length=int, provenances={provenance: [indices]}, buckets={attrkeys: bucket}, slow=[runs])
+
+    @staticmethod
+    def canonical(attrvalue, stored: bool):
+        """
+        Gets the canonical form of an attribute value, such that match_attribute(itemvalue, value) is True if and only if
+        the canonical forms of itemvalue (stored=False) and value (stored=True) are equal
+
+        :param attrvalue:   The attribute value
+        :param stored:      True for the attribute values of the runs in the bidsmap (i.e. the match patterns)
+        :return:            The canonical value (None for empty values) or Ellipsis if the value has no canonical form
+        """
+
+        if not attrvalue:
+            return None
+        if stored:
+            literal = RunIndex.literal(attrvalue)
+            return ... if literal is None else literal
+        if isinstance(attrvalue, bool) or not isinstance(attrvalue, (str, int)):
+            return ...
+        value = str(attrvalue)
+        if value.startswith('[') and value.endswith(']'):
+            return ...
+        return os.path.normcase(value)
+
+    def _modality(self, modality: str) -> dict:
+        """Gets the index of the modality, (re)building it if it was invalidated or if the runs list has been replaced or resized outside the bidsmap helper functions"""
+
+        runs  = self.section.get(modality) or []
+        entry = self.modalities.get(modality)
+        if entry is None or entry['runs'] is not runs or entry['length'] != len(runs):
+            entry = self.modalities[modality] = dict(runs=runs, length=0, provenances={}, buckets={}, slow=[])
+            for run in runs:
+                self._add(entry, run)
+
+        return entry
+
+    def invalidate(self, modality: str='') -> None:
+        """
+        Discards the index of a modality, e.g. after the attributes or provenance of one of its runs have been edited in-place
+
+        :param modality:    The modality of the edited run. Empty values discard the index of all modalities
+        :return:
+        """
+
+        if modality:
+            self.modalities.pop(modality, None)
+        else:
+            self.modalities.clear()
+
+    def _sign(self, entry: dict, run: dict, increment: int) -> None:
+        """Adds (increment=1) or removes (increment=-1) the canonical attribute signature of a run"""
+
+        keys      = tuple(sorted(run['attributes']))
+        signature = tuple(self.canonical(run['attributes'][key], True) for key in keys)
+        if ... in signature:
+            if increment > 0:
+                entry['slow'].append(run)
+            else:
+                entry['slow'] = [run_ for run_ in entry['slow'] if run_ is not run]
+            return
+
+        bucket = entry['buckets'].setdefault(keys, dict(counts={}, projections={}))
+        for counts, key in [(bucket['counts'], signature)] + [(counts, tuple(value for key, value in zip(keys, signature) if key in subkeys))
+                                                               for subkeys, counts in bucket['projections'].items()]:
+            counts[key] = counts.get(key, 0) + increment
+            if not counts[key]:
+                del counts[key]
+
+    def _add(self, entry: dict, run: dict) -> None:
+        entry['provenances'].setdefault(str(run['provenance']), []).append(entry['length'])
+        entry['length'] += 1
+        self._sign(entry, run, 1)
+
+    def _remove(self, entry: dict, run: dict, index: int) -> None:
+        entry['length'] -= 1
+        indices = entry['provenances'].get(str(run['provenance']), [])
+        if index in indices:
+            indices.remove(index)
+            if not indices:
+                del entry['provenances'][str(run['provenance'])]
+        for indices in entry['provenances'].values():
+            indices[:] = [index_ - 1 if index_ > index else index_ for index_ in indices]
+        self._sign(entry, run, -1)
+
+    def _current(self, modality: str, delta: int) -> dict:
+        """Returns the index of the modality if it is in sync with self.section[modality] after a change of delta runs, otherwise None"""
+
+        entry = self.modalities.get(modality)
+        if entry is not None and entry['runs'] is self.section.get(modality) and entry['length'] == len(entry['runs']) - delta:
+            return entry
+
+    def add(self, modality: str, run: dict) -> None:
+        """Registers a run that has been appended to self.section[modality]"""
+
+        entry = self._current(modality, 1)
+        if entry:
+            self._add(entry, run)
+
+    def remove(self, modality: str, run: dict, index: int) -> None:
+        """Unregisters a run that has been removed from self.section[modality][index]"""
+
+        entry = self._current(modality, -1)
+        if entry:
+            self._remove(entry, run, index)
+
+    def replace(self, modality: str, index: int, oldrun: dict, newrun: dict) -> None:
+        """Re-registers the run in self.section[modality][index] that has been replaced by a new run"""
+
+        entry = self._current(modality, 0)
+        if entry and oldrun is newrun:            # The run has been edited in-place, i.e. its old signature is lost
+            self.invalidate(modality)
+        elif entry:
+            indices = entry['provenances'].get(str(oldrun['provenance']), [])
+            if index in indices:
+                indices.remove(index)
+                if not indices:
+                    del entry['provenances'][str(oldrun['provenance'])]
+            entry['provenances'].setdefault(str(newrun['provenance']), []).append(index)
+            entry['provenances'][str(newrun['provenance'])].sort()
+            self._sign(entry, oldrun, -1)
+            self._sign(entry, newrun, 1)
+
+    def find(self, modality: str, provenance) -> list:
+        """
+        Looks up the runs in self.section[modality] by their provenance
+
+        :param modality:    The modality that is searched
+        :param provenance:  The provenance of the run
+        :return:            The (sorted) list indices of the runs with this provenance
+        """
+
+        entry   = self._modality(modality)
+        indices = entry['provenances'].get(str(provenance), [])
+        if any(index >= len(entry['runs']) or entry['runs'][index]['provenance'] != str(provenance) for index in indices):
+            self.modalities.pop(modality)                       # A run has been modified in-place, rebuild the index
+            indices = self._modality(modality)['provenances'].get(str(provenance), [])
+
+        return list(indices)
+
+    def exists(self, modality: str, run_item: dict):
+        """
+        Checks if there is already a run in self.section[modality] with attributes that match the attributes of run_item
+
+        :param modality:    The modality that is searched
+        :param run_item:    The run that is searched for
+        :return:            True or False, or None if run_item cannot be canonicalized (i.e. if the slow path needs to be taken)
+        """
+
+        attributes = run_item['attributes']
+        if not any(value is not None for value in attributes.values()):
+            return False
+        itemvalues = {key: self.canonical(value, False) for key, value in attributes.items()}
+        if ... in itemvalues.values():
+            return None
+
+        entry = self._modality(modality)
+        for keys, bucket in entry['buckets'].items():
+
+            # The item attributes that are absent in the run must be empty
+            if any(value is not None and key not in keys for key, value in itemvalues.items()):
+                continue
+
+            # Look-up the item signature, projected onto the shared attribute keys
+            subkeys = tuple(key for key in keys if key in itemvalues)
+            query   = tuple(itemvalues[key] for key in subkeys)
+            if subkeys == keys:
+                counts = bucket['counts']
+            else:
+                counts = bucket['projections'].get(subkeys)
+                if counts is None:
+                    counts = bucket['projections'][subkeys] = {}
+                    for signature, count in bucket['counts'].items():
+                        projection         = tuple(value for key, value in zip(keys, signature) if key in subkeys)
+                        counts[projection] = counts.get(projection, 0) + count
+            if counts.get(query):
+                return True
+
+        return any(match_run(run, run_item) for run in entry['slow'])
+
+
+def get_bidsmapindex(bidsmap: dict, dataformat: str) -> BidsmapIndex:
+    """
+    Gets the (cached) BidsmapIndex of bidsmap[dataformat]
+
+    :param bidsmap:     Full bidsmap data structure, with all options, BIDS labels and attributes, etc
+    :param dataformat:  The information source in the bidsmap that is used, e.g. 'DICOM'
+    :return:            The BidsmapIndex
+    """
+
+    section = bidsmap[dataformat]
+    index   = _bidsmapindices.get(id(section))
+    if index is None or index.section is not section:
+        if len(_bidsmapindices) > 64:
+            _bidsmapindices.clear()
+        index = _bidsmapindices[id(section)] = BidsmapIndex(section)
+
+    return index
+
+
+_bidsmapindices = {}
 
 
 def exist_run(bidsmap: dict, dataformat: str, modality: str, run_item: dict, matchbidslabels: bool=False) -> bool:
@@ -1090,34 +2578,285 @@ def exist_run(bidsmap: dict, dataformat: str, modality: str, run_item: dict, mat
     if not bidsmap[dataformat] or not bidsmap[dataformat][modality]:
         return False
 
-    for run in bidsmap[dataformat][modality]:
+    # Look-up the canonical attribute signature of the run_item (this is not possible for wildcard or list values)
+    if not matchbidslabels:
+        exists = get_bidsmapindex(bidsmap, dataformat).exists(modality, run_item)
+        if exists is not None:
+            return exists
 
-        # Begin with match = False only if all attributes are empty
-        match = any([run_item['attributes'][key] is not None for key in run_item['attributes']])
+    for run in bidsmap[dataformat][modality]:
 
-        # Search for a case where all run_item items match with the run_item items
-        for itemkey, itemvalue in run_item['attributes'].items():
-            value = run['attributes'].get(itemkey, None)    # Matching bids-labels which exist in one modality but not in the other -> None
-            match = match and match_attribute(itemvalue, value)
-            if not match:
-                break                                       # There is no point in searching further within the run_item now that we've found a mismatch
-
-        # See if the bidslabels also all match. This is probably not very useful, but maybe one day...
-        if matchbidslabels and match:
-            for itemkey, itemvalue in run_item['bids'].items():
-                value = run['bids'].get(itemkey, None)      # Matching bids-labels which exist in one modality but not in the other -> None
-                match = match and value==itemvalue
-                if not match:
-                    break                                   # There is no point in searching further within the run_item now that we've found a mismatch
-
-        # Stop searching if we found a matching run_item (i.e. which is the case if match is still True after all run tests). TODO: maybe count how many instances, could perhaps be useful info
-        if match:
+        # Stop searching if we found a matching run_item. TODO: maybe count how many instances, could perhaps be useful info
+        if match_run(run, run_item, matchbidslabels):
             return True
 
     return False
 
 
-def get_matching_run(sourcefile: Path, bidsmap: dict, dataformat: str, modalities: tuple = (ignoremodality,) + bidsmodalities + (unknownmodality,)) -> Tuple[dict, str, Union[int, None]]:
+def match_run(run: dict, run_item: dict, matchbidslabels: bool=False) -> bool:
+    """
+    Checks if the attributes and, optionally, the bids values of run_item match with run
+
+    :param run:             The run (listitem) in the bidsmap
+    :param run_item:        The run (listitem) that is searched for
+    :param matchbidslabels: If True, also matches the BIDS-labels, otherwise only run['attributes']
+    :return:                True if run_item matches with run
+    """
+
+    # Begin with match = False only if all attributes are empty
+    match = any([run_item['attributes'][key] is not None for key in run_item['attributes']])
+
+    # Search for a case where all run_item items match with the run_item items
+    for itemkey, itemvalue in run_item['attributes'].items():
+        value = run['attributes'].get(itemkey, None)    # Matching bids-labels which exist in one modality but not in the other -> None
+        match = match and match_attribute(itemvalue, value)
+        if not match:
+            break                                       # There is no point in searching further within the run_item now that we've found a mismatch
+
+    # See if the bidslabels also all match. This is probably not very useful, but maybe one day...
+    if matchbidslabels and match:
+        for itemkey, itemvalue in run_item['bids'].items():
+            value = run['bids'].get(itemkey, None)      # Matching bids-labels which exist in one modality but not in the other -> None
+            match = match and value==itemvalue
+            if not match:
+                break                                   # There is no point in searching further within the run_item now that we've found a mismatch
+
+    return match
+
+
+class RunIndex:
+    """
+    An inverted index of the runs in bidsmap[dataformat] that prunes the candidate runs of get_matching_run. For every
+    attribute key, the runs with an exact (i.e. non-wildcard, non-list) attribute value are indexed by that value, such
+    that only the runs that exactly match (or that have a wildcard / empty value for) all these attributes have to be
+    evaluated. The candidate runs are kept as bitmasks in search order, so the first-match-wins semantics are retained
+    """
+
+    def __init__(self, bidsmap: dict, dataformat: str, modalities: tuple):
+        """
+        :param bidsmap:     Full bidsmap data structure, with all options, BIDS labels and attributes, etc
+        :param dataformat:  The information source in the bidsmap that is used, e.g. 'DICOM'
+        :param modalities:  The modalities in which a matching run is searched for (in search order)
+        """
+
+        self.runs      = []         # The (modality, index, run, tests) tuples in search order
+        self.last      = None       # The (modality, run) of the last run in search order
+        self.tagnames  = set()      # The attributes and dynamic values that are needed to match and fill the runs
+        self.viable    = 0          # The bitmask of the runs that have at least one non-empty attribute
+        self.exact     = {}         # The attrkey -> {value: bitmask} index of the runs with an exact attribute value
+        self.wildcards = {}         # The attrkey -> bitmask of the runs without an exact attribute value
+        self.objects   = runsignature(bidsmap, dataformat, modalities)       # NB: Keep the objects alive, so that their ids cannot be reused
+        self.signature = tuple(map(id, self.objects))
+        self.hash      = hashlib.sha1(repr([(dataformat, modality, index, list(run['attributes'].items())) for modality in modalities
+                                                    for index, run in enumerate(bidsmap[dataformat].get(modality) or [])]).encode()).hexdigest()
+
+        for modality in modalities:
+            for index, run in enumerate(bidsmap[dataformat].get(modality) or []):
+                bit   = 1 << len(self.runs)
+                tests = [(attrkey, compile_attribute(attrvalue)) for attrkey, attrvalue in run['attributes'].items() if attrvalue]
+                self.runs.append((modality, index, run, tests))
+                self.last = (modality, run)
+                self.tagnames.update(run['attributes'].keys())
+                self.tagnames.update(bidsvalue[1:-1] for bidsvalue in run['bids'].values() if is_dynamic_value(bidsvalue))
+                if any(attrvalue is not None for attrvalue in run['attributes'].values()):
+                    self.viable |= bit
+                for attrkey, attrvalue in run['attributes'].items():
+                    literal = self.literal(attrvalue)
+                    if literal is None:
+                        self.wildcards[attrkey] = self.wildcards.get(attrkey, 0) | bit
+                    else:
+                        self.exact.setdefault(attrkey, {})
+                        self.exact[attrkey][literal] = self.exact[attrkey].get(literal, 0) | bit
+
+        self.attrkeys = tuple(sorted({attrkey for _, _, run, _ in self.runs for attrkey in run['attributes']}))
+
+        # Runs that lack an indexed attribute altogether are unconstrained by it
+        allruns = (1 << len(self.runs)) - 1
+        for attrkey in self.exact:
+            constrained = 0
+            for mask in self.exact[attrkey].values():
+                constrained |= mask
+            self.wildcards[attrkey] = allruns & ~constrained
+
+    @staticmethod
+    def literal(attrvalue):
+        """Returns the normalized exact value of a (non-empty, non-wildcard, non-list) attribute value, or None if the value cannot be indexed"""
+
+        if not attrvalue or isinstance(attrvalue, bool) or not isinstance(attrvalue, (str, int)):
+            return None
+        literal = os.path.normcase(str(attrvalue))
+        if any(char in literal for char in '*?['):
+            return None
+        return literal
+
+    @staticmethod
+    def keys(sourcevalue) -> set:
+        """Returns the normalized (list) items of a source value that can match exact attribute values"""
+
+        if not sourcevalue:
+            return set()
+        items = cast2list(str(sourcevalue))
+        if not isinstance(items, list):
+            items = [items]
+        return {os.path.normcase(str(item)) for item in items}
+
+    def candidates(self, sourcefields: dict) -> list:
+        """
+        Gets the runs that may match the source attributes
+
+        :param sourcefields:    The attributes of the sourcefile, e.g. from get_sourcefields
+        :return:                The (modality, index, run, tests) candidates in search order
+        """
+
+        mask = self.viable
+        for attrkey, exact in self.exact.items():
+            if not mask:
+                break
+            allowed = self.wildcards[attrkey]
+            for key in self.keys(sourcefields.get(attrkey)):
+                allowed |= exact.get(key, 0)
+            mask &= allowed
+
+        candidates = []
+        while mask:
+            bit   = mask & -mask
+            mask ^= bit
+            candidates.append(bit.bit_length() - 1)
+
+        return candidates
+
+    def matches(self, sourcefields: dict) -> list:
+        """
+        Gets the runs that match the source attributes. The results are memoized in the matchmemo, keyed by the tested
+        attribute values and the hash of the bidsmap runs, so that repeated scan protocols are resolved instantly
+
+        :param sourcefields:    The attributes of the sourcefile, e.g. from get_sourcefields
+        :return:                The positions (in search order) of the matching runs in self.runs
+        """
+
+        key     = (self.hash, tuple(sourcefields[attrkey] for attrkey in self.attrkeys))
+        matches = matchmemo.get(key)
+        if matches is None:
+            matches = [position for position in self.candidates(sourcefields)
+                       if all(predicate(sourcefields[attrkey]) for attrkey, predicate in self.runs[position][3])]
+            matchmemo.put(key, matches)
+
+        return matches
+
+
+class MatchMemo:
+    """
+    A bounded memo of the get_matching_run results, keyed by the tuple of tested attribute values (i.e. the scan
+    protocol signature) and the hash of the bidsmap runs
+    """
+
+    def __init__(self, maxentries: int=65536):
+        """
+        :param maxentries:  The maximum number of results that are kept in the memo
+        """
+
+        self.maxentries = maxentries
+        self.hits       = 0
+        self.misses     = 0
+        self._results   = OrderedDict()
+        self._lock      = threading.RLock()
+
+    def __len__(self):
+        return len(self._results)
+
+    def __str__(self):
+        total = self.hits + self.misses
+        return f"{len(self)} protocols, {self.hits} hits, {self.misses} misses ({100*self.hits/total if total else 0:.0f}% hit rate)"
+
+    def get(self, key: tuple):
+        """
+        Gets the memoized result
+
+        :param key: The (bidsmap hash, attribute values) key
+        :return:    The memoized result or None if the result is not memoized
+        """
+
+        with self._lock:
+            result = self._results.get(key)
+            if result is None:
+                self.misses += 1
+            else:
+                self._results.move_to_end(key)
+                self.hits += 1
+
+        return result
+
+    def put(self, key: tuple, result) -> None:
+        """
+        Stores a result in the memo and removes the least recently used results if the memo is full
+
+        :param key:     The (bidsmap hash, attribute values) key
+        :param result:  The result
+        :return:
+        """
+
+        with self._lock:
+            self._results[key] = result
+            while len(self._results) > max(self.maxentries, 1):
+                self._results.popitem(last=False)
+
+    def clear(self) -> None:
+        """Removes all the results from the memo (the hit/miss counters are kept)"""
+
+        with self._lock:
+            self._results.clear()
+
+
+def runsignature(bidsmap: dict, dataformat: str, modalities: tuple) -> list:
+    """
+    Gets the objects that make up the runs in bidsmap[dataformat]. Their ids form a cheap signature that changes when a
+    run, an attribute or a bids value is added, removed or replaced (as long as the objects themselves are kept alive)
+
+    :param bidsmap:     Full bidsmap data structure, with all options, BIDS labels and attributes, etc
+    :param dataformat:  The information source in the bidsmap that is used, e.g. 'DICOM'
+    :param modalities:  The modalities of the runs
+    :return:            The list of run objects
+    """
+
+    objects = []
+    for modality in modalities:
+        runs = bidsmap[dataformat].get(modality) or []
+        objects.append(runs)
+        for run in runs:
+            objects.append(run)
+            objects.extend(run['attributes'].keys())
+            objects.extend(run['attributes'].values())
+            objects.extend(run['bids'].values())
+
+    return objects
+
+
+def get_runindex(bidsmap: dict, dataformat: str, modalities: tuple) -> RunIndex:
+    """
+    Gets the (cached) RunIndex of bidsmap[dataformat]. The index is rebuilt if the runs in the bidsmap have changed
+
+    :param bidsmap:     Full bidsmap data structure, with all options, BIDS labels and attributes, etc
+    :param dataformat:  The information source in the bidsmap that is used, e.g. 'DICOM'
+    :param modalities:  The modalities in which a matching run is searched for (in search order)
+    :return:            The RunIndex
+    """
+
+    key      = (id(bidsmap[dataformat]), dataformat, tuple(modalities))
+    runindex = _runindices.get(key)
+    if runindex is None or runindex.signature != tuple(map(id, runsignature(bidsmap, dataformat, modalities))):
+        runindex = RunIndex(bidsmap, dataformat, tuple(modalities))
+        if len(_runindices) > 16:
+            _runindices.clear()
+        _runindices[key] = runindex
+
+    return runindex
+
+
+_runindices = {}
+matchmemo   = MatchMemo()
+
+
+def get_matching_run(sourcefile: Path, bidsmap: dict, dataformat: str, modalities: tuple = (ignoremodality,) + bidsmodalities + (unknownmodality,), sourcefields: dict=None) -> Tuple[dict, str, Union[int, None]]:
     """
     Find the first run in the bidsmap with dicom attributes that match with the dicom file. Then update the (dynamic) bids values (values are cleaned-up to be BIDS-valid)
 
@@ -1125,6 +2864,7 @@ def get_matching_run(sourcefile: Path, bidsmap: dict, dataformat: str, modalitie
     :param bidsmap:     Full bidsmap data structure, with all options, BIDS labels and attributes, etc
     :param dataformat:  The information source in the bidsmap that is used, e.g. 'DICOM'
     :param modalities:  The modality in which a matching run is searched for. Default = (ignoremodality,) + bidsmodalities + (unknownmodality,)
+    :param sourcefields: The (prefetched) attributes of the sourcefile, e.g. from get_sourcefields. If None or incomplete, the attributes are read from the sourcefile
     :return:            (run, modality, index) The matching and filled-in / cleaned run item, modality and list index as in run = bidsmap[DICOM][modality][index]
                         modality = bids.unknownmodality and index = None if there is no match, the run is still populated with info from the dicom-file
     """
@@ -1132,48 +2872,163 @@ def get_matching_run(sourcefile: Path, bidsmap: dict, dataformat: str, modalitie
     if not dataformat:
         dataformat = get_dataformat(sourcefile)
 
-    # Loop through all bidsmodalities and runs; all info goes into run_
-    run_ = dict(provenance={}, attributes={}, bids={})
-    for modality in modalities:
+    # Read all the source attributes and dynamic bids values that are needed in one go
+    runindex = get_runindex(bidsmap, dataformat, modalities)
+    if sourcefields is None or not runindex.tagnames.issubset(sourcefields):
+        sourcefields = get_sourcefields(sorted(runindex.tagnames), sourcefile, dataformat)
+
+    # Evaluate only the candidate runs that are not ruled out by the (exact) attribute index (or get the memoized matches of the scan protocol)
+    matches = [runindex.runs[position][0:3] for position in runindex.matches(sourcefields)]
+    if len(matches) > 1:
+        logger.debug(f"{sourcefile} matches multiple runs: {', '.join(f'{modality}[{index}]' for modality, index, _ in matches)} -> using {matches[0][0]}[{matches[0][1]}]")
+
+    # Stop searching the bidsmap if we have a match
+    if matches:
+        modality, index, run = matches[0]
+        run_ = fill_run(run, sourcefile, sourcefields)
+        run_['provenance'] = str(sourcefile.resolve())
+
+        return run_, modality, index
+
+    # We don't have a match (all tests failed, so modality should be the *last* one, i.e. unknownmodality). The run is still populated from the last run
+    modality = modalities[-1] if modalities else ''
+    run_     = dict(provenance={}, attributes={}, bids={})
+    if runindex.last:
+        run_ = fill_run(runindex.last[1], sourcefile, sourcefields)
+    logger.debug(f"Could not find a matching run in the bidsmap for {sourcefile} -> {modality}")
+    run_['provenance'] = str(sourcefile.resolve())
 
-        if bidsmap[dataformat][modality] is None: continue
+    return run_, modality, None
 
-        for index, run in enumerate(bidsmap[dataformat][modality]):
 
-            run_  = dict(provenance={}, attributes={}, bids={})                                             # The CommentedMap API is not guaranteed for the future so keep this line as an alternative
-            match = any([run['attributes'][attrkey] is not None for attrkey in run['attributes']])          # Normally match==True, but make match==False if all attributes are empty
+def fill_run(run: dict, sourcefile: Path, sourcefields: dict) -> dict:
+    """
+    Creates a new run item with the attributes and (dynamic) bids values of run filled in with the info from the sourcefile
 
-            # Try to see if the sourcefile matches all of the attributes and fill all of them
-            for attrkey, attrvalue in run['attributes'].items():
+    :param run:             The run item from the bidsmap
+    :param sourcefile:      The full pathname of the source dicom-file or PAR/XML file
+    :param sourcefields:    The attributes of the sourcefile (e.g. from get_sourcefields)
+    :return:                The filled-in / cleaned run item
+    """
 
-                # Check if the attribute value matches with the info from the sourcefile
-                sourcevalue = get_sourcefield(attrkey, sourcefile, dataformat)
-                if attrvalue:
-                    match = match and match_attribute(sourcevalue, attrvalue)
+    run_ = dict(provenance={}, attributes={}, bids={})                                                     # The CommentedMap API is not guaranteed for the future so keep this line as an alternative
 
-                # Fill the empty attribute with the info from the sourcefile
-                run_['attributes'][attrkey] = sourcevalue
+    # Fill the attributes with the info from the sourcefile
+    for attrkey in run['attributes']:
+        run_['attributes'][attrkey] = sourcefields[attrkey]
 
-            # Try to fill the bids-labels
-            for bidskey, bidsvalue in run['bids'].items():
+    # Try to fill the bids-labels
+    for bidskey, bidsvalue in run['bids'].items():
 
-                # Replace the dynamic bids values
-                run_['bids'][bidskey] = get_dynamic_value(bidsvalue, sourcefile)
+        # Replace the dynamic bids values
+        run_['bids'][bidskey] = get_dynamic_value(bidsvalue, sourcefile, sourcefields)
 
-                # SeriesDescriptions (and ProtocolName?) may get a suffix like '_SBRef' from the vendor, try to strip it off
-                run_ = strip_suffix(run_)
+        # SeriesDescriptions (and ProtocolName?) may get a suffix like '_SBRef' from the vendor, try to strip it off
+        run_ = strip_suffix(run_)
 
-            # Stop searching the bidsmap if we have a match. TODO: check if there are more matches (i.e. conflicts)
-            if match:
-                run_['provenance'] = str(sourcefile.resolve())
+    return run_
 
-                return run_, modality, index
 
-    # We don't have a match (all tests failed, so modality should be the *last* one, i.e. unknownmodality)
-    logger.debug(f"Could not find a matching run in the bidsmap for {sourcefile} -> {modality}")
-    run_['provenance'] = str(sourcefile.resolve())
+def get_sourcetable(sourcefiles: List[Path], tagnames: Iterable[str], dataformat: str=''):
+    """
+    Extracts the attributes of many sourcefiles into a columnar table
 
-    return run_, modality, None
+    :param sourcefiles: The full pathnames of the source dicom-files or PAR/XML files
+    :param tagnames:    The names of the attributes (columns) that are extracted
+    :param dataformat:  The information source in the bidsmap that is used, e.g. 'DICOM'
+    :return:            A pandas DataFrame with one row per sourcefile and one (object) column per attribute
+    """
+
+    import pandas as pd
+
+    tagnames = sorted(set(tagnames))
+    rows     = [get_sourcefields(tagnames, sourcefile, dataformat) for sourcefile in sourcefiles]
+
+    return pd.DataFrame(rows, columns=tagnames, index=[str(sourcefile) for sourcefile in sourcefiles], dtype=object)
+
+
+def match_sourcetable(sourcetable, bidsmap: dict, dataformat: str, modalities: tuple = (ignoremodality,) + bidsmodalities + (unknownmodality,)):
+    """
+    Finds the first matching run in the bidsmap for all rows of a sourcetable at once. The run predicates are evaluated
+    only once for every unique value in a column and are then broadcast as boolean masks over all the rows
+
+    :param sourcetable: A table with the source attributes, e.g. from get_sourcetable (the attributes of the runs in the bidsmap should be present as columns)
+    :param bidsmap:     Full bidsmap data structure, with all options, BIDS labels and attributes, etc
+    :param dataformat:  The information source in the bidsmap that is used, e.g. 'DICOM'
+    :param modalities:  The modalities in which a matching run is searched for. Default = (ignoremodality,) + bidsmodalities + (unknownmodality,)
+    :return:            An integer array with the position of the first matching run in RunIndex.runs (or -1 if there is no match) for every row
+    """
+
+    import numpy as np
+    import pandas as pd
+
+    runindex  = get_runindex(bidsmap, dataformat, modalities)
+    nrows     = len(sourcetable)
+    positions = np.full(nrows, -1, dtype=int)
+    unmatched = np.ones(nrows, dtype=bool)
+    columns   = {}          # The (codes, uniques, lookup-tables) per column
+
+    for position, (_, _, _, tests) in enumerate(runindex.runs):
+        if not unmatched.any():
+            break
+        if not runindex.viable & (1 << position):
+            continue
+
+        mask = unmatched.copy()
+        for attrkey, predicate in tests:
+            if attrkey not in columns:
+                values           = sourcetable[attrkey] if attrkey in sourcetable else pd.Series([None] * nrows, dtype=object)
+                codes, uniques   = pd.factorize(values.to_numpy(dtype=object))
+                columns[attrkey] = (codes, list(uniques), {})
+            codes, uniques, luts = columns[attrkey]
+            if id(predicate) not in luts:
+                luts[id(predicate)] = np.array([bool(predicate(value)) for value in uniques] + [bool(predicate(None))])   # NB: The missing values have code -1, i.e. the last item
+            mask &= luts[id(predicate)][codes]
+            if not mask.any():
+                break
+
+        positions[mask]  = position
+        unmatched[mask]  = False
+
+    return positions
+
+
+def get_matching_runs(sourcefiles: List[Path], bidsmap: dict, dataformat: str, modalities: tuple = (ignoremodality,) + bidsmodalities + (unknownmodality,)) -> List[Tuple[dict, str, Union[int, None]]]:
+    """
+    Batch version of get_matching_run: finds the first run in the bidsmap that matches with each of the sourcefiles. The
+    attributes are extracted into a columnar table and all sourcefiles are matched at once (see match_sourcetable)
+
+    :param sourcefiles: The full pathnames of the source dicom-files or PAR/XML files
+    :param bidsmap:     Full bidsmap data structure, with all options, BIDS labels and attributes, etc
+    :param dataformat:  The information source in the bidsmap that is used, e.g. 'DICOM'
+    :param modalities:  The modality in which a matching run is searched for. Default = (ignoremodality,) + bidsmodalities + (unknownmodality,)
+    :return:            A list with the same (run, modality, index) tuples as get_matching_run returns for every sourcefile
+    """
+
+    if not sourcefiles:
+        return []
+
+    if not dataformat:
+        dataformat = get_dataformat(sourcefiles[0])
+
+    runindex    = get_runindex(bidsmap, dataformat, modalities)
+    sourcetable = get_sourcetable(sourcefiles, runindex.tagnames, dataformat)
+    positions   = match_sourcetable(sourcetable, bidsmap, dataformat, modalities)
+
+    results = []
+    for sourcefile, position, (_, sourcefields) in zip(sourcefiles, positions, sourcetable.iterrows()):
+        sourcefields = {key: value for key, value in sourcefields.items()}
+        if position >= 0:
+            modality, index, run, _ = runindex.runs[position]
+            run_ = fill_run(run, sourcefile, sourcefields)
+        else:
+            modality = modalities[-1] if modalities else ''
+            index    = None
+            run_     = fill_run(runindex.last[1], sourcefile, sourcefields) if runindex.last else dict(provenance={}, attributes={}, bids={})
+        run_['provenance'] = str(sourcefile.resolve())
+        results.append((run_, modality, index))
+
+    return results
 
 
 def get_subid_sesid(sourcefile: Path, subid: str= '<<SourceFilePath>>', sesid: str= '<<SourceFilePath>>', subprefix: str= 'sub-', sesprefix: str= 'ses-') -> Tuple[str, str]:
@@ -1215,6 +3070,70 @@ def get_subid_sesid(sourcefile: Path, subid: str= '<<SourceFilePath>>', sesid: s
     return subid, sesid
 
 
+# The BIDS filename templates: (bidslabel, prefix, required) tuples that follow the [_ses-<label>] entity. Optional entities are
+# left out if their value is empty, required entities are always added (i.e. also if their value is missing)
+bidsnametemplates = {
+    # bidsname: sub-<participant_label>[_ses-<session_label>][_acq-<label>][_ce-<label>][_rec-<label>][_run-<index>][_mod-<label>]_suffix
+    'anat': (('acq', '_acq-', False), ('ce', '_ce-', False), ('rec', '_rec-', False), ('run', '_run-', False), ('mod', '_mod-', False), ('suffix', '_', True)),
+
+    # bidsname: sub-<label>[_ses-<label>]_task-<label>[_acq-<label>][_ce-<label>][_dir-<label>][_rec-<label>][_run-<index>][_echo-<index>]_<contrast_label>.nii[.gz]
+    'func': (('task', '_task-', True), ('acq', '_acq-', False), ('ce', '_ce-', False), ('dir', '_dir-', False), ('rec', '_rec-', False), ('run', '_run-', False),
+             ('echo', '_echo-', False), ('suffix', '_', True)),
+
+    # bidsname: sub-<label>[_ses-<label>][_acq-<label>][_dir-<label>][_run-<index>]_dwi.nii[.gz]
+    'dwi':  (('acq', '_acq-', False), ('dir', '_dir-', False), ('run', '_run-', False), ('suffix', '_', True)),
+
+    # bidsname: sub-<label>[_ses-<label>][_acq-<label>][_ce-<label>]_dir-<label>[_run-<index>]_epi.nii[.gz]       TODO: add more fieldmap logic?
+    'fmap': (('acq', '_acq-', False), ('ce', '_ce-', False), ('dir', '_dir-', False), ('run', '_run-', False), ('suffix', '_', True)),
+
+    # bidsname: sub-<participant_label>[_ses-<session_label>]_task-<task_name>_suffix
+    'beh':  (('task', '_task-', True), ('suffix', '_', True)),
+
+    # bidsname: sub-<participant_label>[_ses-<session_label>]_task-<task_label>[_acq-<label>][_rec-<label>][_run-<index>]_suffix
+    'pet':  (('task', '_task-', True), ('acq', '_acq-', False), ('rec', '_rec-', False), ('run', '_run-', False), ('suffix', '_', True)),
+
+    # bidsname: sub-<participant_label>[_ses-<session_label>]_acq-<label>[..][_suffix]
+    unknownmodality: (('task', '_task-', False), ('acq', '_acq-', True), ('ce', '_ce-', False), ('rec', '_rec-', False), ('dir', '_dir-', False), ('run', '_run-', False),
+                      ('echo', '_echo-', False), ('mod', '_mod-', False), ('suffix', '_', False))}
+bidsnametemplates[ignoremodality] = bidsnametemplates[unknownmodality]
+
+dynamiccache = HeaderCache(maxentries=16384)                      # The memoized dynamic bidsvalues of the source files
+
+
+def get_dynamic_values(bidsvalues: Iterable, sourcefile: Path) -> dict:
+    """
+    Batched and memoized version of get_dynamic_value. The resolved (dynamic) values are cached per source file, such that
+    composing the BIDS names of the same run over and over again (e.g. in the bidseditor) does not require header reads
+
+    :param bidsvalues:  The values from the BIDS key-value pairs
+    :param sourcefile:  The source (e.g. DICOM or PAR/XML) file from which the attributes are read
+    :return:            A {bidsvalue: updated bidsvalue} dictionary
+    """
+
+    bidsvalues = [bidsvalue for bidsvalue in bidsvalues if is_dynamic_value(bidsvalue)]
+    if not bidsvalues or not sourcefile.name:
+        return {}
+
+    try:
+        resolved = dynamiccache.get(sourcefile)
+    except OSError:
+        resolved = None
+    if resolved is None:
+        resolved = {}
+    missing = [bidsvalue for bidsvalue in bidsvalues if bidsvalue not in resolved]
+    if missing:
+        resolved       = dict(resolved)                           # The cached dictionaries are never modified in-place (thread safety)
+        sourcefields   = get_sourcefields([bidsvalue[1:-1] for bidsvalue in missing], sourcefile)
+        for bidsvalue in missing:
+            resolved[bidsvalue] = get_dynamic_value(bidsvalue, sourcefile, sourcefields)
+        try:
+            dynamiccache.put(sourcefile, resolved)
+        except OSError:
+            pass
+
+    return resolved
+
+
 def get_bidsname(subid: str, sesid: str, modality: str, run: dict, runindex: str= '', subprefix: str= 'sub-', sesprefix: str= 'ses-') -> str:
     """
     Composes a filename as it should be according to the BIDS standard using the BIDS labels in run
@@ -1222,7 +3141,7 @@ def get_bidsname(subid: str, sesid: str, modality: str, run: dict, runindex: str
     :param subid:       The subject identifier, i.e. name of the subject folder (e.g. 'sub-001' or just '001'). Can be left empty
     :param sesid:       The optional session identifier, i.e. name of the session folder (e.g. 'ses-01' or just '01'). Can be left empty
     :param modality:    The bidsmodality (choose from bids.bidsmodalities)
-    :param run:         The run mapping with the BIDS labels
+    :param run:         The run mapping with the BIDS labels. The run is not modified
     :param runindex:    The optional runindex label (e.g. 'run-01'). Can be left ''
     :param subprefix:   The optional subprefix (e.g. 'sub-'). Used to parse the sub-value from the provenance as default subid
     :param sesprefix:   The optional sesprefix (e.g. 'ses-'). If it is found in the provenance then a default sesid will be set
@@ -1234,123 +3153,46 @@ def get_bidsname(subid: str, sesid: str, modality: str, run: dict, runindex: str
     if run['provenance']:
         subid, sesid = get_subid_sesid(Path(run['provenance']), subid, sesid, subprefix, sesprefix)
 
-    # Validate and do some checks to allow for dragging the run entries between the different modality-sections
-    run = copy.deepcopy(run)                # Avoid side effects when changing run
-    for bidslabel in bidslabels:
-        if bidslabel not in run['bids']:
-            run['bids'][bidslabel] = None
-        else:
-            run['bids'][bidslabel] = cleanup_value(get_dynamic_value(run['bids'][bidslabel], Path(run['provenance'])))
+    # Get the cleaned-up (dynamic) BIDS labels. NB: Absent labels are None, such that the run entries can be dragged between the different modality-sections
+    values  = run['bids']
+    dynamic = get_dynamic_values([values[bidslabel] for bidslabel in bidslabels if bidslabel in values], Path(run['provenance']))
+    labels  = {bidslabel: cleanup_value(dynamic.get(values[bidslabel], values[bidslabel]) if isinstance(values[bidslabel], str) else values[bidslabel])
+               if bidslabel in values else None for bidslabel in bidslabels}
 
     # Use the clean-up runindex
-    if not runindex:
-        runindex = run['bids']['run']
-
-    # Compose the BIDS filename (-> switch statement)
-    if modality == 'anat':
-
-        # bidsname: sub-<participant_label>[_ses-<session_label>][_acq-<label>][_ce-<label>][_rec-<label>][_run-<index>][_mod-<label>]_suffix
-        bidsname = '{sub}{_ses}{_acq}{_ce}{_rec}{_run}{_mod}_{suffix}'.format(
-            sub     = subid,
-            _ses    = add_prefix('_', sesid),
-            _acq    = add_prefix('_acq-', run['bids']['acq']),
-            _ce     = add_prefix('_ce-',  run['bids']['ce']),
-            _rec    = add_prefix('_rec-', run['bids']['rec']),
-            _run    = add_prefix('_run-', runindex),
-            _mod    = add_prefix('_mod-', run['bids']['mod']),
-            suffix  = run['bids']['suffix'])
-
-    elif modality == 'func':
-
-        # bidsname: sub-<label>[_ses-<label>]_task-<label>[_acq-<label>][_ce-<label>][_dir-<label>][_rec-<label>][_run-<index>][_echo-<index>]_<contrast_label>.nii[.gz]
-        bidsname = '{sub}{_ses}_{task}{_acq}{_ce}{_dir}{_rec}{_run}{_echo}_{suffix}'.format(
-            sub     = subid,
-            _ses    = add_prefix('_', sesid),
-            task    = f"task-{run['bids']['task']}",
-            _acq    = add_prefix('_acq-',  run['bids']['acq']),
-            _ce     = add_prefix('_ce-',   run['bids']['ce']),
-            _dir    = add_prefix('_dir-',  run['bids']['dir']),
-            _rec    = add_prefix('_rec-',  run['bids']['rec']),
-            _run    = add_prefix('_run-',  runindex),
-            _echo   = add_prefix('_echo-', run['bids']['echo']),
-            suffix  = run['bids']['suffix'])
-
-    elif modality == 'dwi':
-
-        # bidsname: sub-<label>[_ses-<label>][_acq-<label>][_dir-<label>][_run-<index>]_dwi.nii[.gz]
-        bidsname = '{sub}{_ses}{_acq}{_dir}{_run}_{suffix}'.format(
-            sub     = subid,
-            _ses    = add_prefix('_', sesid),
-            _acq    = add_prefix('_acq-', run['bids']['acq']),
-            _dir    = add_prefix('_dir-', run['bids']['dir']),
-            _run    = add_prefix('_run-', runindex),
-            suffix  = run['bids']['suffix'])
-
-    elif modality == 'fmap':
-
-        # TODO: add more fieldmap logic?
-
-        # bidsname: sub-<label>[_ses-<label>][_acq-<label>][_ce-<label>]_dir-<label>[_run-<index>]_epi.nii[.gz]
-        bidsname = '{sub}{_ses}{_acq}{_ce}{_dir}{_run}_{suffix}'.format(
-            sub     = subid,
-            _ses    = add_prefix('_', sesid),
-            _acq    = add_prefix('_acq-', run['bids']['acq']),
-            _ce     = add_prefix('_ce-',  run['bids']['ce']),
-            _dir    = add_prefix('_dir-', run['bids']['dir']),
-            _run    = add_prefix('_run-', runindex),
-            suffix  = run['bids']['suffix'])
-
-    elif modality == 'beh':
-
-        # bidsname: sub-<participant_label>[_ses-<session_label>]_task-<task_name>_suffix
-        bidsname = '{sub}{_ses}_{task}_{suffix}'.format(
-            sub     = subid,
-            _ses    = add_prefix('_', sesid),
-            task    = f"task-{run['bids']['task']}",
-            suffix  = run['bids']['suffix'])
-
-    elif modality == 'pet':
-
-        # bidsname: sub-<participant_label>[_ses-<session_label>]_task-<task_label>[_acq-<label>][_rec-<label>][_run-<index>]_suffix
-        bidsname = '{sub}{_ses}_{task}{_acq}{_rec}{_run}_{suffix}'.format(
-            sub     = subid,
-            _ses    = add_prefix('_', sesid),
-            task    = f"task-{run['bids']['task']}",
-            _acq    = add_prefix('_acq-', run['bids']['acq']),
-            _rec    = add_prefix('_rec-', run['bids']['rec']),
-            _run    = add_prefix('_run-', runindex),
-            suffix  = run['bids']['suffix'])
-
-    elif modality == unknownmodality or modality == ignoremodality:
-
-        # bidsname: sub-<participant_label>[_ses-<session_label>]_acq-<label>[..][_suffix]
-        bidsname = '{sub}{_ses}{_task}_{acq}{_ce}{_rec}{_dir}{_run}{_echo}{_mod}{_suffix}'.format(
-            sub     = subid,
-            _ses    = add_prefix('_', sesid),
-            _task   = add_prefix('_task-', run['bids']['task']),
-            acq     = f"acq-{run['bids']['acq']}",
-            _ce     = add_prefix('_ce-',   run['bids']['ce']),
-            _rec    = add_prefix('_rec-',  run['bids']['rec']),
-            _dir    = add_prefix('_dir-',  run['bids']['dir']),
-            _run    = add_prefix('_run-',  runindex),
-            _echo   = add_prefix('_echo-', run['bids']['echo']),
-            _mod    = add_prefix('_mod-',  run['bids']['mod']),
-            _suffix = add_prefix('_',      run['bids']['suffix']))
+    if runindex:
+        labels['run'] = runindex
 
-    else:
+    # Compose the BIDS filename from the template
+    if modality not in bidsnametemplates:
         raise ValueError(f'Critical error: modality "{modality}" not implemented, please inform the developers about this error')
+    bidsname = subid + add_prefix('_', sesid)
+    for bidslabel, prefix, required in bidsnametemplates[modality]:
+        bidsname += f"{prefix}{labels[bidslabel]}" if required else add_prefix(prefix, labels[bidslabel])
 
     return bidsname
 
 
-def get_dynamic_value(bidsvalue: str, sourcefile: Path) -> str:
+def is_dynamic_value(bidsvalue) -> bool:
+    """
+    Checks whether a bidsvalue is a dynamic value, i.e. whether it starts with '<' and ends with '>', but not with '<<' and '>>'
+
+    :param bidsvalue:   The value from the BIDS key-value pair
+    :return:            True if the bidsvalue is a dynamic value
+    """
+
+    return isinstance(bidsvalue, str) and bidsvalue.startswith('<') and bidsvalue.endswith('>') and not (bidsvalue.startswith('<<') and bidsvalue.endswith('>>'))
+
+
+def get_dynamic_value(bidsvalue: str, sourcefile: Path, sourcefields: dict=None) -> str:
     """
     Replaces (dynamic) bidsvalues with (DICOM) run attributes when they start with '<' and end with '>',
     but not with '<<' and '>>'
 
-    :param bidsvalue:   The value from the BIDS key-value pair
-    :param sourcefile:  The source (e.g. DICOM or PAR/XML) file from which the attribute is read
-    :return:            Updated bidsvalue (if possible, otherwise the original bidsvalue is returned)
+    :param bidsvalue:       The value from the BIDS key-value pair
+    :param sourcefile:      The source (e.g. DICOM or PAR/XML) file from which the attribute is read
+    :param sourcefields:    Optional attributes that have already been read from the sourcefile (e.g. with get_sourcefields)
+    :return:                Updated bidsvalue (if possible, otherwise the original bidsvalue is returned)
     """
 
     # Intelligent filling of the value is done runtime by bidscoiner
@@ -1359,7 +3201,10 @@ def get_dynamic_value(bidsvalue: str, sourcefile: Path) -> str:
 
     # Fill any bids-label with the <annotated> dicom attribute
     if bidsvalue.startswith('<') and bidsvalue.endswith('>') and sourcefile.name:
-        sourcevalue = get_sourcefield(bidsvalue[1:-1], sourcefile)
+        if sourcefields and bidsvalue[1:-1] in sourcefields:
+            sourcevalue = sourcefields[bidsvalue[1:-1]]
+        else:
+            sourcevalue = get_sourcefield(bidsvalue[1:-1], sourcefile)
         if not sourcevalue:
             return bidsvalue
         else:
@@ -1368,11 +3213,120 @@ def get_dynamic_value(bidsvalue: str, sourcefile: Path) -> str:
     return bidsvalue
 
 
+class BidsName:
+    """
+    A parsed BIDS name (e.g. 'sub-01_ses-01_task-rest_echo-1_bold.nii.gz') with its entities in their original order,
+    its suffix, extension and (optional) parent folder. The entity values can be get and set in O(1) (e.g. bidsname['echo']
+    or bidsname['echo'] = '2') and the name is only rendered to a string or Path when it is needed, such that names do not
+    need to be parsed again and again when they are repeatedly modified
+    """
+
+    def __init__(self, bidsfile: Union[str, Path, 'BidsName']):
+        """
+        :param bidsfile:    The bidsname (e.g. as returned from get_bidsname) or fullpath, with or without extension
+        """
+
+        if isinstance(bidsfile, BidsName):
+            self.folder    = bidsfile.folder
+            self.entities  = OrderedDict(bidsfile.entities)
+            self.suffix    = bidsfile.suffix
+            self.extension = bidsfile.extension
+            return
+
+        folder, name           = os.path.split(str(bidsfile))
+        name, dot, extension   = name.partition('.')
+        labels                 = name.split('_')
+        self.folder            = folder
+        self.extension         = dot + extension
+        self.suffix            = labels.pop() if '-' not in labels[-1] else ''
+        self.entities          = OrderedDict()             # Labels without a '-' (i.e. that are not key-value pairs) are kept as keys with value None
+        for label in labels:
+            key, dash, value   = label.partition('-')
+            self.entities[key] = value if dash else None
+
+    def __getitem__(self, key: str) -> str:
+        """Returns the value of the entity (or of the suffix), or '' if the entity is not in the name"""
+
+        if key == 'suffix':
+            return self.suffix
+
+        return self.entities.get(key) or ''
+
+    def __setitem__(self, key: str, value: str) -> None:
+        """Sets the value of the entity (or of the suffix). New entities are appended to the existing entities"""
+
+        if key == 'suffix':
+            self.suffix = value
+        else:
+            self.entities[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        self.entities.pop(key, None)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entities
+
+    def __str__(self) -> str:
+        return str(self.path)
+
+    def __repr__(self) -> str:
+        return f"BidsName('{self}')"
+
+    def __fspath__(self) -> str:
+        return str(self)
+
+    def __eq__(self, other) -> bool:
+        return str(self) == str(other)
+
+    def __hash__(self):
+        return hash(str(self))
+
+    @property
+    def name(self) -> str:
+        """The rendered bidsname, i.e. without the parent folder and without the extension"""
+
+        labels = [key if value is None else f"{key}-{value}" for key, value in self.entities.items()]
+        if self.suffix:
+            labels.append(self.suffix)
+
+        return '_'.join(labels)
+
+    @property
+    def filename(self) -> str:
+        """The rendered bidsname with the extension"""
+
+        return self.name + self.extension
+
+    @property
+    def path(self) -> Path:
+        """The rendered bidsname with the parent folder and the extension"""
+
+        return Path(self.folder, self.filename)
+
+    def copy(self) -> 'BidsName':
+        return BidsName(self)
+
+    def with_extension(self, extension: str) -> Path:
+        """Returns the path of the bidsname with a different extension, e.g. of the json sidecar file"""
+
+        return Path(self.folder, self.name + extension)
+
+    def extend_acq(self, value: str) -> None:
+        """Appends the value to the acquisition label. If there is no acquisition label, then it is inserted right after the sub/ses entities"""
+
+        if 'acq' not in self.entities:
+            entities = list(self.entities.items())
+            position = len([key for key, _ in entities[0:2] if key in ('sub', 'ses')])
+            entities.insert(position, ('acq', ''))
+            self.entities = OrderedDict(entities)
+        self.entities['acq'] = (self.entities['acq'] or '') + value
+
+
 def get_bidsvalue(bidsfile: Union[str, Path], bidskey: str, newvalue: str= '') -> Union[Path, str]:
     """
     Sets the bidslabel, i.e. '*_bidskey-*_' is replaced with '*_bidskey-bidsvalue_'. If the key is not in the bidsname
     then the newvalue is appended to the acquisition label. If newvalue is empty (= default), then the parsed existing
-    bidsvalue is returned and nothing is set
+    bidsvalue is returned and nothing is set. NB: Use BidsName when the bidsname is accessed or modified more than once
 
     :param bidsfile:    The bidsname (e.g. as returned from get_bidsname or fullpath)
     :param bidskey:     The name of the bidskey, e.g. 'echo' or 'suffix'
@@ -1380,56 +3334,183 @@ def get_bidsvalue(bidsfile: Union[str, Path], bidskey: str, newvalue: str= '') -
     :return:            The bidsname with the new bidsvalue or, if newvalue is empty, the existing bidsvalue
     """
 
-    bidspath = Path(bidsfile).parent
-    bidsname = Path(bidsfile).with_suffix('').stem
-    bidsext  = ''.join(Path(bidsfile).suffixes)
+    bidsname = BidsName(bidsfile)
 
-    # Get the existing bidsvalue
-    oldvalue = ''
-    acqvalue = ''
-    if bidskey=='suffix':
-        oldvalue = bidsname.split('_')[-1]
-    else:
-        for label in bidsname.split('_'):
-            if '-' in label:
-                key, value = label.split('-', 1)
-                if key==bidskey:
-                    oldvalue = value
-                if key=='acq':
-                    acqvalue = value
+    # Just return the parsed old bidsvalue
+    if not newvalue:
+        return bidsname[bidskey]
 
     # Replace the existing bidsvalue with the new value or append the newvalue to the acquisition value
-    if newvalue:
-        if f'_{bidskey}-' not in bidsname + 'suffix':
-            if '_acq-' not in bidsname:         # Insert the 'acq' key right after the sub/ses key-value pairs
-                keyval = bidsname.split('_')
-                if get_bidsvalue(bidsname, 'ses'):
-                    keyval.insert(2, 'acq-')
-                else:
-                    keyval.insert(1, 'acq-')
-                bidsname = '_'.join(keyval)
-            bidskey  = 'acq'
-            oldvalue = acqvalue
-            newvalue = acqvalue + newvalue
-
-        # Return the updated bidsfile
-        if bidskey=='suffix':
-            newbidsfile = (bidspath/(bidsname.replace(f'_{oldvalue}', f'_{newvalue}'))).with_suffix(bidsext)
-        else:
-            newbidsfile = (bidspath/(bidsname.replace(f'{bidskey}-{oldvalue}', f'{bidskey}-{newvalue}'))).with_suffix(bidsext)
-        if isinstance(bidsfile, str):
-            newbidsfile = str(newbidsfile)
-        return newbidsfile
-
-    # Or just return the parsed old bidsvalue
+    if bidskey == 'suffix' or bidskey in bidsname:
+        bidsname[bidskey] = newvalue
     else:
-        return oldvalue
+        bidsname.extend_acq(newvalue)
+
+    # Return the updated bidsfile
+    if isinstance(bidsfile, str):
+        return str(bidsname)
+    return bidsname.path
+
+
+class RunIndexAllocator:
+    """
+    Hands out the free run indices of the BIDS names in an output folder. The folder is listed only once and the indices
+    that are handed out are reserved with reservation files that are created atomically, such that concurrent
+    writers (e.g. the workers of a parallel bidscoiner) never get the same run index. The reservation files are kept in
+    bidsfolder/code/bidscoin/reservations (i.e. outside the BIDS data folders) and should be released when the output
+    files are written to disk, or when no output files were written at all. The folder is listed again only when it was
+    modified after it was listed (e.g. by other writers)
+    """
+
+    def __init__(self, folder: Path, reservations: Path=None):
+        """
+        :param folder:          The full pathname of the output folder
+        :param reservations:    The folder with the reservation files. Default: the reservations folder in the code/bidscoin
+                                folder of the bidsfolder that contains the output folder, or else the output folder itself
+        """
+
+        self.folder   = Path(folder)
+        self.stems    = {}              # The listing of the folder: bidsname -> filenames
+        self.mtime    = None            # The modification time of the folder when it was listed
+        self.reserved = {}              # The reservations of this allocator: (bidsname, ext) -> reservation file
+        self.lock     = threading.RLock()
+        self.prefix   = '.'             # The prefix of the reservation files, i.e. hidden files in the output folder or the relative output folder in the reservations folder
+        if reservations is None:
+            reservations = self.folder
+            for bidsfolder in self.folder.parents:
+                if (bidsfolder/'code'/'bidscoin').is_dir():
+                    reservations = bidsfolder/'code'/'bidscoin'/'reservations'
+                    self.prefix  = '+'.join(self.folder.relative_to(bidsfolder).parts) + '+'
+                    break
+        self.reservations = Path(reservations)
+        if self.reservations != self.folder:
+            try:
+                self.reservations.mkdir(parents=True, exist_ok=True)
+            except OSError as mkdirerror:
+                logger.debug(f"Could not create {self.reservations}: {mkdirerror}")
+        self._list()
+
+    def __len__(self):
+        return len(self.reserved)
+
+    def _list(self) -> None:
+        """Lists the folder if it was modified after it was last listed"""
+
+        try:
+            mtime = self.folder.stat().st_mtime
+        except OSError:
+            return
+        if mtime == self.mtime:
+            return
+
+        self.stems = {}
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                self.stems.setdefault(entry.name.split('.', 1)[0], []).append(entry.name)
+        self.mtime = mtime if time.time() - mtime > 2 else None    # A recent modification may not (yet) show in the (coarse) modification time
+
+    def _reservation(self, bidsname: str, ext: str) -> Path:
+        return self.reservations/f"{self.prefix}{bidsname}{ext}.reserved".replace('*', '%')
+
+    def _reserve(self, bidsname: str, ext: str) -> bool:
+        """Atomically creates a reservation file for the bidsname. Stale reservations of processes that are no longer running are taken over"""
+
+        reservation = self._reservation(bidsname, ext)
+        for attempt in range(2):
+            try:
+                fid = os.open(reservation, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if attempt == 0 and self._stale(reservation):
+                    reservation.unlink()
+                    continue
+                return False
+            except OSError as reservationerror:         # E.g. a read-only folder -> nothing to reserve
+                logger.debug(f"Could not reserve {reservation}: {reservationerror}")
+                return True
+            with os.fdopen(fid, 'w') as reservation_fid:
+                reservation_fid.write(f"{socket.gethostname()} {os.getpid()}")
+            self.reserved[(bidsname, ext)] = reservation
+            return True
+
+        return False
+
+    @staticmethod
+    def _stale(reservation: Path) -> bool:
+        """Checks if the (POSIX) process on this host that made the reservation is no longer running, or else if the reservation is older than RESERVATION_AGE"""
+
+        try:
+            host, pid = reservation.read_text().split()
+            if os.name != 'posix' or host != socket.gethostname():
+                return time.time() - reservation.stat().st_mtime > RESERVATION_AGE
+            if int(pid) == os.getpid():
+                return False
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except (OSError, ValueError):
+            pass
+
+        return False
+
+    def _taken(self, bidsname: str, ext: str) -> bool:
+        """Checks if the bidsname is already taken, i.e. reserved by this allocator or present in the folder listing"""
+
+        return (bidsname, ext) in self.reserved or self._listed(bidsname, ext)
+
+    def _listed(self, bidsname: str, ext: str) -> bool:
+        """Checks if the bidsname is present in the folder listing"""
+
+        return any(fnmatch.fnmatchcase(filename, bidsname + ext) for filename in self.stems.get(bidsname, []))
+
+    def allocate(self, bidsname: str, ext: str='.*') -> str:
+        """
+        Gets the bidsname with the first free runindex, starting from the provisional runindex
+
+        :param bidsname:    The bidsname with a provisional runindex
+        :param ext:         The file extension for which the runindex is allocated (default = '.*')
+        :return:            The bidsname with the allocated runindex
+        """
+
+        bidsname_ = BidsName(bidsname)
+        if not bidsname_['run']:
+            return bidsname
+
+        with self.lock:
+            while True:
+                candidate = str(bidsname_)
+                if not self._taken(candidate, ext) and self._reserve(candidate, ext):
+                    self._list()                                        # The files may have been written (and released) after the folder was listed
+                    if not self._listed(candidate, ext):
+                        return candidate
+                    self.reserved.pop((candidate, ext)).unlink()
+                bidsname_['run'] = str(int(bidsname_['run']) + 1)
+
+    def release(self, bidsname: str=None, ext: str='.*') -> None:
+        """
+        Removes the reservation files
+
+        :param bidsname:    The bidsname of the reservation that is released (e.g. when no output file was written). Default: all reservations
+        :param ext:         The file extension for which the runindex was allocated (default = '.*')
+        :return:
+        """
 
+        with self.lock:
+            keys = list(self.reserved) if bidsname is None else [(bidsname, ext)] if (bidsname, ext) in self.reserved else []
+            for key in keys:
+                try:
+                    self.reserved.pop(key).unlink()
+                except FileNotFoundError:
+                    pass
 
-def increment_runindex(bidsfolder: Path, bidsname: str, ext: str='.*') -> Union[Path, str]:
+
+_runindexallocators = {}                        # The allocators per (thread, bidsfolder), i.e. each thread only releases its own reservations
+_runindexlock       = threading.Lock()
+
+
+def increment_runindex(bidsfolder: Path, bidsname: Union[str, Path], ext: str='.*') -> Union[Path, str]:
     """
     Checks if a file with the same the bidsname already exists in the folder and then increments the runindex (if any)
-    until no such file is found
+    until no such file is found. The runindex is reserved until release_runindices() is called (in the same thread)
 
     :param bidsfolder:  The full pathname of the bidsfolder
     :param bidsname:    The bidsname with a provisional runindex
@@ -1437,10 +3518,50 @@ def increment_runindex(bidsfolder: Path, bidsname: str, ext: str='.*') -> Union[
     :return:            The bidsname with the incremented runindex
     """
 
-    while list(bidsfolder.glob(bidsname + ext)):
+    key = (threading.get_ident(), str(bidsfolder))
+    with _runindexlock:
+        allocator = _runindexallocators.get(key)
+        if allocator is None:
+            allocator = _runindexallocators[key] = RunIndexAllocator(bidsfolder)
 
-        runindex = get_bidsvalue(bidsname, 'run')
-        if runindex:
-            bidsname = get_bidsvalue(bidsname, 'run', str(int(runindex) + 1))
+    if isinstance(bidsname, str):
+        return allocator.allocate(bidsname, ext)
+    return Path(allocator.allocate(str(bidsname), ext))
 
-    return bidsname
+
+def release_runindex(bidsfolder: Path, bidsname: Union[str, Path], ext: str='.*') -> None:
+    """
+    Releases a runindex that has been reserved by increment_runindex (in the same thread), i.e. when no output file has
+    been written to disk, such that the runindex can be handed out again and the run numbering stays gap-free
+
+    :param bidsfolder:  The full pathname of the bidsfolder
+    :param bidsname:    The bidsname with the reserved runindex
+    :param ext:         The file extension for which the runindex was incremented (default = '.*')
+    :return:
+    """
+
+    with _runindexlock:
+        allocator = _runindexallocators.get((threading.get_ident(), str(bidsfolder)))
+
+    if allocator is not None:
+        allocator.release(str(bidsname), ext)
+
+
+def release_runindices() -> None:
+    """Releases the runindices that have been reserved by increment_runindex in this thread, i.e. when the output files have been written to disk"""
+
+    with _runindexlock:
+        for key in [key for key in _runindexallocators if key[0] == threading.get_ident()]:
+            _runindexallocators.pop(key).release()
+
+
+def _release_allrunindices() -> None:
+    """Releases the runindices of all threads, i.e. when the process exits"""
+
+    with _runindexlock:
+        for allocator in _runindexallocators.values():
+            allocator.release()
+        _runindexallocators.clear()
+
+
+atexit.register(_release_allrunindices)         # Do not leave reservation files behind in the bids folder
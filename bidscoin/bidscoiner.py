@@ -13,12 +13,11 @@ bidsfolder/code/bidscoin/bidscoiner.log file.
 """
 
 import re
-import pandas as pd
 import json
-import dateutil.parser
 import logging
 import shutil
 from pathlib import Path
+from typing import Iterable
 try:
     from bidscoin import bids
 except ImportError:
@@ -27,7 +26,7 @@ except ImportError:
 LOGGER = logging.getLogger('bidscoin')
 
 
-def coin_data2bids(dataformat: str, session: Path, bidsmap: dict, bidsfolder: Path, personals: dict, subprefix: str, sesprefix: str) -> None:
+def coin_data2bids(dataformat: str, session: Path, bidsmap: dict, bidsfolder: Path, personals: dict, subprefix: str, sesprefix: str, dicomtags: Iterable[str]=()) -> None:
     """
     Converts the session source-files into BIDS-valid nifti-files in the corresponding bidsfolder and
     extracts personals (e.g. Age, Sex) from the source header
@@ -39,9 +38,13 @@ def coin_data2bids(dataformat: str, session: Path, bidsmap: dict, bidsfolder: Pa
     :param personals:   The dictionary with the personal information
     :param subprefix:   The prefix common for all source subject-folders
     :param sesprefix:   The prefix common for all source session-folders
+    :param dicomtags:   The DICOM keywords that are needed from the source headers. If given, only these are read from the headers
     :return:            Nothing
     """
 
+    import pandas as pd
+    import dateutil.parser
+
     # Get valid BIDS subject/session identifiers from the (first) DICOM- or PAR/XML source file
     if dataformat=='DICOM':
         sourcefile = Path()
@@ -96,8 +99,9 @@ def coin_data2bids(dataformat: str, session: Path, bidsmap: dict, bidsfolder: Pa
         if not sourcefile.name:
             continue
 
-        # Get a matching run from the bidsmap
-        run, modality, index = bids.get_matching_run(sourcefile, bidsmap, dataformat)
+        # Get a matching run from the bidsmap (reading only the DICOM keywords that are needed)
+        sourcefields         = bids.get_dicomfields(dicomtags, sourcefile, restrict=True) if dataformat=='DICOM' and dicomtags else None
+        run, modality, index = bids.get_matching_run(sourcefile, bidsmap, dataformat, sourcefields=sourcefields)
 
         # Check if we should ignore this run
         if modality == bids.ignoremodality:
@@ -133,6 +137,7 @@ def coin_data2bids(dataformat: str, session: Path, bidsmap: dict, bidsfolder: Pa
             outfolder = bidsmodality,
             source    = source)
         if not bids.run_command(command):
+            bids.release_runindex(bidsmodality, bidsname)
             continue
 
         # Replace uncropped output image with the cropped one
@@ -150,22 +155,24 @@ def coin_data2bids(dataformat: str, session: Path, bidsmap: dict, bidsfolder: Pa
             for filename in sorted(bidsmodality.glob(f"{bidsname}*{dcm2niisuffix}*")):
                 ext             = ''.join(filename.suffixes)
                 basepath, index = str(filename).rsplit(ext)[0].rsplit(dcm2niisuffix,1)                          # basepath = the name without the added stuff (i.e. bidsmodality/bidsname), index = added dcm2niix index (e.g. _c1 -> index=1)
-                basesuffix      = basepath.rsplit('_',1)[1]                                                     # The BIDS suffix, e.g. basepath = *_magnitude1 -> basesuffix=magnitude1
+                basename        = bids.BidsName(basepath)
+                basesuffix      = basename['suffix']                                                            # The BIDS suffix, e.g. basepath = *_magnitude1 -> basesuffix=magnitude1
                 index           = index.split('_')[0].zfill(2)                                                  # Zero padd as specified in the BIDS-standard (assuming two digits is sufficient); strip following suffices (fieldmaps produce *_e2_ph files)
 
                 # Phase data may be stored in the magnitude data source (e.g. Philips fieldmaps)
                 if 'ph' in filename.name.rsplit(ext)[0].split('_'):
-                    basepath = basepath.replace('_magnitude', '_phase')
+                    basename['suffix'] = basesuffix.replace('magnitude', 'phase')
 
                 # This is a special hack: dcm2niix does not always add a _c/_e suffix for the first(?) coil/echo image -> add it when we encounter a **_e2/_c2 file
                 # https://github.com/rordenlab/dcm2niix/issues/381
                 if dcm2niisuffix in ('_c','_e') and int(index)==2 and basesuffix not in ['magnitude1', 'phase1']:    # For fieldmaps: *_magnitude1_e[index] -> *_magnitude[index] (This is handled below)
-                    filename_ce = Path(basepath + ext)                                                          # The file without the _c1/_e1 suffix
-                    if dcm2niisuffix=='_e' and bids.get_bidsvalue(basepath, 'echo'):
-                        newbasepath_ce = Path(bids.get_bidsvalue(basepath, 'echo', '1'))
+                    filename_ce    = basename.with_extension(ext)                                               # The file without the _c1/_e1 suffix
+                    newbasename_ce = basename.copy()
+                    if dcm2niisuffix=='_e' and basename['echo']:
+                        newbasename_ce['echo'] = '1'
                     else:
-                        newbasepath_ce = Path(bids.get_bidsvalue(basepath, 'dummy', dcm2niisuffix.upper()[1:] + '1'.zfill(len(index))))  # --> append to acq-label, may need to be elaborated for future BIDS standards, supporting multi-coil data
-                    newfilename_ce = newbasepath_ce.with_suffix(ext)                                            # The file as it should have been
+                        newbasename_ce.extend_acq(dcm2niisuffix.upper()[1:] + '1'.zfill(len(index)))          # --> append to acq-label, may need to be elaborated for future BIDS standards, supporting multi-coil data
+                    newfilename_ce = newbasename_ce.with_extension(ext)                                         # The file as it should have been
                     if filename_ce.is_file():
                         if filename_ce != newfilename_ce:
                             LOGGER.warning(f"Found no dcm2niix {dcm2niisuffix} suffix for image instance 1, renaming\n{filename_ce} ->\n{newfilename_ce}\nConsider upgrading dcm2niix: https://github.com/rordenlab/dcm2niix/issues/381")
@@ -173,23 +180,23 @@ def coin_data2bids(dataformat: str, session: Path, bidsmap: dict, bidsfolder: Pa
                                 LOGGER.warning(f"Overwriting existing {newfilename_ce} file -- check your results carefully!")
                             filename_ce.replace(newfilename_ce)
                         if ext == '.json':
-                            jsonfiles.append(newbasepath_ce.with_suffix('.json'))
+                            jsonfiles.append(newbasename_ce.with_extension('.json'))
 
-                # Patch the basepath with the dcm2niix suffix info (we can't rely on the basepath info here because Siemens can e.g. put multiple echos in one series / run-folder)
-                if dcm2niisuffix=='_e' and bids.get_bidsvalue(basepath, 'echo') and index:
-                    basepath = bids.get_bidsvalue(basepath, 'echo', str(int(index)))                            # In contrast to other labels, run and echo labels MUST be integers. Those labels MAY include zero padding, but this is NOT RECOMMENDED to maintain their uniqueness
+                # Patch the basename with the dcm2niix suffix info (we can't rely on the basename info here because Siemens can e.g. put multiple echos in one series / run-folder)
+                if dcm2niisuffix=='_e' and basename['echo'] and index:
+                    basename['echo'] = str(int(index))                                                          # In contrast to other labels, run and echo labels MUST be integers. Those labels MAY include zero padding, but this is NOT RECOMMENDED to maintain their uniqueness
 
                 elif dcm2niisuffix=='_e' and basesuffix in ('magnitude1','magnitude2','phase1','phase2') and index:  # i.e. modality == 'fmap'
-                    basepath = basepath[0:-1] + str(int(index))                                                 # basepath: *_magnitude1_e[index] -> *_magnitude[index] and *_phase1_e[index]_ph -> *_phase[index]
+                    basename['suffix'] = basename['suffix'][0:-1] + str(int(index))                             # basename: *_magnitude1_e[index] -> *_magnitude[index] and *_phase1_e[index]_ph -> *_phase[index]
 
                 elif dcm2niisuffix=='_e' and basesuffix=='phasediff' and index:                                 # i.e. modality == 'fmap'
                     pass
 
                 else:
-                    basepath = bids.get_bidsvalue(basepath, 'dummy', dcm2niisuffix.upper()[1:] + index)         # --> append to acq-label, may need to be elaborated for future BIDS standards, supporting multi-coil data
+                    basename.extend_acq(dcm2niisuffix.upper()[1:] + index)                                      # --> append to acq-label, may need to be elaborated for future BIDS standards, supporting multi-coil data
 
                 # Save the file with a new name
-                newbidsname = str(Path(basepath).name)
+                newbidsname = basename.name
                 if runindex.startswith('<<') and runindex.endswith('>>'):
                     newbidsname = bids.increment_runindex(bidsmodality, newbidsname, ext)                       # Update the runindex now that the acq-label has changed
                 newfilename = (bidsmodality/newbidsname).with_suffix(ext)
@@ -200,6 +207,10 @@ def coin_data2bids(dataformat: str, session: Path, bidsmap: dict, bidsfolder: Pa
                 if ext == '.json':
                     jsonfiles.append((bidsmodality/newbidsname).with_suffix('.json'))
 
+        # Release the runindex of the bidsname if no output files were written with it (e.g. when all files were renamed above), to keep the run numbering gap-free
+        if not list(bidsmodality.glob(bidsname + '.*')):
+            bids.release_runindex(bidsmodality, bidsname)
+
         # Loop over and adapt all the newly produced json files and write to the scans.tsv file (every nifti-file comes with a json-file)
         if not jsonfiles:
             jsonfiles = [(bidsmodality/bidsname).with_suffix('.json')]
@@ -249,6 +260,9 @@ def coin_data2bids(dataformat: str, session: Path, bidsmap: dict, bidsfolder: Pa
                 scanpath = list(jsonfile.parent.glob(jsonfile.stem + '.nii*'))[0].relative_to(bidsses)  # Find the corresponding nifti file (there should be only one, let's not make assumptions about the .gz extension)
                 scans_table.loc[scanpath.as_posix(), 'acq_time'] = '1925-01-01T' + acq_time.strftime('%H:%M:%S')
 
+    # Release the reserved runindices, now that all the output files are on disk
+    bids.release_runindices()
+
     # Write the scans_table to disk
     LOGGER.info(f"Writing acquisition time data to: {scans_tsv}")
     scans_table.sort_values(by=['acq_time','filename'], inplace=True)
@@ -275,7 +289,7 @@ def coin_data2bids(dataformat: str, session: Path, bidsmap: dict, bidsfolder: Pa
 
             # Get the set of json-files (account for multiple runs in one data source and dcm2niix suffixes inserted into the acquisition label)
             jsonfiles = []
-            acqlabel  = bids.get_bidsvalue(bidsname, 'acq')
+            acqlabel  = bids.BidsName(bidsname)['acq']
             patterns  = (bidsname.replace('_run-1_',     '_run-[0-9]*_').
                                   replace('_magnitude1', '_magnitude*').
                                   replace('_magnitude2', '_magnitude*').
@@ -287,8 +301,9 @@ def coin_data2bids(dataformat: str, session: Path, bidsmap: dict, bidsfolder: Pa
             for pattern in patterns:
                 jsonfiles.extend((bidsses/'fmap').glob(pattern  + '.json'))
                 if acqlabel:
-                    cepattern = bids.get_bidsvalue(pattern, 'acq', acqlabel + '[CE][0-9]*')
-                    jsonfiles.extend(list((bidsses/'fmap').glob(cepattern + '.json')))
+                    cepattern        = bids.BidsName(pattern)
+                    cepattern['acq'] = acqlabel + '[CE][0-9]*'
+                    jsonfiles.extend(list((bidsses/'fmap').glob(cepattern.name + '.json')))
 
             # Save the meta-data in the jsonfiles
             for jsonfile in set(jsonfiles):
@@ -340,7 +355,8 @@ def coin_data2bids(dataformat: str, session: Path, bidsmap: dict, bidsfolder: Pa
                 personals['session_id'] = sesid
             else:
                 return                                              # Only from the first session -> BIDS specification
-        age = bids.get_dicomfield('PatientAge', sourcefile)         # A string of characters with one of the following formats: nnnD, nnnW, nnnM, nnnY
+        fields = bids.get_dicomfields(('PatientAge', 'PatientSex', 'PatientSize', 'PatientWeight'), sourcefile)
+        age    = fields['PatientAge']                               # A string of characters with one of the following formats: nnnD, nnnW, nnnM, nnnY
         if age.endswith('D'):
             personals['age'] = str(int(float(age.rstrip('D'))/365.2524))
         elif age.endswith('W'):
@@ -351,9 +367,9 @@ def coin_data2bids(dataformat: str, session: Path, bidsmap: dict, bidsfolder: Pa
             personals['age'] = str(int(float(age.rstrip('Y'))))
         elif age:
             personals['age'] = age
-        personals['sex']     = bids.get_dicomfield('PatientSex',    sourcefile)
-        personals['size']    = bids.get_dicomfield('PatientSize',   sourcefile)
-        personals['weight']  = bids.get_dicomfield('PatientWeight', sourcefile)
+        personals['sex']     = fields['PatientSex']
+        personals['size']    = fields['PatientSize']
+        personals['weight']  = fields['PatientWeight']
 
 
 def coin_nifti(session: Path, bidsmap: dict, bidsfolder: Path, personals: dict) -> None:
@@ -406,7 +422,7 @@ def coin_plugin(session: Path, bidsmap: dict, bidsfolder: Path, personals: dict)
             module.bidscoiner_plugin(session, bidsmap, bidsfolder, personals)
 
 
-def bidscoiner(rawfolder: str, bidsfolder: str, subjects: list=(), force: bool=False, participants: bool=False, bidsmapfile: str='bidsmap.yaml', subprefix: str='sub-', sesprefix: str='ses-') -> None:
+def bidscoiner(rawfolder: str, bidsfolder: str, subjects: list=(), force: bool=False, participants: bool=False, bidsmapfile: str='bidsmap.yaml', subprefix: str='sub-', sesprefix: str='ses-', workdir: str='') -> None:
     """
     Main function that processes all the subjects and session in the sourcefolder and uses the
     bidsmap.yaml file in bidsfolder/code/bidscoin to cast the data into the BIDS folder.
@@ -419,9 +435,12 @@ def bidscoiner(rawfolder: str, bidsfolder: str, subjects: list=(), force: bool=F
     :param bidsmapfile:     The name of the bidsmap YAML-file. If the bidsmap pathname is relative (i.e. no "/" in the name) then it is assumed to be located in bidsfolder/code/bidscoin
     :param subprefix:       The prefix common for all source subject-folders
     :param sesprefix:       The prefix common for all source session-folders
+    :param workdir:         The folder for the temporary (unpacked) source data, e.g. a local SSD or tmpfs. Default: the system's temporary folder
     :return:                Nothing
     """
 
+    import pandas as pd
+
     # Input checking & defaults
     rawfolder   = Path(rawfolder).resolve()
     bidsfolder  = Path(bidsfolder).resolve()
@@ -432,11 +451,15 @@ def bidscoiner(rawfolder: str, bidsfolder: str, subjects: list=(), force: bool=F
     LOGGER.info('')
     LOGGER.info(f"-------------- START BIDScoiner {bids.version()}: BIDS {bids.bidsversion()} ------------")
     LOGGER.info(f">>> bidscoiner sourcefolder={rawfolder} bidsfolder={bidsfolder} subjects={subjects} force={force}"
-                f" participants={participants} bidsmap={bidsmapfile} subprefix={subprefix} sesprefix={sesprefix}")
+                f" participants={participants} bidsmap={bidsmapfile} subprefix={subprefix} sesprefix={sesprefix} workdir={workdir}")
 
     # Create a code/bidscoin subfolder
     (bidsfolder/'code'/'bidscoin').mkdir(parents=True, exist_ok=True)
 
+    # Use the persistent header index if it has been built
+    if (bidsfolder/'code'/'bidscoin'/'headerindex.db').is_file():
+        bids.open_headerindex(bidsfolder/'code'/'bidscoin'/'headerindex.db')
+
     # Create a dataset description file if it does not exist
     dataset_file = bidsfolder/'dataset_description.json'
     if not dataset_file.is_file():
@@ -465,11 +488,14 @@ def bidscoiner(rawfolder: str, bidsfolder: str, subjects: list=(), force: bool=F
                       f"For more information see: https://github.com/Donders-Institute/bidscoin")
 
     # Get the bidsmap heuristics from the bidsmap YAML-file
-    bidsmap, _ = bids.load_bidsmap(bidsmapfile, bidsfolder/'code'/'bidscoin')
+    bidsmap, _ = bids.load_bidsmap(bidsmapfile, bidsfolder/'code'/'bidscoin', roundtrip=False)
     if not bidsmap:
         LOGGER.error(f"No bidsmap file found in {bidsfolder}. Please run the bidsmapper first and / or use the correct bidsfolder")
         return
 
+    # Read only the DICOM attributes that are needed from the source headers
+    dicomtags = bids.get_bidsmaptags(bidsmap, 'DICOM') | {'AcquisitionTime', 'PatientAge', 'PatientSex', 'PatientSize', 'PatientWeight'}
+
     # Save options to the .bidsignore file
     bidsignore_items = [item.strip() for item in bidsmap['Options']['bidscoin']['bidsignore'].split(';')]
     LOGGER.info(f"Writing {bidsignore_items} entries to {bidsfolder}.bidsignore")
@@ -517,7 +543,7 @@ def bidscoiner(rawfolder: str, bidsfolder: str, subjects: list=(), force: bool=F
 
             # Unpack the data in a temporary folder if it is tarballed/zipped and/or contains a DICOMDIR file
             bidssession       = bidsfolder/session.relative_to(rawfolder)  # Append the sub-*/ses-* subdirectories from the rawfolder to the bidsfolder
-            session, unpacked = bids.unpack(session, subprefix, sesprefix, '*')
+            session, unpacked = bids.unpack(session, subprefix, sesprefix, '*', scratchdir=workdir)
 
             # See what dataformat we have
             dataformat = bids.get_dataformat(session)
@@ -541,7 +567,10 @@ def bidscoiner(rawfolder: str, bidsfolder: str, subjects: list=(), force: bool=F
 
             # Update / append the sourde data mapping
             if dataformat in ('DICOM', 'PAR'):
-                coin_data2bids(dataformat, session, bidsmap, bidsfolder, personals, subprefix, sesprefix)
+                try:
+                    coin_data2bids(dataformat, session, bidsmap, bidsfolder, personals, subprefix, sesprefix, dicomtags)
+                finally:
+                    bids.release_runindices()       # Also when the conversion failed, such that no reservations are left behind
 
             # Update / append the P7 mapping
             if dataformat=='P7':
@@ -560,9 +589,9 @@ def bidscoiner(rawfolder: str, bidsfolder: str, subjects: list=(), force: bool=F
             if bidsmap['PlugIns']:
                 coin_plugin(session, bidsmap, bidsfolder, personals)
 
-            # Clean-up the temporary unpacked data
+            # Clean-up the temporary unpacked data (i.e. the whole workfolder that was created by unpack, not just the sub/ses folder in it)
             if unpacked:
-                shutil.rmtree(session)
+                shutil.rmtree(unpacked)
 
         # Store the collected personals in the participant_table
         for key in personals:
@@ -590,6 +619,10 @@ def bidscoiner(rawfolder: str, bidsfolder: str, subjects: list=(), force: bool=F
     with participants_json.open('w') as json_fid:
         json.dump(participants_dict, json_fid, indent=4)
 
+    LOGGER.debug(f"Header cache: {bids.headercache}")
+    LOGGER.debug(f"Directory cache: {bids.dircache}")
+    LOGGER.info(f"Run matching memo: {bids.matchmemo}")
+    bids.close_headerindex()
     LOGGER.info('-------------- FINISHED! ------------')
     LOGGER.info('')
 
@@ -615,6 +648,7 @@ def main():
     parser.add_argument('-b','--bidsmap',           help='The bidsmap YAML-file with the study heuristics. If the bidsmap filename is relative (i.e. no "/" in the name) then it is assumed to be located in bidsfolder/code/bidscoin. Default: bidsmap.yaml', default='bidsmap.yaml')
     parser.add_argument('-n','--subprefix',         help="The prefix common for all the source subject-folders. Default: 'sub-'", default='sub-')
     parser.add_argument('-m','--sesprefix',         help="The prefix common for all the source session-folders. Default: 'ses-'", default='ses-')
+    parser.add_argument('-w','--workdir',           help='The folder for the temporary (unpacked) source data, e.g. a local SSD or tmpfs. Default: the system\'s temporary folder')
     parser.add_argument('-v','--version',           help='Show the BIDS and BIDScoin version', action='version', version=f"BIDS-version:\t\t{bids.bidsversion()}\nBIDScoin-version:\t{bids.version()}")
     args = parser.parse_args()
 
@@ -625,7 +659,8 @@ def main():
                participants = args.skip_participants,
                bidsmapfile  = args.bidsmap,
                subprefix    = args.subprefix,
-               sesprefix    = args.sesprefix)
+               sesprefix    = args.sesprefix,
+               workdir      = args.workdir)
 
 
 if __name__ == "__main__":
@@ -13,8 +13,8 @@ import argparse
 import textwrap
 import logging
 import copy
+import threading
 import webbrowser
-import pydicom
 from pathlib import Path
 from functools import partial
 from PyQt5 import QtCore, QtGui, QtWidgets
@@ -168,11 +168,21 @@ class MainWindow(QMainWindow):
 
     def closeEvent(self, event):
         """Handle exit. """
+        if self.isWindowModified():
+            answer = QMessageBox.question(self, 'BIDS editor', 'The BIDS-map has not been saved, do you want to quit anyway?',
+                                          QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+            if answer == QMessageBox.No:
+                if event:
+                    event.ignore()
+                return
         QApplication.quit()     # TODO: Do not use class method but self.something
 
 
 class Ui_MainWindow(MainWindow):
 
+    bidsmap_copied = QtCore.pyqtSignal()
+    bidsmap_saved  = QtCore.pyqtSignal(str, int, bool)
+
     def setupUi(self, MainWindow, bidsfolder, bidsmap_filename, input_bidsmap, output_bidsmap, template_bidsmap,
                 dataformat, selected_tab_index=2, subprefix='sub-', sesprefix='ses-', reload: bool=False):
 
@@ -186,6 +196,12 @@ class Ui_MainWindow(MainWindow):
         self.dataformat       = dataformat
         self.subprefix        = subprefix
         self.sesprefix        = sesprefix
+        if not reload:
+            self.savethread   = None
+            self.edits        = 0           # The number of edits of the output bidsmap, i.e. to see if a save is up-to-date
+            self.bidsmap_copied.connect(self.release_bidsmap)
+            self.bidsmap_saved.connect(self.handle_bidsmap_saved)
+            self.MainWindow.setWindowTitle(f"{self.bidsmap_filename}[*] - BIDS editor")
 
         self.has_edit_dialog_open = None
 
@@ -311,7 +327,7 @@ class Ui_MainWindow(MainWindow):
             cell = self.samples_table.item(row, 5)
             sourcefile = Path(cell.text())
             if bids.is_dicomfile(sourcefile):
-                sourcedata = pydicom.dcmread(str(sourcefile), force=True)
+                sourcedata = bids.read_dicomfile(sourcefile)
             elif bids.is_parfile(sourcefile):
                 with open(sourcefile, 'r') as parfid:
                     sourcedata = parfid.read()
@@ -367,6 +383,7 @@ class Ui_MainWindow(MainWindow):
             if key and value!=oldvalue:
                 LOGGER.warning(f"Expert usage: User has set {self.dataformat}['{key}'] from '{oldvalue}' to '{value}'")
                 self.output_bidsmap[self.dataformat][key] = value
+                self.set_modified()
                 self.update_subses_and_samples(self.output_bidsmap)
 
     def tool_cell_was_changed(self, tool: str, idx: int, row: int, column: int):
@@ -381,6 +398,7 @@ class Ui_MainWindow(MainWindow):
             if key and value!=oldvalue:
                 LOGGER.info(f"User has set {self.dataformat}['Options']['{key}'] from '{oldvalue}' to '{value}'")
                 self.output_bidsmap['Options'][tool][key] = value
+                self.set_modified()
 
     def handle_click_test_plugin(self, plugin: str):
         """Test the bidsmap plugin and show the result in a pop-up window
@@ -411,6 +429,8 @@ class Ui_MainWindow(MainWindow):
         plugin = QFileDialog.getOpenFileNames(self.MainWindow, 'Select the plugin-file(s)', directory=str(self.bidsfolder/'code'/'bidscoin'), filter='Python files (*.py *.pyc *.pyo);; All files (*)')
         LOGGER.info(f'Added plugins: {plugin[0]}')
         self.output_bidsmap['PlugIns'] += plugin[0]
+        if plugin[0]:
+            self.set_modified()
         self.update_plugintable()
 
     def plugin_cell_was_changed(self, row: int, column: int):
@@ -428,7 +448,9 @@ class Ui_MainWindow(MainWindow):
                 del self.output_bidsmap['PlugIns'][row]
             else:
                 LOGGER.error(f"Unexpected cell change for {plugin}")
+                return
 
+            self.set_modified()
             self.update_plugintable()
 
     def update_plugintable(self):
@@ -733,6 +755,7 @@ class Ui_MainWindow(MainWindow):
         LOGGER.info('User reloads the bidsmap')
         current_tab_index = self.tabwidget.currentIndex()
         self.output_bidsmap, _ = bids.load_bidsmap(self.bidsmap_filename)
+        self.MainWindow.setWindowModified(False)
         self.setupUi(self.MainWindow,
                      self.bidsfolder,
                      self.bidsmap_filename,
@@ -762,8 +785,37 @@ class Ui_MainWindow(MainWindow):
                         str(self.bidsfolder/'code'/'bidscoin'/'bidsmap.yaml'),
                         'YAML Files (*.yaml *.yml);;All Files (*)')
         if filename:
-            bids.save_bidsmap(Path(filename), self.output_bidsmap)
-            QtCore.QCoreApplication.setApplicationName(f"{filename} - BIDS editor")
+            if self.savethread and self.savethread.is_alive():
+                self.savethread.join()                                      # Save the bidsmaps in the right order
+            self.MainWindow.centralWidget().setEnabled(False)               # The bidsmap must not be edited until it has been copied, see release_bidsmap()
+            self.savethread = threading.Thread(target=self.save_bidsmap, args=(Path(filename), self.edits), name='save_bidsmap')
+            self.savethread.start()                                         # Save the bidsmap in the background (NB: the thread is not a daemon, i.e. it will always finish)
+
+    def save_bidsmap(self, filename: Path, edits: int):
+        """Copies and saves the output bidsmap in the background. The main window is notified with the bidsmap_copied and bidsmap_saved signals"""
+        try:
+            bidsmap = copy.deepcopy(self.output_bidsmap)
+        finally:
+            self.bidsmap_copied.emit()
+        self.bidsmap_saved.emit(str(filename), edits, bids.save_bidsmap(filename, bidsmap))
+
+    def release_bidsmap(self):
+        """Allows the output bidsmap to be edited again, now that it has been copied for saving"""
+        self.MainWindow.centralWidget().setEnabled(True)
+
+    def handle_bidsmap_saved(self, filename: str, edits: int, saved: bool):
+        """Reports the result of the background save. The modified flag is only cleared if nothing was edited after the bidsmap was copied"""
+        if not saved:
+            QMessageBox.warning(self.MainWindow, 'Save BIDS-map', f"Could not save the BIDS-map to:\n{filename}\n\nSee the terminal output or the log file for more info")
+            return
+        self.MainWindow.setWindowTitle(f"{filename}[*] - BIDS editor")
+        if edits == self.edits:
+            self.MainWindow.setWindowModified(False)
+
+    def set_modified(self):
+        """Flags that the output bidsmap has been edited and not yet saved"""
+        self.edits += 1
+        self.MainWindow.setWindowModified(True)
 
     def handle_edit_button_clicked(self):
         """Make sure that index map has been updated. """
@@ -778,7 +830,7 @@ class Ui_MainWindow(MainWindow):
         """Opens the inspect window when a source file in the file-tree tab is double-clicked"""
         sourcefile = Path(self.model.fileInfo(index).absoluteFilePath())
         if bids.is_dicomfile(sourcefile):
-            sourcedata = pydicom.dcmread(str(sourcefile), force=True)
+            sourcedata = bids.read_dicomfile(sourcefile)
         elif bids.is_parfile(sourcefile):
             with open(sourcefile, 'r') as parfid:
                 sourcedata = parfid.read()
@@ -808,6 +860,7 @@ class Ui_MainWindow(MainWindow):
                     else:
                         self.has_edit_dialog_open = True
                     self.dialog_edit.done_edit.connect(self.update_subses_and_samples)
+                    self.dialog_edit.done_edit.connect(lambda bidsmap: self.set_modified())
                     self.dialog_edit.finished.connect(self.release_edit_dialog)
                     if modal:
                         self.dialog_edit.exec()
@@ -854,9 +907,8 @@ class EditDialog(QDialog):
         self.template_bidsmap = template_bidsmap
         self.subprefix        = subprefix
         self.sesprefix        = sesprefix
-        for run in bidsmap[self.dataformat][modality]:
-            if run['provenance'] == str(provenance):
-                self.source_run = run
+        _, _, index           = bids.find_run(bidsmap, self.dataformat, provenance, modality)
+        self.source_run       = bidsmap[self.dataformat][modality][index]
         self.target_run = copy.deepcopy(self.source_run)
         self.get_allowed_suffixes()
 
@@ -1054,7 +1106,7 @@ class EditDialog(QDialog):
         if row == 1 and column == 1:
             sourcefile = Path(self.target_run['provenance'])
             if bids.is_dicomfile(sourcefile):
-                sourcedata = pydicom.dcmread(str(sourcefile), force=True)
+                sourcedata = bids.read_dicomfile(sourcefile)
             elif bids.is_parfile(sourcefile):
                 with open(sourcefile, 'r') as parfid:
                     sourcedata = parfid.read()
@@ -1076,6 +1128,7 @@ class EditDialog(QDialog):
             if key and value!=oldvalue:
                 LOGGER.warning(f"Expert usage: User has set {self.dataformat}['{key}'] from '{oldvalue}' to '{value}' for {self.target_run['provenance']}")
                 self.target_run['attributes'][key] = value
+                bids.get_bidsmapindex(self.target_bidsmap, self.dataformat).invalidate(self.current_modality)
 
     def bids_cell_changed(self, row: int, column: int):
         """BIDS attribute value has been changed. """
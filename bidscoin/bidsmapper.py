@@ -18,16 +18,31 @@ import logging
 import sys
 import shutil
 from pathlib import Path
-from PyQt5.QtWidgets import QApplication, QMessageBox
 try:
-    from bidscoin import bids, bidseditor
+    from bidscoin import bids
 except ImportError:
-    import bids, bidseditor         # This should work if bidscoin was not pip-installed
+    import bids                     # This should work if bidscoin was not pip-installed
 
 
 LOGGER = logging.getLogger('bidscoin')
 
 
+def import_bidseditor():
+    """
+    Imports the bidseditor (and hence PyQt5) on first use, i.e. only when the bidsmapper is run interactively. In this way
+    the non-interactive bidsmapper runs headless, e.g. on compute nodes without a display or without PyQt5
+
+    :return:    The bidseditor module
+    """
+
+    try:
+        from bidscoin import bidseditor
+    except ImportError:
+        import bidseditor           # This should work if bidscoin was not pip-installed
+
+    return bidseditor
+
+
 def build_bidsmap(dataformat: str, sourcefile: Path, bidsmap_new: dict, bidsmap_old: dict, template: dict, store: dict, gui: object) -> dict:
     """
     All the logic to map the Philips PAR/XML fields onto bids labels go into this function
@@ -61,7 +76,10 @@ def build_bidsmap(dataformat: str, sourcefile: Path, bidsmap_new: dict, bidsmap_
         if store:
             targetfile        = store['target']/sourcefile.relative_to(store['source'])
             targetfile.parent.mkdir(parents=True, exist_ok=True)
-            sourcefile        = Path(shutil.copy2(sourcefile, targetfile))
+            if bids.archivetree.get(sourcefile):
+                sourcefile    = bids.archivetree.extract(sourcefile, targetfile)
+            else:
+                sourcefile    = Path(shutil.copy2(sourcefile, targetfile))
             run['provenance'] = str(sourcefile.resolve())
 
         # Communicate with the user if the run was not present in bidsmap_old or in template, i.e. that we found a new sample
@@ -74,6 +92,8 @@ def build_bidsmap(dataformat: str, sourcefile: Path, bidsmap_new: dict, bidsmap_
         if gui and gui.interactive==2 and index is None:
 
             # Open the interactive edit window to get the new mapping
+            from PyQt5.QtWidgets import QMessageBox
+            bidseditor  = import_bidseditor()
             dialog_edit = bidseditor.EditDialog(dataformat, sourcefile, modality, bidsmap_new, template, gui.subprefix, gui.sesprefix)
             dialog_edit.exec()
 
@@ -189,15 +209,19 @@ def bidsmapper(rawfolder: str, bidsfolder: str, bidsmapfile: str, templatefile:
     LOGGER.info(f">>> bidsmapper sourcefolder={rawfolder} bidsfolder={bidsfolder} bidsmap={bidsmapfile} "
                 f" template={templatefile} subprefix={subprefix} sesprefix={sesprefix} store={store} interactive={interactive}")
 
-    # Get the heuristics for filling the new bidsmap
-    bidsmap_old, _ = bids.load_bidsmap(bidsmapfile,  bidscoinfolder)
-    template, _    = bids.load_bidsmap(templatefile, bidscoinfolder)
+    # Use the persistent header index if it has been built
+    if (bidscoinfolder/'headerindex.db').is_file():
+        bids.open_headerindex(bidscoinfolder/'headerindex.db')
+
+    # Get the (read-only) heuristics for filling the new bidsmap
+    bidsmap_old, _ = bids.load_bidsmap(bidsmapfile,  bidscoinfolder, roundtrip=False)
+    template, _    = bids.load_bidsmap(templatefile, bidscoinfolder, roundtrip=False)
 
-    # Create the new bidsmap as a copy / bidsmap skeleton with no modality entries (i.e. bidsmap with empty lists)
+    # Create the new (editable) bidsmap as a copy / bidsmap skeleton with no modality entries (i.e. bidsmap with empty lists)
     if bidsmap_old:
-        bidsmap_new = copy.deepcopy(bidsmap_old)
+        bidsmap_new, _ = bids.load_bidsmap(bidsmapfile,  bidscoinfolder, report=False)
     else:
-        bidsmap_new = copy.deepcopy(template)
+        bidsmap_new, _ = bids.load_bidsmap(templatefile, bidscoinfolder, report=False)
     for logic in ('DICOM', 'PAR', 'P7', 'Nifti', 'FileSystem'):
         for modality in bids.bidsmodalities + (bids.unknownmodality, bids.ignoremodality):
             if bidsmap_new[logic] and modality in bidsmap_new[logic]:
@@ -205,11 +229,13 @@ def bidsmapper(rawfolder: str, bidsfolder: str, bidsmapfile: str, templatefile:
 
     # Start with an empty skeleton if we didn't have an old bidsmap
     if not bidsmap_old:
-        bidsmap_old = copy.deepcopy(bidsmap_new)
+        bidsmap_old = bids.plain_bidsmap(bidsmap_new)
 
-    # Start the Qt-application
+    # Start the Qt-application (only when needed, i.e. the non-interactive bidsmapper does not import any Qt-modules)
     gui = interactive
     if gui:
+        from PyQt5.QtWidgets import QApplication, QMessageBox
+        bidseditor = import_bidseditor()
         app = QApplication(sys.argv)
         app.setApplicationName('BIDS editor')
         mainwin = bidseditor.MainWindow()
@@ -241,11 +267,11 @@ def bidsmapper(rawfolder: str, bidsfolder: str, bidsmapfile: str, templatefile:
             sessions = [subject]
         for session in sessions:
 
-            # Unpack the data in a temporary folder if it is tarballed/zipped and/or contains a DICOMDIR file
-            session, unpacked = bids.unpack(session, subprefix, sesprefix, '*')
+            # Unpack the data in a temporary folder if it is tarballed/zipped and/or contains a DICOMDIR file (archived DICOM data is read straight from the archives)
+            session, unpacked = bids.unpack(session, subprefix, sesprefix, '*', virtual=True)
             if unpacked:
                 store = dict(source=unpacked, target=bidscoinfolder/'provenance')
-            elif store:
+            elif store or bids.archivetree.is_mounted(session):
                 store = dict(source=rawfolder, target=bidscoinfolder/'provenance')
             else:
                 store = dict()
@@ -287,9 +313,10 @@ def bidsmapper(rawfolder: str, bidsfolder: str, bidsmapfile: str, templatefile:
             if bidsmap_old['PlugIns']:
                 bidsmap_new = build_pluginmap(session, bidsmap_new, bidsmap_old)
 
-            # Clean-up the temporary unpacked data
+            # Clean-up the temporary unpacked data (i.e. the whole workfolder that was created by unpack, not just the sub/ses folder in it)
             if unpacked:
-                shutil.rmtree(session)
+                shutil.rmtree(unpacked)
+            bids.archivetree.unmount(session)
 
     if not dataformat:
         LOGGER.warning('Could not determine the dataformat of the source data')
@@ -317,6 +344,10 @@ def bidsmapper(rawfolder: str, bidsfolder: str, bidsmapfile: str, templatefile:
         # Save the bidsmap in the bidscoinfolder
         bids.save_bidsmap(bidsmapfile, bidsmap_new)
 
+    LOGGER.debug(f"Header cache: {bids.headercache}")
+    LOGGER.debug(f"Directory cache: {bids.dircache}")
+    LOGGER.info(f"Run matching memo: {bids.matchmemo}")
+    bids.close_headerindex()
     LOGGER.info('-------------- FINISHED! -------------------')
     LOGGER.info('')
 
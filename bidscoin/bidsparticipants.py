@@ -8,9 +8,7 @@ bidsfolder/code/bidscoin/bidsparticipants.log file.
 """
 
 import re
-import pandas as pd
 import json
-import dateutil.parser
 import logging
 import shutil
 from pathlib import Path
@@ -64,7 +62,8 @@ def scanparticipant(dataformat: str, session: Path, personals: dict, subid: str,
                 personals['session_id'] = sesid
             else:
                 return False                                        # Only from the first session -> BIDS specification
-        age = bids.get_dicomfield('PatientAge', sourcefile)         # A string of characters with one of the following formats: nnnD, nnnW, nnnM, nnnY
+        fields = bids.get_dicomfields(('PatientAge', 'PatientSex', 'PatientSize', 'PatientWeight'), sourcefile)
+        age    = fields['PatientAge']                               # A string of characters with one of the following formats: nnnD, nnnW, nnnM, nnnY
         if age.endswith('D'):
             personals['age'] = str(int(float(age.rstrip('D'))/365.2524))
         elif age.endswith('W'):
@@ -75,9 +74,9 @@ def scanparticipant(dataformat: str, session: Path, personals: dict, subid: str,
             personals['age'] = str(int(float(age.rstrip('Y'))))
         elif age:
             personals['age'] = age
-        personals['sex']     = bids.get_dicomfield('PatientSex',    sourcefile)
-        personals['size']    = bids.get_dicomfield('PatientSize',   sourcefile)
-        personals['weight']  = bids.get_dicomfield('PatientWeight', sourcefile)
+        personals['sex']     = fields['PatientSex']
+        personals['size']    = fields['PatientSize']
+        personals['weight']  = fields['PatientWeight']
 
         return True
 
@@ -95,6 +94,8 @@ def bidsparticipants(rawfolder: str, bidsfolder: str, keys: str, subprefix: str=
     :return:                Nothing
     """
 
+    import pandas as pd
+
     # Input checking & defaults
     rawfolder   = Path(rawfolder).resolve()
     bidsfolder  = Path(bidsfolder).resolve()
@@ -108,6 +109,10 @@ def bidsparticipants(rawfolder: str, bidsfolder: str, keys: str, subprefix: str=
     LOGGER.info(f"-------------- START bidsparticipants {bids.version()} ------------")
     LOGGER.info(f">>> bidsparticipants sourcefolder={rawfolder} bidsfolder={bidsfolder} subprefix={subprefix} sesprefix={sesprefix}")
 
+    # Use the persistent header index if it has been built
+    if (bidsfolder/'code'/'bidscoin'/'headerindex.db').is_file():
+        bids.open_headerindex(bidsfolder/'code'/'bidscoin'/'headerindex.db')
+
     # Get the table & dictionary of the subjects that have been processed
     participants_tsv  = bidsfolder/'participants.tsv'
     participants_json = participants_tsv.with_suffix('.json')
@@ -149,16 +154,17 @@ def bidsparticipants(rawfolder: str, bidsfolder: str, keys: str, subprefix: str=
         for session in sessions:
 
             # Unpack the data in a temporary folder if it is tarballed/zipped and/or contains a DICOMDIR file
-            session, unpacked = bids.unpack(session, subprefix, sesprefix, '*')
+            session, unpacked = bids.unpack(session, subprefix, sesprefix, '*', virtual=True)
 
             LOGGER.info(f"Scanning session: {session}")
 
             # Update / append the sourde data mapping
             success = scanparticipant('DICOM', session, personals, subid, sesid)
 
-            # Clean-up the temporary unpacked data
+            # Clean-up the temporary unpacked data (i.e. the whole workfolder that was created by unpack, not just the sub/ses folder in it)
             if unpacked:
-                shutil.rmtree(session)
+                shutil.rmtree(unpacked)
+            bids.archivetree.unmount(session)
 
             if success:
                 break
@@ -193,6 +199,8 @@ def bidsparticipants(rawfolder: str, bidsfolder: str, keys: str, subprefix: str=
 
     print(participants_table)
 
+    bids.close_headerindex()
+
     LOGGER.info('-------------- FINISHED! ------------')
     LOGGER.info('')
 
@@ -10,9 +10,6 @@ import shutil
 import argparse
 import json
 import logging
-import pandas as pd
-import pydeface.utils as pdu
-import drmaa
 from pathlib import Path
 try:
     from bidscoin import bids
@@ -35,6 +32,10 @@ def deface(bidsdir: str, pattern: str, subjects: list, output: str, cluster: boo
     :return:
     """
 
+    import pandas as pd
+    import pydeface.utils as pdu
+    import drmaa
+
     # Input checking
     bidsdir = Path(bidsdir).resolve()
 
@@ -103,8 +104,8 @@ def deface(bidsdir: str, pattern: str, subjects: list, output: str, cluster: boo
                         pdu.deface_image(str(match), str(outputfile), force=True, forcecleanup=True, **kwargs)
 
                     # Overwrite or add a json sidecar-file
-                    inputjson  = match.with_suffix('').with_suffix('.json')
-                    outputjson = outputfile.with_suffix('').with_suffix('.json')
+                    inputjson  = bids.BidsName(match).with_extension('.json')
+                    outputjson = bids.BidsName(outputfile).with_extension('.json')
                     if inputjson.is_file() and inputjson != outputjson:
                         if outputjson.is_file():
                             LOGGER.info(f"Overwriting the json sidecar-file: {outputjson}")
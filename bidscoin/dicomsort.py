@@ -4,15 +4,18 @@ Sorts and / or renames DICOM files into local subdirectories with a (3-digit) Se
 """
 
 import re
+import os
+import time
 import logging
+from typing import Iterable, List, Tuple
 from pathlib import Path
-from pydicom.filereader import read_dicomdir
 try:
     from bidscoin import bids
 except ImportError:
     import bids         # This should work if bidscoin was not pip-installed
 
-LOGGER = logging.getLogger('bidscoin')
+LOGGER    = logging.getLogger('bidscoin')
+BATCHSIZE = 1000                                # The number of files that are moved in one batch
 
 
 def cleanup(name: str) -> str:
@@ -31,87 +34,168 @@ def cleanup(name: str) -> str:
     return name
 
 
-def sortsession(sessionfolder: Path, dicomfiles: list, dicomfield: str, rename: bool, ext: str, nosort: bool, dryrun: bool) -> None:
+def get_sortfields(dicomfile: Path, dicomfield: str='SeriesDescription', rename: bool=False) -> Tuple[Path, dict]:
     """
-    Sorts dicomfiles into (3-digit) SeriesNumber-SeriesDescription subfolders (e.g. '003-T1MPRAGE')
+    Reads (only) the DICOM fields that are needed to sort and/or rename a DICOM file. The file is read header-only and
+    restricted to the needed tags, which makes it suitable for the (parallel) workers of sortsession(). If dicomfield is
+    not a top-level DICOM keyword, then it is looked up in the full header (see bids.get_dicomfield())
+
+    :param dicomfile:   The full pathname of the DICOM file
+    :param dicomfield:  The dicomfield that is used to construct the series folder name (SeriesDescription and ProtocolName are used as fallback)
+    :param rename:      Boolean to also read the fields that are needed for renaming the DICOM file
+    :return:            A (dicomfile, fields) tuple with the seriesnr, seriesdescr and (if rename) the acquisitionnr, instancenr and patientname fields, or with an empty fields dictionary if the file could not be read
+    """
+
+    from pydicom.datadict import tag_for_keyword
+
+    tags = (dicomfield, 'SeriesNumber', 'SeriesDescription', 'ProtocolName')
+    if rename:
+        tags += ('AcquisitionNumber', 'InstanceNumber', 'ImageNumber', 'PatientName', 'PatientsName')   # ImageNumber was named InstanceNumber in earlier versions of the Standard and PatientName is sometimes called PatientsName
+    if not bids.is_dicomfile(dicomfile):
+        LOGGER.warning(f"{dicomfile} is not a DICOM file")
+        return dicomfile, {}
+    try:
+        dicomdict = bids.read_dicomfile(dicomfile, tags=tags)
+    except Exception as readerror:
+        LOGGER.warning(f"Cannot read {dicomfile}: {readerror}")
+        return dicomfile, {}
+
+    values = {tag: bids.cast_value(dicomdict.get(tag)) for tag in tags}
+    if not (tag_for_keyword(dicomfield) and dicomfield in dicomdict):    # A (nested) element name or a vendor specific field is not in the restricted read
+        values[dicomfield] = bids.get_dicomfield(dicomfield, dicomfile)
+    fields = {'seriesnr':    values['SeriesNumber'],
+              'seriesdescr': values[dicomfield] or values['SeriesDescription'] or values['ProtocolName']}
+    if rename:
+        fields['acquisitionnr'] = values['AcquisitionNumber']
+        fields['instancenr']    = values['InstanceNumber'] or values['ImageNumber']
+        fields['patientname']   = values['PatientName'] or values['PatientsName']
+
+    return dicomfile, fields
+
+
+def sortsession(sessionfolder: Path, dicomfiles: Iterable[Path], dicomfield: str, rename: bool, ext: str, nosort: bool, dryrun: bool, jobs: int=1) -> None:
+    """
+    Sorts dicomfiles into (3-digit) SeriesNumber-SeriesDescription subfolders (e.g. '003-T1MPRAGE'). The DICOM fields are
+    read by (parallel) workers, while the files are moved in batches in the main process
 
     :param sessionfolder:   The name of the destination folder of the dicom files
-    :param dicomfiles:      The list of dicomfiles to be sorted and/or renamed
+    :param dicomfiles:      The list (or a stream) of dicomfiles to be sorted and/or renamed
     :param dicomfield:      The dicomfield that is used to construct the series folder name (e.g. SeriesDescription or ProtocolName, which are both used as fallback)
     :param rename:          Boolean to rename the DICOM files to a PatientName_SeriesNumber_SeriesDescription_AcquisitionNumber_InstanceNumber scheme
     :param ext:             The file extension after sorting (empty value keeps original file extension)
     :param nosort:          Boolean to skip sorting of DICOM files into SeriesNumber-SeriesDescription directories (useful in combination with -r for renaming only)
     :param dryrun:          Boolean to just display the action
+    :param jobs:            The number of worker processes that read the DICOM fields
     :return:                Nothing
     """
 
     # Map all dicomfiles and move them to series folders
-    LOGGER.info(f">> Sorting: {sessionfolder} ({len(dicomfiles)} files)")
+    LOGGER.info(f">> Sorting: {sessionfolder}" + (f" ({len(dicomfiles)} files)" if isinstance(dicomfiles, list) else ''))
     if not dryrun:
         sessionfolder.mkdir(parents=True, exist_ok=True)
 
+    pool = None
+    if jobs > 1:
+        import multiprocessing
+        from functools import partial
+        pool    = multiprocessing.Pool(jobs)
+        results = pool.imap(partial(get_sortfields, dicomfield=dicomfield, rename=rename), dicomfiles, chunksize=BATCHSIZE//jobs or 1)     # Stream the fields back in the order of the dicomfiles
+    else:
+        results = (get_sortfields(dicomfile, dicomfield, rename) for dicomfile in dicomfiles)
+
+    starttime  = time.time()
     seriesdirs = []
-    for dicomfile in dicomfiles:
-
-        # Extract the SeriesDescription and SeriesNumber from the dicomfield
-        seriesnr = bids.get_dicomfield('SeriesNumber', dicomfile)
-        if not seriesnr:
-            LOGGER.warning(f"No SeriesNumber found, skipping: {dicomfile}")          # This is not a normal DICOM file, better not do anything with it
-            continue
-        seriesdescr = bids.get_dicomfield(dicomfield, dicomfile)
-        if not seriesdescr:
-            seriesdescr = bids.get_dicomfield('SeriesDescription', dicomfile)
+    targets    = set()
+    moves      = []
+    nfiles     = 0
+    try:
+        for dicomfile, fields in results:
+            nfiles += 1
+
+            # Extract the SeriesDescription and SeriesNumber from the dicomfield
+            seriesnr = fields.get('seriesnr')
+            if not seriesnr:
+                LOGGER.warning(f"No SeriesNumber found, skipping: {dicomfile}")          # This is not a normal DICOM file, better not do anything with it
+                continue
+            seriesdescr = fields['seriesdescr']
             if not seriesdescr:
-                seriesdescr = bids.get_dicomfield('ProtocolName', dicomfile)
-                if not seriesdescr:
-                    seriesdescr = 'unknown_protocol'
-                    LOGGER.warning(f"No {dicomfield}, SeriesDecription or ProtocolName found for: {dicomfile}")
-        if rename:
-            acquisitionnr = bids.get_dicomfield('AcquisitionNumber', dicomfile)
-            instancenr    = bids.get_dicomfield('InstanceNumber', dicomfile)
-            if not instancenr:
-                instancenr = bids.get_dicomfield('ImageNumber', dicomfile)          # This Attribute was named Image Number in earlier versions of this Standard
-            patientname    = bids.get_dicomfield('PatientName', dicomfile)
-            if not patientname:
-                patientname = bids.get_dicomfield('PatientsName', dicomfile)        # This Attribute was/is sometimes called PatientsName?
-
-        # Move and/or rename the dicomfile in(to) the (series sub)folder
-        if rename and not (patientname and seriesnr and seriesdescr and acquisitionnr and instancenr):
-            LOGGER.warning(f"Missing one or more essential DICOM-fields, cannot safely rename {dicomfile}\n"
-                           f"patientname = {patientname}\n"
-                           f"seriesnumber = {seriesnr}\n"
-                           f"{dicomfield} = {seriesdescr}\n"
-                           f"acquisitionnr = {acquisitionnr}\n"
-                           f"instancenr = {instancenr}")
-            filename = dicomfile.name
-        elif rename:
-            filename = cleanup(f"{patientname}_{seriesnr:03d}_{seriesdescr}_{acquisitionnr:05d}_{instancenr:05d}{ext}")
-        else:
-            filename = dicomfile.name
-        if nosort:
-            pathname = sessionfolder
-        else:
-            # Create the series subfolder
-            seriesdir = cleanup(f"{seriesnr:03d}-{seriesdescr}")
-            if seriesdir not in seriesdirs:  # We have a new series
-                if not (sessionfolder/seriesdir).is_dir():
-                    LOGGER.info(f"   Creating:  {sessionfolder/seriesdir}")
-                    if not dryrun:
-                        (sessionfolder/seriesdir).mkdir(parents=True)
-                seriesdirs.append(seriesdir)
-            pathname = sessionfolder/seriesdir
-        if ext:
-            newfilename = (pathname/filename).with_suffix(ext)
-        else:
-            newfilename = pathname/filename
-        if newfilename.is_file():
-            LOGGER.warning(f"File already exists, cannot safely rename {dicomfile} -> {newfilename}")
-        elif not dryrun:
+                seriesdescr = 'unknown_protocol'
+                LOGGER.warning(f"No {dicomfield}, SeriesDecription or ProtocolName found for: {dicomfile}")
+            if rename:
+                acquisitionnr = fields['acquisitionnr']
+                instancenr    = fields['instancenr']
+                patientname   = fields['patientname']
+
+            # Move and/or rename the dicomfile in(to) the (series sub)folder
+            if rename and not (patientname and seriesnr and seriesdescr and acquisitionnr and instancenr):
+                LOGGER.warning(f"Missing one or more essential DICOM-fields, cannot safely rename {dicomfile}\n"
+                               f"patientname = {patientname}\n"
+                               f"seriesnumber = {seriesnr}\n"
+                               f"{dicomfield} = {seriesdescr}\n"
+                               f"acquisitionnr = {acquisitionnr}\n"
+                               f"instancenr = {instancenr}")
+                filename = dicomfile.name
+            elif rename:
+                filename = cleanup(f"{patientname}_{seriesnr:03d}_{seriesdescr}_{acquisitionnr:05d}_{instancenr:05d}{ext}")
+            else:
+                filename = dicomfile.name
+            if nosort:
+                pathname = sessionfolder
+            else:
+                # Create the series subfolder
+                seriesdir = cleanup(f"{seriesnr:03d}-{seriesdescr}")
+                if seriesdir not in seriesdirs:  # We have a new series
+                    if not (sessionfolder/seriesdir).is_dir():
+                        LOGGER.info(f"   Creating:  {sessionfolder/seriesdir}")
+                        if not dryrun:
+                            (sessionfolder/seriesdir).mkdir(parents=True)
+                    seriesdirs.append(seriesdir)
+                pathname = sessionfolder/seriesdir
+            if ext:
+                newfilename = (pathname/filename).with_suffix(ext)
+            else:
+                newfilename = pathname/filename
+
+            # Collect the moves and detect collisions with existing files and with the other moves of this session
+            if newfilename in targets or (newfilename != dicomfile and newfilename.is_file()):
+                LOGGER.warning(f"File already exists, cannot safely rename {dicomfile} -> {newfilename}")
+                continue
+            targets.add(newfilename)
+            moves.append((dicomfile, newfilename))
+            if len(moves) >= BATCHSIZE:
+                movefiles(moves, dryrun)
+                moves = []
+        movefiles(moves, dryrun)
+
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    elapsed = max(time.time() - starttime, 1e-6)
+    LOGGER.info(f">> Sorted {nfiles} files in {elapsed:.1f}s ({nfiles/elapsed:.0f} files/s)")
+
+
+def movefiles(moves: List[Tuple[Path, Path]], dryrun: bool) -> None:
+    """
+    Moves a batch of files
+
+    :param moves:   A list of (source, destination) tuples
+    :param dryrun:  Boolean to just display the action
+    :return:        Nothing
+    """
+
+    for dicomfile, newfilename in moves:
+        if dryrun:
+            LOGGER.debug(f"   Moving: {dicomfile} -> {newfilename}")
+        elif dicomfile != newfilename:
             dicomfile.replace(newfilename)
 
 
-def sortsessions(session: Path, subprefix: str='', sesprefix: str='', dicomfield: str='SeriesDescription', rename: bool=False, ext: str='', nosort: bool=False, pattern: str='.*\.(IMA|dcm)$', dryrun: bool=False) -> None:
+def sortsessions(session: Path, subprefix: str='', sesprefix: str='', dicomfield: str='SeriesDescription', rename: bool=False, ext: str='', nosort: bool=False, pattern: str=r'.*\.(IMA|dcm)$', dryrun: bool=False, jobs: int=1) -> None:
     """
+    Sorts and / or renames the DICOM files in the session folder(s). The folder listing is streamed to sortsession(), except
+    in nosort mode, where the files stay in (and would otherwise be re-listed from) the same folder
 
     :param session:     The root folder containing the source [sub/][ses/]dicomfiles or the DICOMDIR file
     :param subprefix:   The prefix for searching the sub folders in session
@@ -122,6 +206,7 @@ def sortsessions(session: Path, subprefix: str='', sesprefix: str='', dicomfield
     :param nosort:      Boolean to skip sorting of DICOM files into SeriesNumber-SeriesDescription directories (useful in combination with -r for renaming only)
     :param pattern:     The regular expression pattern used in re.match() to select the dicom files
     :param dryrun:      Boolean to just display the action
+    :param jobs:        The number of worker processes that read the DICOM fields (see sortsession())
     :return:            Nothing
     """
 
@@ -141,11 +226,12 @@ def sortsessions(session: Path, subprefix: str='', sesprefix: str='', dicomfield
                 sessionfolders = [subfolder]
 
             for sessionfolder in sessionfolders:
-                sortsessions(session=sessionfolder, dicomfield=dicomfield, rename=rename, ext=ext, nosort=nosort, pattern=pattern, dryrun=dryrun)
+                sortsessions(session=sessionfolder, dicomfield=dicomfield, rename=rename, ext=ext, nosort=nosort, pattern=pattern, dryrun=dryrun, jobs=jobs)
 
     # Use the DICOMDIR file if it is there
     if (session/'DICOMDIR').is_file():
 
+        from pydicom.filereader import read_dicomdir
         dicomdir = read_dicomdir(str(session/'DICOMDIR'))
 
         sessionfolder = session
@@ -159,12 +245,16 @@ def sortsessions(session: Path, subprefix: str='', sesprefix: str='', dicomfield
                     LOGGER.warning(f"The session index-number '{n:02}' is not necessarily meaningful: {sessionfolder}")
 
                 dicomfiles = [session.joinpath(*image.ReferencedFileID) for series in study.children for image in series.children]
-                sortsession(sessionfolder, dicomfiles, dicomfield, rename, ext, nosort, dryrun)
+                sortsession(sessionfolder, dicomfiles, dicomfield, rename, ext, nosort, dryrun, jobs)
 
     else:
 
-        dicomfiles = [dcmfile for dcmfile in session.iterdir() if dcmfile.is_file() and re.match(pattern, str(dcmfile))]
-        sortsession(session, dicomfiles, dicomfield, rename, ext, nosort, dryrun)
+        # Stream the directory entries (without stat calls) to the workers. In nosort mode the files are renamed in the listed folder, so then the listing is completed first
+        with os.scandir(session) as entries:
+            dicomfiles = (Path(entry.path) for entry in entries if entry.is_file() and re.match(pattern, entry.path))
+            if nosort:
+                dicomfiles = list(dicomfiles)
+            sortsession(session, dicomfiles, dicomfield, rename, ext, nosort, dryrun, jobs)
 
 
 def main():
@@ -191,8 +281,9 @@ def main():
     parser.add_argument('-r','--rename',    help='Flag to rename the DICOM files to a PatientName_SeriesNumber_SeriesDescription_AcquisitionNumber_InstanceNumber scheme (recommended for DICOMDIR data)', action='store_true')
     parser.add_argument('-e','--ext',       help='The file extension after sorting (empty value keeps the original file extension), e.g. ".dcm"', default='')
     parser.add_argument('-n','--nosort',    help='Flag to skip sorting of DICOM files into SeriesNumber-SeriesDescription directories (useful in combination with -r for renaming only)', action='store_true')
-    parser.add_argument('-p','--pattern',   help='The regular expression pattern used in re.match(pattern, dicomfile) to select the dicom files', default='.*\.(IMA|dcm)$')
+    parser.add_argument('-p','--pattern',   help='The regular expression pattern used in re.match(pattern, dicomfile) to select the dicom files', default=r'.*\.(IMA|dcm)$')
     parser.add_argument('-d','--dryrun',    help='Add this flag to just print the dicomsort commands without actually doing anything', action='store_true')
+    parser.add_argument('--jobs',           help='The number of parallel worker processes that read the DICOM headers (useful for large, flat folders)', type=int, default=1)
     args = parser.parse_args()
 
     sortsessions(session    = args.dicomsource,
@@ -203,7 +294,8 @@ def main():
                  ext        = args.ext,
                  nosort     = args.nosort,
                  pattern    = args.pattern,
-                 dryrun     = args.dryrun)
+                 dryrun     = args.dryrun,
+                 jobs       = args.jobs)
 
 
 if __name__ == "__main__":
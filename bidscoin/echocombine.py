@@ -8,8 +8,6 @@ This wrapper is fully BIDS-aware (a 'bidsapp') and writes BIDS compliant output
 import argparse
 import json
 import logging
-import pandas as pd
-from multiecho import combination as me
 from pathlib import Path
 try:
     from bidscoin import bids
@@ -32,6 +30,9 @@ def echocombine(bidsdir: str, pattern: str, subjects: list, output: str, algorit
     :return:
     """
 
+    import pandas as pd
+    from multiecho import combination as me
+
     # Input checking
     bidsdir = Path(bidsdir).resolve()
 
@@ -71,20 +72,23 @@ def echocombine(bidsdir: str, pattern: str, subjects: list, output: str, algorit
             for match in sorted([match for match in session.rglob(pattern) if '.nii' in match.suffixes]):
 
                 # Check if it is normal/BIDS multi-echo data
-                input     = match.parent.name
-                echonr    = bids.get_bidsvalue(match, 'echo')
-                mepattern = bids.get_bidsvalue(match, 'echo', '*')
-                echos     = sorted(match.parent.glob(mepattern.name))
-                newechos  = [echo.parents[1]/bids.unknownmodality/echo.name for echo in echos]
+                input    = match.parent.name
+                bidsname = bids.BidsName(match)
+                echonr   = bidsname['echo']
                 if not echonr:
                     LOGGER.warning(f"No 'echo' key-value pair found in the filename, skipping: {match}")
                     continue
+                bidsname['echo'] = '*'
+                mepattern        = bidsname.path
+                echos            = sorted(match.parent.glob(mepattern.name))
+                newechos         = [echo.parents[1]/bids.unknownmodality/echo.name for echo in echos]
                 if len(echos) == 1:
                     LOGGER.warning(f"Only one echo image found, nothing to do for: {match}")
                     continue
 
                 # Construct the combined-echo output filename and check if that file already exists
-                cename = match.name.replace(f"_echo-{echonr}", '')
+                del bidsname['echo']
+                cename = bidsname.filename
                 if not output:
                     cefile = session/input/cename
                 elif output == 'derivatives':
@@ -105,12 +109,12 @@ def echocombine(bidsdir: str, pattern: str, subjects: list, output: str, algorit
                         LOGGER.info(f"Moving original echo image: {echo} -> {newecho}")
                         newecho.parent.mkdir(parents=True, exist_ok=True)
                         echo.replace(newecho)
-                        echo.with_suffix('').with_suffix('.json').replace(newecho.with_suffix('').with_suffix('.json'))
+                        bids.BidsName(echo).with_extension('.json').replace(bids.BidsName(newecho).with_extension('.json'))
                 elif output == input:
                     for echo in echos:
                         LOGGER.info(f"Removing original echo image: {echo}")
                         echo.unlink()
-                        echo.with_suffix('').with_suffix('.json').unlink()
+                        bids.BidsName(echo).with_extension('.json').unlink()
 
                 # Construct relative path names as they are used in BIDS
                 echos_rel    = [str(echo.relative_to(session)) for echo in echos]
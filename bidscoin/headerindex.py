@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+"""
+Builds or prunes a persistent index of the source header attributes that are used by the
+bidsmapper, bidscoiner, bidsparticipants and rawmapper. The index is an SQLite database in
+bidsfolder/code/bidscoin/headerindex.db and, once it exists, it is consulted (and
+incrementally refreshed) by these tools, so that the source headers of unchanged files
+do not have to be parsed again. Index entries are invalidated as soon as the size,
+modification time or inode of a source file changes.
+"""
+
+import os
+import json
+import logging
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterable
+try:
+    from bidscoin import bids
+except ImportError:
+    import bids         # This should work if bidscoin was not pip-installed
+
+LOGGER = logging.getLogger('bidscoin')
+
+INDEXNAME = 'headerindex.db'
+SCHEMA    = 1                                                                                               # The version of the database layout (PRAGMA user_version). Indices with another version are rebuilt
+PERSONALS = ('AcquisitionTime', 'exam_date', 'PatientAge', 'PatientSex', 'PatientSize', 'PatientWeight')    # Attributes that are read by the tools, on top of the attributes in the bidsmap
+NETWORKFS = ('nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'lustre', 'gpfs', 'beegfs', 'ceph', 'glusterfs', 'afs', 'fuse.sshfs')    # File systems on which the SQLite WAL-mode does not work
+
+
+def is_networkfs(path: Path) -> bool:
+    """
+    Checks whether a path is on a network file system (according to /proc/mounts, i.e. this is only detected on Linux)
+
+    :param path:    The full pathname of an existing file or folder
+    :return:        True if the path is on one of the NETWORKFS file systems
+    """
+
+    path = Path(path).resolve()
+    if str(path).startswith('\\\\'):                      # A Windows UNC path
+        return True
+
+    fstype, mountlength = '', -1
+    try:
+        with open('/proc/mounts') as mounts:
+            for mount in mounts:
+                fields = mount.split()
+                if len(fields) < 3:
+                    continue
+                mountpoint = Path(fields[1].replace('\\040', ' '))
+                if (mountpoint == path or mountpoint in path.parents) and len(mountpoint.parts) > mountlength:
+                    fstype, mountlength = fields[2], len(mountpoint.parts)
+    except OSError:
+        pass
+
+    return fstype in NETWORKFS
+
+
+class HeaderIndex:
+    """
+    A persistent SQLite index of source file attributes, keyed by the file path and validated by the size, modification
+    time and inode of the file. The index can be shared by concurrent (threaded or multiprocessing) readers and writers.
+    On network file systems the rollback journal is used instead of WAL, so that processes on different nodes can share
+    the index (albeit with less concurrency)
+    """
+
+    def __init__(self, dbfile: Path):
+        """
+        :param dbfile:  The full pathname of the SQLite database file. It is created if it does not exist
+        """
+
+        self.dbfile    = Path(dbfile)
+        self.hits      = 0
+        self.misses    = 0
+        self.excluded  = []                                         # Folders with (temporary) files that are not indexed, see exclude()
+        self._verified = {}                                         # The path -> stamp of the files that have been verified against the database in this session
+        self._lock     = threading.RLock()
+
+        self.dbfile.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(self.dbfile), timeout=60, isolation_level=None, check_same_thread=False)
+        if is_networkfs(self.dbfile.parent):                        # WAL needs shared memory, i.e. all processes must be on the same host
+            LOGGER.debug(f"Using the rollback journal for the header index on a network file system: {self.dbfile}")
+            self._db.execute('PRAGMA journal_mode=DELETE')
+        else:
+            self._db.execute('PRAGMA journal_mode=WAL')             # Readers and a writer can then work concurrently
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        with self._transaction() as db:
+            version = db.execute('PRAGMA user_version').fetchone()[0]
+            if version != SCHEMA:
+                if version:
+                    LOGGER.info(f"Rebuilding the header index (version {version} -> {SCHEMA}): {self.dbfile}")
+                db.execute('DROP TABLE IF EXISTS files')
+                db.execute('DROP TABLE IF EXISTS attributes')
+                db.execute('CREATE TABLE files (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, inode INTEGER)')
+                db.execute('CREATE TABLE attributes (path TEXT, tagname TEXT, value TEXT, PRIMARY KEY (path, tagname))')
+                db.execute(f"PRAGMA user_version={SCHEMA}")
+
+    def __str__(self):
+        return f"{self.dbfile} ({self.hits} hits, {self.misses} misses)"
+
+    @contextmanager
+    def _transaction(self):
+        """Runs the enclosed statements in a single write transaction that is rolled back if anything goes wrong"""
+
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            yield self._db
+            self._db.execute('COMMIT')
+        except BaseException:
+            if self._db.in_transaction:
+                self._db.execute('ROLLBACK')
+            raise
+
+    @staticmethod
+    def _stamp(sourcefile: Path) -> tuple:
+        stat = sourcefile.stat()
+        return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+    def exclude(self, folder: Path) -> None:
+        """
+        Excludes the files in a folder from the index, e.g. because they are temporary copies of the source data
+
+        :param folder:  The full pathname of the folder
+        :return:
+        """
+
+        with self._lock:
+            self.excluded.append(str(folder).rstrip(os.sep) + os.sep)
+
+    def _verify(self, sourcefile: Path) -> tuple:
+        """
+        Checks whether the index entry of the file is up-to-date, i.e. whether the file is unchanged. Nothing is written to
+        the database, the stale attributes of a changed file are replaced by put_many()
+
+        :param sourcefile:  The full pathname of the source file
+        :return:            A (stamp, verified) tuple, or (None, False) if the file does not exist or is excluded from the index
+        """
+
+        key = str(sourcefile)
+        if key.startswith(tuple(self.excluded)):
+            return None, False
+
+        try:
+            stamp = self._stamp(sourcefile)
+        except OSError:
+            return None, False
+        if self._verified.get(key) == stamp:
+            return stamp, True
+
+        with self._lock:
+            row = self._db.execute('SELECT size, mtime, inode FROM files WHERE path=?', (key,)).fetchone()
+            if row is None or tuple(row) != stamp:
+                return stamp, False
+            self._verified[key] = stamp
+
+        return stamp, True
+
+    def get(self, sourcefile: Path, tagname: str) -> tuple:
+        """
+        Looks up an attribute of a source file in the index
+
+        :param sourcefile:  The full pathname of the source file
+        :param tagname:     The name of the attribute
+        :return:            A (found, value) tuple
+        """
+
+        values = self.get_many(sourcefile, (tagname,))
+        if tagname in values:
+            return True, values[tagname]
+
+        return False, None
+
+    def get_many(self, sourcefile: Path, tagnames: Iterable[str]) -> dict:
+        """
+        Looks up a batch of attributes of a source file in the index, using a single validity check
+
+        :param sourcefile:  The full pathname of the source file
+        :param tagnames:    The names of the attributes
+        :return:            A tagname -> value dictionary of the attributes that were found
+        """
+
+        tagnames = set(tagnames)
+        values   = {}
+        with self._lock:
+            if self._verify(sourcefile)[1]:
+                for tagname, value in self._db.execute('SELECT tagname, value FROM attributes WHERE path=?', (str(sourcefile),)):
+                    if tagname in tagnames:
+                        values[tagname] = json.loads(value)
+            self.hits   += len(values)
+            self.misses += len(tagnames) - len(values)
+
+        return values
+
+    def put(self, sourcefile: Path, tagname: str, value) -> None:
+        """
+        Stores an attribute of a source file in the index
+
+        :param sourcefile:  The full pathname of the source file
+        :param tagname:     The name of the attribute
+        :param value:       The (str or int) value of the attribute
+        :return:
+        """
+
+        self.put_many(sourcefile, {tagname: value})
+
+    def put_many(self, sourcefile: Path, fields: dict) -> None:
+        """
+        Stores a batch of attributes of a source file in the index, using a single transaction (that also replaces the
+        index entry of a new or changed file)
+
+        :param sourcefile:  The full pathname of the source file
+        :param fields:      A tagname -> (str or int) value dictionary
+        :return:
+        """
+
+        key = str(sourcefile)
+        with self._lock:
+            stamp, verified = self._verify(sourcefile)
+            if not fields or stamp is None:
+                return
+            try:
+                with self._transaction() as db:
+                    if not verified:
+                        db.execute('DELETE FROM attributes WHERE path=?', (key,))
+                        db.execute('INSERT OR REPLACE INTO files (path, size, mtime, inode) VALUES (?,?,?,?)', (key,) + stamp)
+                    db.executemany('INSERT OR REPLACE INTO attributes (path, tagname, value) VALUES (?,?,?)',
+                                   [(key, tagname, json.dumps(value)) for tagname, value in fields.items()])
+            except sqlite3.Error as dberror:
+                LOGGER.warning(f"Could not store the attributes of {sourcefile} in the header index: {dberror}")
+                return
+            self._verified[key] = stamp
+
+    def prune(self) -> int:
+        """
+        Removes the entries of all files that no longer exist or that have changed
+
+        :return:    The number of removed files
+        """
+
+        with self._lock:
+            stale = []
+            for path, size, mtime, inode in self._db.execute('SELECT path, size, mtime, inode FROM files').fetchall():
+                try:
+                    if self._stamp(Path(path)) != (size, mtime, inode):
+                        stale.append((path,))
+                except OSError:
+                    stale.append((path,))
+            with self._transaction() as db:
+                db.executemany('DELETE FROM attributes WHERE path=?', stale)
+                db.executemany('DELETE FROM files WHERE path=?', stale)
+            self._verified.clear()
+
+        return len(stale)
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+def buildindex(rawfolder: str, bidsfolder: str, bidsmapfile: str='bidsmap.yaml', subprefix: str='sub-', sesprefix: str='ses-', prune: bool=False) -> None:
+    """
+    Indexes the attributes of the source files in rawfolder that are used by the BIDScoin tools
+
+    :param rawfolder:   The root folder-name of the sub/ses/data/file tree containing the source data files
+    :param bidsfolder:  The name of the BIDS root folder (the index is stored in bidsfolder/code/bidscoin)
+    :param bidsmapfile: The name of the bidsmap YAML-file that is used to select the attributes. If the bidsmap pathname is relative (i.e. no "/" in the name) then it is assumed to be located in bidsfolder/code/bidscoin
+    :param subprefix:   The prefix common for all source subject-folders
+    :param sesprefix:   The prefix common for all source session-folders
+    :param prune:       If True, the stale index entries are removed instead
+    :return:            Nothing
+    """
+
+    # Input checking
+    rawfolder      = Path(rawfolder).resolve()
+    bidscoinfolder = Path(bidsfolder).resolve()/'code'/'bidscoin'
+
+    # Start logging
+    bids.setup_logging()
+
+    index = bids.open_headerindex(bidscoinfolder/INDEXNAME)
+    if prune:
+        LOGGER.info(f"Pruned {index.prune()} files from: {index.dbfile}")
+        bids.close_headerindex()
+        return
+
+    # Get the attributes that need to be indexed
+    bidsmap, _ = bids.load_bidsmap(Path(bidsmapfile), bidscoinfolder, roundtrip=False)
+    if not bidsmap:
+        bidsmap, _ = bids.load_bidsmap(Path(), bidscoinfolder, roundtrip=False)
+
+    # Loop over all subjects and sessions and index the source files
+    for subject in bids.lsdirs(rawfolder, subprefix + '*'):
+        sessions = bids.lsdirs(subject, sesprefix + '*')
+        if not sessions:
+            sessions = [subject]
+        for session in sessions:
+
+            dataformat = bids.get_dataformat(session)
+            if dataformat=='DICOM':
+                sourcefiles = [bids.get_dicomfile(sourcedir) for sourcedir in bids.lsdirs(session)]
+            elif dataformat=='PAR':
+                sourcefiles = bids.get_parfiles(session)
+            else:
+                LOGGER.info(f"Skipping: {session}")
+                continue
+
+            LOGGER.info(f"Indexing: {session}")
+            tagnames = bids.get_bidsmaptags(bidsmap, dataformat) | set(PERSONALS)
+            for sourcefile in [sourcefile for sourcefile in sourcefiles if sourcefile.name]:
+                bids.get_sourcefields(sorted(tagnames), sourcefile, dataformat)
+
+    LOGGER.info(f"Finished indexing: {index}")
+    bids.close_headerindex()
+
+
+def main():
+    """Console script usage"""
+
+    # Parse the input arguments and run buildindex(args)
+    import argparse
+    import textwrap
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description=textwrap.dedent(__doc__),
+                                     epilog='examples:\n'
+                                            '  headerindex /project/foo/raw /project/foo/bids\n'
+                                            '  headerindex /project/foo/raw /project/foo/bids --prune\n ')
+    parser.add_argument('sourcefolder',     help='The study root folder containing the raw data in sub-#/[ses-#/]data subfolders (or specify --subprefix and --sesprefix for different prefixes)')
+    parser.add_argument('bidsfolder',       help='The destination folder with the (future) bids data and the bidsfolder/code/bidscoin/headerindex.db output file')
+    parser.add_argument('-b','--bidsmap',   help='The bidsmap YAML-file with the attributes that are indexed. If the bidsmap filename is relative (i.e. no "/" in the name) then it is assumed to be located in bidsfolder/code/bidscoin. Default: bidsmap.yaml (or the template if there is no bidsmap)', default='bidsmap.yaml')
+    parser.add_argument('-n','--subprefix', help="The prefix common for all the source subject-folders. Default: 'sub-'", default='sub-')
+    parser.add_argument('-m','--sesprefix', help="The prefix common for all the source session-folders. Default: 'ses-'", default='ses-')
+    parser.add_argument('-p','--prune',     help='Flag to remove the entries of deleted or changed source files from the index', action='store_true')
+    parser.add_argument('-v','--version',   help='Show the BIDS and BIDScoin version', action='version', version=f"BIDS-version:\t\t{bids.bidsversion()}\nBIDScoin-version:\t{bids.version()}")
+    args = parser.parse_args()
+
+    buildindex(rawfolder   = args.sourcefolder,
+               bidsfolder  = args.bidsfolder,
+               bidsmapfile = args.bidsmap,
+               subprefix   = args.subprefix,
+               sesprefix   = args.sesprefix,
+               prune       = args.prune)
+
+
+if __name__ == "__main__":
+    main()
@@ -16,7 +16,7 @@ def bidsmapper_plugin(seriesfolder: Path, bidsmap: dict, bidsmap_template: dict)
     """
     The plugin to map info onto bids labels
 
-    :param seriesfolder:        The full-path name of the raw-data series folder
+    :param seriesfolder:        The full-path name of the raw-data series folder. NB: Archived DICOM data is not unpacked but presented as a virtual source tree, use bids.lsdirs(), bids.get_dicomfile() and bids.get_dicomfield() to access it
     :param bidsmap:             The study bidsmap
     :param bidsmap_template:    Full BIDS heuristics data structure, with all options, BIDS labels and attributes, etc
     :return:                    The study bidsmap with new entries in it
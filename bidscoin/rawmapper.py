@@ -16,7 +16,7 @@ except ImportError:
     import bids         # This should work if bidscoin was not pip-installed
 
 
-def rawmapper(rawfolder, outfolder: Path=Path(), sessions: tuple=(), rename: bool=False, dicomfield: tuple=('PatientComments',), wildcard: str='*', subprefix: str='sub-', sesprefix: str='ses-', dryrun: bool=False) -> None:
+def rawmapper(rawfolder, outfolder: Path=Path(), sessions: tuple=(), rename: bool=False, dicomfield: tuple=('PatientComments',), wildcard: str='*', subprefix: str='sub-', sesprefix: str='ses-', dryrun: bool=False, headerindex: str='') -> None:
     """
     :param rawfolder:   The root folder-name of the sub/ses/data/file tree containing the source data files
     :param outfolder:   The name of the folder where the mapping-file is saved (default = sourcefolder)
@@ -27,6 +27,7 @@ def rawmapper(rawfolder, outfolder: Path=Path(), sessions: tuple=(), rename: boo
     :param subprefix:   The prefix common for all source subject-folders
     :param sesprefix:   The prefix common for all source session-folders
     :param dryrun:      Flag for dry-running renaming the sub-subid folders
+    :param headerindex: The full pathname of a persistent header index (e.g. bidsfolder/code/bidscoin/headerindex.db) that is used to look up the dicomfields
     :return:            Nothing
     """
 
@@ -36,97 +37,104 @@ def rawmapper(rawfolder, outfolder: Path=Path(), sessions: tuple=(), rename: boo
         outfolder = rawfolder
         print(f"Outfolder: {outfolder}")
     outfolder = Path(outfolder).resolve()
-
-    # Write the header of the mapper logfile
-    mapperfile = outfolder/f"rawmapper_{'_'.join(dicomfield)}.tsv"
-    if not dryrun:
-        if rename and not mapperfile.is_file():     # Write the header once
-            with mapperfile.open('w') as fid:
-                fid.write('subid\tsesid\tnewsubid\tnewsesid\n')
-        else:     # Write the header once
-            with mapperfile.open('w') as fid:
-                fid.write('subid\tsesid\tseriesname\t{}\n'.format('\t'.join(dicomfield)))
-
-    # Map the sessions in the sourcefolder
-    if not sessions:
-        sessions = list(rawfolder.glob(f"{subprefix}*/{sesprefix}*"))
+    if headerindex:
+        bids.open_headerindex(Path(headerindex).resolve())
+
+    try:
+        # Write the header of the mapper logfile
+        mapperfile = outfolder/f"rawmapper_{'_'.join(dicomfield)}.tsv"
+        if not dryrun:
+            if rename and not mapperfile.is_file():     # Write the header once
+                with mapperfile.open('w') as fid:
+                    fid.write('subid\tsesid\tnewsubid\tnewsesid\n')
+            else:     # Write the header once
+                with mapperfile.open('w') as fid:
+                    fid.write('subid\tsesid\tseriesname\t{}\n'.format('\t'.join(dicomfield)))
+
+        # Map the sessions in the sourcefolder
         if not sessions:
-            sessions = list(rawfolder.glob(f"{subprefix}*"))        # Try without session-subfolders
-    else:
-        sessions = [sessionitem for session in sessions for sessionitem in rawfolder.glob(session)]
-    sessions = [session for session in sessions if session.is_dir()]
-
-    # Loop over the selected sessions in the sourcefolder
-    for session in sessions:
-
-        # Get the subject and session identifiers from the sub/ses session folder
-        subid, sesid = bids.get_subid_sesid(session/'dum.my', subprefix=subprefix, sesprefix=sesprefix)
-        subid = subid.replace('sub-', subprefix)
-        sesid = sesid.replace('ses-', sesprefix)
-
-        # Parse the new subject and session identifiers from the dicomfield
-        series = bids.lsdirs(session, wildcard)
-        if not series:
-            series = ''
-            dcmval = ''
+            sessions = list(rawfolder.glob(f"{subprefix}*/{sesprefix}*"))
+            if not sessions:
+                sessions = list(rawfolder.glob(f"{subprefix}*"))        # Try without session-subfolders
         else:
-            series = series[0]                                                                          # TODO: loop over series?
-            dcmval = ''
-            for dcmfield in dicomfield:
-                dcmval = dcmval + '/' + str(bids.get_dicomfield(dcmfield, bids.get_dicomfile(series)))
-            dcmval = dcmval[1:]
-
-        # Rename the session subfolder in the sourcefolder and print & save this info
-        if rename:
-
-            # Get the new subid and sesid
-            if not dcmval or dcmval=='None':
-                warnings.warn(f"Skipping renaming because the dicom-field was empty for: {session}")
-                continue
+            sessions = [sessionitem for session in sessions for sessionitem in rawfolder.glob(session)]
+        sessions = [session for session in sessions if session.is_dir()]
+
+        # Loop over the selected sessions in the sourcefolder
+        for session in sessions:
+
+            # Get the subject and session identifiers from the sub/ses session folder
+            subid, sesid = bids.get_subid_sesid(session/'dum.my', subprefix=subprefix, sesprefix=sesprefix)
+            subid = subid.replace('sub-', subprefix)
+            sesid = sesid.replace('ses-', sesprefix)
+
+            # Parse the new subject and session identifiers from the dicomfield
+            series = bids.lsdirs(session, wildcard)
+            if not series:
+                series = ''
+                dcmval = ''
             else:
-                if '/' in dcmval:               # Allow for different sub/ses delimiters that could be entered at the console (i.e. in PatientComments)
-                    delim = '/'
-                elif '\\' in dcmval:
-                    delim = '\\'
-                else:
-                    delim = '\r\n'
-                newsubsesid = [val for val in dcmval.split(delim) if val]   # Skip empty lines / entries
-                newsubid    = subprefix + bids.cleanup_value(re.sub(f'^{subprefix}', '', newsubsesid[0]))
-                if newsubid==subprefix or newsubid==subprefix+'None':
-                    newsubid = subid
-                    warnings.warn(f"Could not rename {subid} because the dicom-field was empty for: {session}")
-                if len(newsubsesid)==1:
-                    newsesid = sesid
-                elif len(newsubsesid)==2:
-                    newsesid = sesprefix + bids.cleanup_value(re.sub(f'^{sesprefix}', '', newsubsesid[1]))
+                series = series[0]                                                                          # TODO: loop over series?
+                dcmval = ''
+                for dcmfield in dicomfield:
+                    dcmval = dcmval + '/' + str(bids.get_dicomfield(dcmfield, bids.get_dicomfile(series)))
+                dcmval = dcmval[1:]
+
+            # Rename the session subfolder in the sourcefolder and print & save this info
+            if rename:
+
+                # Get the new subid and sesid
+                if not dcmval or dcmval=='None':
+                    warnings.warn(f"Skipping renaming because the dicom-field was empty for: {session}")
+                    continue
                 else:
-                    warnings.warn(f"Skipping renaming of {session} because the dicom-field '{dcmval}' could not be parsed into [subid, sesid]")
+                    if '/' in dcmval:               # Allow for different sub/ses delimiters that could be entered at the console (i.e. in PatientComments)
+                        delim = '/'
+                    elif '\\' in dcmval:
+                        delim = '\\'
+                    else:
+                        delim = '\r\n'
+                    newsubsesid = [val for val in dcmval.split(delim) if val]   # Skip empty lines / entries
+                    newsubid    = subprefix + bids.cleanup_value(re.sub(f'^{subprefix}', '', newsubsesid[0]))
+                    if newsubid==subprefix or newsubid==subprefix+'None':
+                        newsubid = subid
+                        warnings.warn(f"Could not rename {subid} because the dicom-field was empty for: {session}")
+                    if len(newsubsesid)==1:
+                        newsesid = sesid
+                    elif len(newsubsesid)==2:
+                        newsesid = sesprefix + bids.cleanup_value(re.sub(f'^{sesprefix}', '', newsubsesid[1]))
+                    else:
+                        warnings.warn(f"Skipping renaming of {session} because the dicom-field '{dcmval}' could not be parsed into [subid, sesid]")
+                        continue
+                    if newsesid==sesprefix or newsesid==subprefix+'None':
+                        newsesid = sesid
+                        warnings.warn(f"Could not rename {sesid} because the dicom-field was empty for: {session}")
+
+                # Save the dicomfield / sub-ses mapping in the mapper logfile and rename the session subfolder (but skip if it already exists)
+                newsession = rawfolder/newsubid/newsesid
+                print(f"{session} -> {newsession}")
+                if newsession == session:
                     continue
-                if newsesid==sesprefix or newsesid==subprefix+'None':
-                    newsesid = sesid
-                    warnings.warn(f"Could not rename {sesid} because the dicom-field was empty for: {session}")
-
-            # Save the dicomfield / sub-ses mapping in the mapper logfile and rename the session subfolder (but skip if it already exists)
-            newsession = rawfolder/newsubid/newsesid
-            print(f"{session} -> {newsession}")
-            if newsession == session:
-                continue
-            if newsession.is_dir():
-                warnings.warn(f"{newsession} already exists, skipping renaming of {session}")
-            elif not dryrun:
-                with mapperfile.open('a') as fid:
-                    fid.write(f"{subid}\t{sesid}\t{newsubid}\t{newsesid}\n")
-                if sesid and newsesid != sesid:
-                    (rawfolder/subid/sesid).rename(rawfolder/subid/newsesid)
-                if newsubid != subid:
-                    (rawfolder/subid).rename(rawfolder/newsubid)
-
-        # Print & save the dicom values in the mapper logfile
-        else:
-            print('{}/{}/{}\t-> {}'.format(subid, sesid, series.name, '\t'.join(dcmval.split('/'))))
-            if not dryrun:
-                with mapperfile.open('a') as fid:
-                    fid.write('{}\t{}\t{}\t{}\n'.format(subid, sesid, series.name, '\t'.join(dcmval.split('/'))))
+                if newsession.is_dir():
+                    warnings.warn(f"{newsession} already exists, skipping renaming of {session}")
+                elif not dryrun:
+                    with mapperfile.open('a') as fid:
+                        fid.write(f"{subid}\t{sesid}\t{newsubid}\t{newsesid}\n")
+                    if sesid and newsesid != sesid:
+                        (rawfolder/subid/sesid).rename(rawfolder/subid/newsesid)
+                    if newsubid != subid:
+                        (rawfolder/subid).rename(rawfolder/newsubid)
+
+            # Print & save the dicom values in the mapper logfile
+            else:
+                print('{}/{}/{}\t-> {}'.format(subid, sesid, series.name, '\t'.join(dcmval.split('/'))))
+                if not dryrun:
+                    with mapperfile.open('a') as fid:
+                        fid.write('{}\t{}\t{}\t{}\n'.format(subid, sesid, series.name, '\t'.join(dcmval.split('/'))))
+
+    finally:
+        if headerindex:
+            bids.close_headerindex()
 
 
 def main():
@@ -156,18 +164,20 @@ def main():
     parser.add_argument('-r','--rename',     help='If this flag is given sub-subid/ses-sesid directories in the sourcefolder will be renamed to sub-dcmval/ses-dcmval', action='store_true')
     parser.add_argument('-n','--subprefix',  help='The prefix common for all the source subject-folders', default='sub-')
     parser.add_argument('-m','--sesprefix',  help='The prefix common for all the source session-folders', default='ses-')
+    parser.add_argument('-i','--headerindex', help='The persistent header index (e.g. bidsfolder/code/bidscoin/headerindex.db, see the headerindex tool) that is used to look up the dicomfields')
     parser.add_argument('--dryrun',          help='Add this flag to dryrun (test) the mapping or renaming of the sub-subid/ses-sesid directories (i.e. nothing is stored on disk and directory names are not actually changed))', action='store_true')
     args = parser.parse_args()
 
-    rawmapper(rawfolder  = args.sourcefolder,
-              outfolder  = args.outfolder,
-              sessions   = args.sessions,
-              rename     = args.rename,
-              dicomfield = args.dicomfield,
-              wildcard   = args.wildcard,
-              subprefix  = args.subprefix,
-              sesprefix  = args.sesprefix,
-              dryrun     = args.dryrun)
+    rawmapper(rawfolder   = args.sourcefolder,
+              outfolder   = args.outfolder,
+              sessions    = args.sessions,
+              rename      = args.rename,
+              dicomfield  = args.dicomfield,
+              wildcard    = args.wildcard,
+              subprefix   = args.subprefix,
+              sesprefix   = args.sesprefix,
+              dryrun      = args.dryrun,
+              headerindex = args.headerindex)
 
 
 if __name__ == "__main__":
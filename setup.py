@@ -32,6 +32,7 @@ setup(name                           = 'bidscoin',          # Required
                                                             'echocombine      = bidscoin.echocombine:main',
                                                             'deface           = bidscoin.deface:main',
                                                             'bidsparticipants = bidscoin.bidsparticipants:main',
+                                                            'headerindex      = bidscoin.headerindex:main',
                                                             'pulltutorialdata = bidscoin.pulltutorialdata:main']},
       classifiers                    = ['Programming Language :: Python :: 3',
                                         'License :: OSI Approved :: GNU General Public License v3 (GPLv3)',
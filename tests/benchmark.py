@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""
+Reports the wall-clock timings of the performance critical parts of BIDScoin. The timings depend on the machine and
+its load, so they are not part of the unit tests. Usage (from the repository root):
+
+    python -m tests.benchmark
+"""
+
+import re
+import sys
+import subprocess
+import tempfile
+import timeit
+from pathlib import Path
+
+from bidscoin import bids
+from tests.helpers import make_dicomfile
+from tests.test_importtime import get_consolescripts
+from tests.test_matching import SERIES
+
+
+def importtime(module: str) -> float:
+    """
+    Imports the module in a fresh interpreter with '-X importtime'
+
+    :param module:  The name of the module, e.g. 'bidscoin.bidscoiner'
+    :return:        The cumulative import time in seconds, or None if the module could not be imported
+    """
+
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {module}"], cwd=Path(__file__).parents[1],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    timing  = re.findall(r'import time:\s+\d+ \|\s+(\d+) \|( *)([\w.]+)', process.stderr)
+
+    return sum(int(cumulative) for cumulative, indent, _ in timing if len(indent) == 1) / 1e6 if process.returncode == 0 else None     # The sum of the top-level imports
+
+
+def bench_importtime() -> None:
+    for script, module in get_consolescripts().items():
+        elapsed = importtime(module)
+        print(f"Importing {module}: " + (f"{elapsed:.3f}s" if elapsed is not None else 'failed'))
+
+
+def bench_matching() -> None:
+    bidsmap, _ = bids.load_bidsmap(Path('bidsmap_dccn.yaml'), Path(), report=False)
+    values     = [attrvalue for modality in bids.bidsmodalities + (bids.unknownmodality, bids.ignoremodality)
+                            for run in bidsmap['DICOM'][modality] or []
+                            for attrvalue in run['attributes'].values() if attrvalue]
+    sources    = ['', 2, '[1, 2]', 'my_pulse_sequence_name', 'T1_MPRAGE', 't1_mprage', 'ep2d_bold_moco', "['ORIGINAL', 'PRIMARY', 'M', 'ND']"]
+    elapsed    = timeit.timeit(lambda: [bids.match_attribute(source, value) for source in sources for value in values], number=5)
+    print(f"Matching {len(sources)} x {len(values)} attributes (5x): {elapsed:.3f}s")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dicomfiles  = [make_dicomfile(Path(tmpdir)/f"{seriesdescr}.dcm", seriesnr=n, seriesdescr=seriesdescr) for n, seriesdescr in enumerate(SERIES, 1)]
+        runindex    = bids.get_runindex(bidsmap, 'DICOM', (bids.ignoremodality,) + bids.bidsmodalities + (bids.unknownmodality,))
+        sourcetable = bids.get_sourcetable(dicomfiles, runindex.tagnames, 'DICOM')
+        largetable  = sourcetable.iloc[[n % len(dicomfiles) for n in range(20000)]]
+        elapsed     = timeit.timeit(lambda: bids.match_sourcetable(largetable, bidsmap, 'DICOM'), number=1)
+        print(f"Matching {len(largetable)} series: {elapsed:.3f}s")
+
+
+if __name__ == '__main__':
+    bench_importtime()
+    bench_matching()
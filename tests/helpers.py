@@ -0,0 +1,49 @@
+"""Shared fixtures of the BIDScoin unit tests"""
+
+import unittest
+import tempfile
+from pathlib import Path
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+
+def make_dicomfile(dicomfile: Path, seriesnr: int=1, seriesdescr: str='t1_mprage', instancenr: int=1) -> Path:
+    """Writes a small (Siemens-like) MR DICOM file with pixel data"""
+
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID    = '1.2.840.10008.5.1.4.1.1.4'
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID          = ExplicitVRLittleEndian
+
+    dataset = FileDataset(str(dicomfile), {}, file_meta=meta, preamble=b'\0'*128)
+    dataset.is_little_endian  = True
+    dataset.is_implicit_VR    = False
+    dataset.Modality          = 'MR'
+    dataset.Manufacturer      = 'SIEMENS'
+    dataset.PatientName       = 'Doe^John'
+    dataset.PatientAge        = '030Y'
+    dataset.SeriesNumber      = seriesnr
+    dataset.SeriesDescription = seriesdescr
+    dataset.ProtocolName      = seriesdescr
+    dataset.AcquisitionNumber = 1
+    dataset.InstanceNumber    = instancenr
+    dataset.MRAcquisitionType = '3D'
+    dataset.EchoTime          = 2.98
+    dataset.add_new(0x00291020, 'OB', b'\0'*40000 + b'### ASCCONV BEGIN ###\nsKSpace.lBaseResolution\t = \t256\n### ASCCONV END ###\n')
+    dataset.Rows = dataset.Columns = 128
+    dataset.BitsAllocated     = 16
+    dataset.PixelData         = bytes(2*128*128)
+
+    dicomfile.parent.mkdir(parents=True, exist_ok=True)
+    dataset.save_as(str(dicomfile), write_like_original=False)
+
+    return dicomfile
+
+
+class TmpdirTestCase(unittest.TestCase):
+    """A test case that gives each test a fresh temporary directory (self.tmpdir) that is removed afterwards"""
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmpdir = Path(tmpdir.name)
@@ -1,7 +1,20 @@
 import unittest
+import io
 import os
+import shutil
+import tarfile
+import zipfile
+from unittest import mock
+from pathlib import Path
+from pydicom.dataset import Dataset
+from pydicom.sequence import Sequence
+from pydicom.filebase import DicomFileLike
+from pydicom.filewriter import write_dataset
+from pydicom.uid import generate_uid
 
+from bidscoin import bids
 from bidscoin.bids import bidsversion, version
+from tests.helpers import TmpdirTestCase, make_dicomfile
 
 
 class TestBids(unittest.TestCase):
@@ -19,5 +32,398 @@ class TestBids(unittest.TestCase):
         self.assertEqual(bids_v, bids_v_from_file)
 
 
+class TestBidsmapSnapshot(TmpdirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.yamlfile = self.tmpdir/'bidsmap.yaml'
+        shutil.copyfile(bids.heuristics_folder/'bidsmap_dccn.yaml', self.yamlfile)
+        patcher = mock.patch.object(bids, 'snapshotfolder', self.tmpdir/'cache')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_load_bidsmap(self):
+        bidsmap, _   = bids.load_bidsmap(self.yamlfile, report=False)
+        snapshot, _  = bids.load_bidsmap(self.yamlfile, report=False, roundtrip=False)
+        snapshotfile = bids.get_snapshotfile(self.yamlfile)
+        self.assertEqual(snapshot, bidsmap)
+        self.assertIs(type(snapshot['DICOM']['anat'][0]['attributes']), dict)
+        self.assertEqual(snapshotfile.parent, self.tmpdir/'cache')
+        self.assertEqual(sorted(self.tmpdir.iterdir()), [self.tmpdir/'bidsmap.yaml', self.tmpdir/'cache'])      # Nothing is written next to the yaml-file
+        stamp = snapshotfile.stat().st_mtime_ns
+        self.assertEqual(bids.load_bidsmap(self.yamlfile, report=False, roundtrip=False)[0], snapshot)
+        self.assertEqual(snapshotfile.stat().st_mtime_ns, stamp)                # The snapshot is reused
+
+    def test_template(self):
+        heuristics = sorted(bids.heuristics_folder.iterdir())
+        bids.load_bidsmap(bids.heuristics_folder/'bidsmap_dccn.yaml', report=False, roundtrip=False)
+        self.assertEqual(sorted(bids.heuristics_folder.iterdir()), heuristics)  # Nothing is written in the (installed) heuristics folder
+        self.assertTrue(bids.get_snapshotfile(bids.heuristics_folder/'bidsmap_dccn.yaml').is_file())
+
+    def test_invalidation(self):
+        bids.load_bidsmap(self.yamlfile, report=False, roundtrip=False)
+        snapshotfile = bids.get_snapshotfile(self.yamlfile)
+        self.yamlfile.write_text(self.yamlfile.read_text().replace('args: -b y -z y -i n', 'args: -b y -z n -i n', 1))
+        bidsmap, _ = bids.load_bidsmap(self.yamlfile, report=False, roundtrip=False)
+        self.assertEqual(bidsmap['Options']['dcm2niix']['args'], '-b y -z n -i n')
+        self.assertNotEqual(bids.get_snapshotfile(self.yamlfile), snapshotfile)
+        with mock.patch.object(bids, 'version', return_value='0.0.0'):
+            self.assertFalse(bids.get_snapshotfile(self.yamlfile).is_file())
+            bids.load_bidsmap(self.yamlfile, report=False, roundtrip=False)
+            self.assertTrue(bids.get_snapshotfile(self.yamlfile).is_file())
+
+    def test_corrupt(self):
+        bidsmap, _ = bids.load_bidsmap(self.yamlfile, report=False, roundtrip=False)
+        bids.get_snapshotfile(self.yamlfile).write_bytes(b'\x80\x04corrupt')
+        self.assertEqual(bids.load_bidsmap(self.yamlfile, report=False, roundtrip=False)[0], bidsmap)
+        self.assertEqual(bids.load_bidsmapsnapshot(self.yamlfile), bids.plain_bidsmap(bids.get_yaml().load(self.yamlfile.read_text())))
+
+    def test_cleanup(self):
+        with mock.patch.object(bids, 'SNAPSHOT_FILES', 2):
+            for n in range(4):
+                self.yamlfile.write_text(self.yamlfile.read_text() + f"\n# Edit {n}\n")
+                bids.load_bidsmap(self.yamlfile, report=False, roundtrip=False)
+        self.assertEqual(len(list((self.tmpdir/'cache').iterdir())), 2)
+        self.assertTrue(bids.get_snapshotfile(self.yamlfile).is_file())
+
+    def test_save_bidsmap(self):
+        bidsmap, _ = bids.load_bidsmap(self.yamlfile, report=False)
+        bidsmap['Options']['bidscoin']['version'] = 'saved'
+        self.assertTrue(bids.save_bidsmap(self.yamlfile, bidsmap))
+        self.assertEqual(bids.load_bidsmap(self.yamlfile, report=False)[0], bidsmap)
+        bidsmap['Options']['bidscoin']['version'] = object()                   # Cannot be serialized -> the bidsmap file is left as is
+        with self.assertLogs('bidscoin', 'ERROR'):
+            self.assertFalse(bids.save_bidsmap(self.yamlfile, bidsmap))
+        self.assertEqual(bids.load_bidsmap(self.yamlfile, report=False)[0]['Options']['bidscoin']['version'], 'saved')
+        self.assertEqual([path.name for path in self.yamlfile.parent.iterdir()], [self.yamlfile.name])         # No temporary files are left behind
+
+
+class TestDicomHeader(TmpdirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.dicomfile = make_dicomfile(self.tmpdir/'sub-01'/'ses-01'/'001-t1_mprage'/'IM_0001.dcm')
+
+    def test_read_dicomfile(self):
+        self.assertNotIn('PixelData', bids.read_dicomfile(self.dicomfile))
+        self.assertIn('PixelData', bids.read_dicomfile(self.dicomfile, pixeldata=True))
+        self.assertNotIn('EchoTime', bids.read_dicomfile(self.dicomfile, tags=('SeriesDescription',)))
+
+    def test_get_dicomfield(self):
+        self.assertEqual(bids.get_dicomfield('SeriesDescription', self.dicomfile), 't1_mprage')
+        self.assertEqual(bids.get_dicomfield('SeriesNumber', self.dicomfile), 1)
+
+    def test_restricted_read(self):
+        bids.get_dicomfields(['SeriesDescription', 'SeriesNumber'], self.dicomfile, restrict=True)
+        self.assertEqual(bids.headercache.get(self.dicomfile)['tags'], ('SeriesDescription', 'SeriesNumber'))
+        self.assertEqual(bids.get_dicomfield('SeriesDescription', self.dicomfile), 't1_mprage')
+        self.assertEqual(bids.get_dicomfield('EchoTime', self.dicomfile), '2.98')          # Re-reads the full header
+        self.assertEqual(bids.headercache.get(self.dicomfile)['tags'], ())
+
+    def test_restricted_read_absent(self):
+        with mock.patch.object(bids, 'read_dicomfile', wraps=bids.read_dicomfile) as read_dicomfile:
+            fields = bids.get_dicomfields(['SeriesDescription', 'PhaseEncodingDirection'], self.dicomfile, restrict=True)
+            self.assertEqual(fields, {'SeriesDescription': 't1_mprage', 'PhaseEncodingDirection': ''})
+            self.assertEqual(bids.get_dicomfield('PhaseEncodingDirection', self.dicomfile), '')
+            self.assertEqual(read_dicomfile.call_count, 1)                  # The absent keyword does not trigger a full read
+
+    def test_restricted_read_fallback(self):
+        dataset = bids.read_dicomfile(self.dicomfile, pixeldata=True)
+        echo    = Dataset()
+        echo.EchoTime = dataset.EchoTime
+        group   = Dataset()
+        group.MREchoSequence = Sequence([echo])
+        dataset.SharedFunctionalGroupsSequence = Sequence([group])     # Enhanced DICOM, where the EchoTime is nested in the functional groups
+        del dataset.EchoTime
+        dataset.save_as(str(self.dicomfile), write_like_original=False)
+        fields = bids.get_dicomfields(['EchoTime', "Patient's Name"], self.dicomfile, restrict=True)
+        self.assertEqual(fields, {'EchoTime': '2.98', "Patient's Name": 'Doe^John'})
+        bids.headercache.discard(self.dicomfile)
+        self.assertEqual(bids.get_dicomfields(['EchoTime', 'SeriesNumber'], self.dicomfile, restrict=True)['EchoTime'], '2.98')
+
+    def test_fieldindex(self):
+        self.assertEqual(bids.get_dicomfield("Patient's Name", self.dicomfile), 'Doe^John')
+        self.assertEqual(bids.get_dicomfield('PhaseEncodingDirection', self.dicomfile), '')
+        header = bids.headercache.get(self.dicomfile)
+        self.assertIn('PhaseEncodingDirection', header['fields'])       # Negative caching of the missing field
+        self.assertIn("Patient's Name", header['names'])
+
+    def test_nested_fields(self):
+        dataset = bids.read_dicomfile(self.dicomfile, pixeldata=True)
+        item    = Dataset()
+        item.ProtocolName    = 'nested_protocol'
+        item.ImageComments   = 'nested_comments'
+        dataset.ReferencedImageSequence = Sequence([item])          # NB: The sequence comes before the top-level ProtocolName
+        dataset.save_as(str(self.dicomfile), write_like_original=False)
+        self.assertEqual(bids.get_dicomfield('Protocol Name', self.dicomfile), 't1_mprage')     # The top-level element is not shadowed
+        self.assertEqual(bids.get_dicomfield('ProtocolName', self.dicomfile), 't1_mprage')
+        self.assertEqual(bids.get_dicomfield('ImageComments', self.dicomfile), 'nested_comments')
+
+    def test_get_sourcefields(self):
+        tagnames = ['SeriesDescription', 'SeriesNumber', 'EchoTime', 'PhaseEncodingDirection', 'sKSpace.lBaseResolution']
+        fields   = bids.get_sourcefields(tagnames, self.dicomfile)
+        self.assertEqual(list(fields), tagnames)
+        self.assertEqual(fields, {tagname: bids.get_sourcefield(tagname, self.dicomfile) for tagname in tagnames})
+        self.assertEqual(bids.get_sourcefields(tagnames, Path(), 'DICOM'), dict.fromkeys(tagnames, ''))
+
+    def test_get_matching_run(self):
+        bidsmap, _           = bids.load_bidsmap(Path('bidsmap_dccn.yaml'), Path(), report=False)
+        run, modality, index = bids.get_matching_run(self.dicomfile, bidsmap, 'DICOM')
+        self.assertEqual((modality, index), ('anat', 1))
+        self.assertEqual(run['bids']['suffix'], 'T1w')
+        self.assertEqual(run['attributes']['SeriesDescription'], 't1_mprage')
+        self.assertEqual(run['provenance'], str(self.dicomfile.resolve()))
+        sourcefields = bids.get_dicomfields(bids.get_bidsmaptags(bidsmap, 'DICOM'), self.dicomfile, restrict=True)
+        with mock.patch.object(bids, 'get_sourcefields') as get_sourcefields:
+            self.assertEqual(bids.get_matching_run(self.dicomfile, bidsmap, 'DICOM', sourcefields=sourcefields), (run, modality, index))
+            get_sourcefields.assert_not_called()                            # The prefetched fields are used
+
+    def test_x_protocol(self):
+        self.assertTrue(bids.is_dicomfile_siemens(self.dicomfile))
+        self.assertEqual(bids.read_x_protocol(self.dicomfile), {'sKSpace.lBaseResolution': '256'})
+        self.assertEqual(bids.parse_x_protocol('sKSpace.lBaseResolution', self.dicomfile), '256')
+        self.assertEqual(bids.parse_x_protocol(r'sKSpace\.lBase.*', self.dicomfile), '256')
+        self.assertIsNone(bids.parse_x_protocol('sKSpace.lImagesPerSlab', self.dicomfile))
+        self.assertIsNotNone(bids.protocolcache.get(self.dicomfile))
+
+    def test_classification(self):
+        textfile = self.dicomfile.with_name('README.txt')
+        textfile.write_text('Not a DICOM file\n' * 20)
+        self.assertTrue(bids.is_dicomfile(self.dicomfile))
+        self.assertFalse(bids.is_dicomfile(textfile))
+        self.assertFalse(bids.classcache.get(textfile))                 # The verdict is memoized
+        textfile.write_bytes(self.dicomfile.read_bytes()[0x84:])        # An anonymized DICOM file without preamble (the file stamp changes)
+        self.assertTrue(bids.is_dicomfile(textfile))
+        for implicit in (True, False):                                  # Preamble-less DICOM files that start with a group 0010 element
+            dataset = Dataset()
+            dataset.PatientName       = 'Doe^John'
+            dataset.SeriesInstanceUID = generate_uid()
+            dataset.SeriesNumber      = 3
+            dataset.is_little_endian  = True
+            dataset.is_implicit_VR    = implicit
+            rawfile = self.dicomfile.with_name(f"IM_implicit{implicit}")
+            with rawfile.open('wb') as fid:
+                write_dataset(DicomFileLike(fid), dataset)
+            self.assertEqual(rawfile.read_bytes()[0:2], b'\x10\x00')
+            self.assertTrue(bids.is_dicomfile(rawfile))
+            self.assertEqual(bids.get_dicomfield('SeriesNumber', rawfile), 3)
+        session = self.dicomfile.parents[1]
+        self.assertEqual(bids.get_dataformat(session), 'DICOM')
+        self.assertEqual(bids.formatcache.get(session), 'DICOM')
+
+
+class TestHeaderCache(TmpdirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.files = []
+        for n in range(3):
+            self.files.append(self.tmpdir/f"file{n}")
+            self.files[n].write_text(str(n))
+
+    def test_lru_eviction(self):
+        cache = bids.HeaderCache(maxentries=2, maxbytes=100)
+        cache.put(self.files[0], 'header0', 10)
+        cache.put(self.files[1], 'header1', 10)
+        self.assertEqual(cache.get(self.files[0]), 'header0')      # file0 is now the most recently used
+        cache.put(self.files[2], 'header2', 10)
+        self.assertIsNone(cache.get(self.files[1]))
+        self.assertEqual(cache.get(self.files[0]), 'header0')
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (2, 1, 1))
+        cache.put(self.files[1], 'header1', 95)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.nbytes, 95)
+
+    def test_invalidation(self):
+        cache = bids.HeaderCache()
+        cache.put(self.files[0], 'header0', 1)
+        self.files[0].write_text('changed')
+        self.assertIsNone(cache.get(self.files[0]))
+
+
+class TestDirCache(TmpdirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.session = self.tmpdir/'sub-01'/'ses-01'
+        for n in range(1, 4):
+            make_dicomfile(self.session/'001-t1_mprage'/f"IM_000{n}.dcm", instancenr=n)
+        (self.session/'002-rest').mkdir()
+        (self.session/'.hidden').mkdir()
+        (self.session/'scan.PAR').write_text('')
+
+    def test_lsdirs(self):
+        self.assertEqual(bids.lsdirs(self.session), sorted(path for path in self.session.glob('*') if path.is_dir()))
+        self.assertEqual(bids.lsdirs(self.session, '00[2]*'), [self.session/'002-rest'])
+        self.assertEqual(bids.get_parfiles(self.session), [self.session/'scan.PAR'])
+        scandirs = bids.dircache.scandirs
+        bids.lsdirs(self.session)
+        self.assertEqual(bids.dircache.scandirs, scandirs)                  # The snapshot is reused
+        (self.session/'003-dwi').mkdir()
+        self.assertIn(self.session/'003-dwi', bids.lsdirs(self.session))
+
+    def test_get_dicomfile(self):
+        series = self.session/'001-t1_mprage'
+        for n in range(3):
+            self.assertEqual(bids.get_dicomfile(series, n), series/f"IM_000{n+1}.dcm")
+        self.assertEqual(bids.get_dicomfile(series, 3), Path())
+        self.assertEqual(bids.get_dicomfile(self.session/'002-rest'), Path())
+
+
+class TestUnpack(TmpdirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.session = self.tmpdir/'raw'/'sub-01'/'ses-01'
+        packfolder   = self.tmpdir/'pack'
+        make_dicomfile(self.session/'IM_0001.dcm', seriesnr=1, seriesdescr='t1_mprage')
+        make_dicomfile(packfolder/'IM_0001.dcm', seriesnr=2, seriesdescr='ep2d_bold')                     # NB: The same name as the loose file
+        make_dicomfile(packfolder/'003-dwi'/'IM_0001.dcm', seriesnr=3, seriesdescr='dwi')
+        with zipfile.ZipFile(self.session/'bold.zip', 'w') as zip_fid:
+            zip_fid.write(packfolder/'IM_0001.dcm', 'IM_0001.dcm')
+        with tarfile.open(self.session/'dwi.tar.gz', 'w:gz') as tar_fid:
+            tar_fid.add(packfolder/'003-dwi', '003-dwi')
+        self.source = {path: path.read_bytes() for path in self.session.rglob('*') if path.is_file()}
+
+    def test_unpack(self):
+        for staging in ('link', 'copy'):
+            with self.subTest(staging=staging):
+                workfolder = self.tmpdir/staging
+                worksubses, unpacked = bids.unpack(self.session, workfolder=workfolder, staging=staging)
+                self.assertEqual(unpacked, workfolder)
+                self.assertEqual(worksubses, workfolder/'sub-01'/'ses-01')
+                self.assertEqual(sorted(path.name for path in bids.lsdirs(worksubses)), ['001-t1_mprage', '002-ep2d_bold', '003-dwi'])
+                for seriesdir in bids.lsdirs(worksubses):
+                    self.assertEqual(bids.get_dicomfield('SeriesNumber', bids.get_dicomfile(seriesdir)), int(seriesdir.name[0:3]))
+                shutil.rmtree(worksubses)
+                self.assertEqual({path: path.read_bytes() for path in self.session.rglob('*') if path.is_file()}, self.source)     # The source data is left untouched
+
+    def test_parallel(self):
+        for n in range(2, 5):
+            packfolder = self.tmpdir/f"pack{n}"
+            make_dicomfile(packfolder/'IM_0001.dcm', seriesnr=n+2, seriesdescr='ep2d_bold')
+            make_dicomfile(packfolder/'IM_0002.dcm', seriesnr=n+2, seriesdescr='ep2d_bold', instancenr=2)
+            with zipfile.ZipFile(self.session/f"run{n}.zip", 'w') as zip_fid:
+                for dicomfile in packfolder.iterdir():
+                    zip_fid.write(dicomfile, dicomfile.name)
+        listings = []
+        for workers in (1, 4):
+            scratchdir = self.tmpdir/f"scratch{workers}"
+            scratchdir.mkdir()
+            with mock.patch.object(bids, 'ZIP_CHUNKSIZE', 1):       # Extract the members of the zip-files in parallel
+                worksubses, unpacked = bids.unpack(self.session, scratchdir=scratchdir, workers=workers)
+            self.assertEqual(unpacked.parent, scratchdir)
+            self.assertEqual(sorted(path.name for path in bids.lsdirs(worksubses)), ['001-t1_mprage', '002-ep2d_bold', '003-dwi', '004-ep2d_bold', '005-ep2d_bold', '006-ep2d_bold'])
+            listings.append(sorted(str(path.relative_to(worksubses)) for path in worksubses.rglob('*')))
+        self.assertEqual(listings[0], listings[1])
+
+    def test_unsafe_tar(self):
+        archive = self.tmpdir/'unsafe.tar'
+        with tarfile.open(archive, 'w') as tar_fid:
+            for name, linkname in (('IM_0001.dcm', ''), ('../escape.dcm', ''), (str(self.tmpdir/'absolute.dcm'), ''), ('link', '../../escape'), ('hardlink', '../escape.dcm')):
+                member = tarfile.TarInfo(name)
+                if name == 'link':
+                    member.type, member.linkname = tarfile.SYMTYPE, linkname
+                elif name == 'hardlink':
+                    member.type, member.linkname = tarfile.LNKTYPE, linkname
+                else:
+                    member.size = 4
+                tar_fid.addfile(member, io.BytesIO(b'DICM') if member.isfile() else None)
+        folder = self.tmpdir/'extract'
+        folder.mkdir()
+        with self.assertLogs('bidscoin', 'WARNING') as logs:
+            extractfolders, extractedbytes = bids.extract_archives([archive], folder)
+        self.assertEqual([path.name for path in extractfolders[0].iterdir()], ['IM_0001.dcm'])
+        self.assertEqual(extractedbytes, 4)
+        self.assertEqual(len(logs.output), 4)
+        self.assertFalse((self.tmpdir/'escape.dcm').exists())
+        self.assertFalse((self.tmpdir/'absolute.dcm').exists())
+
+    def test_stage_folder(self):
+        stagefolder = self.tmpdir/'stage'
+        nfiles, byteswritten, sourcebytes = bids.stage_folder(self.session, stagefolder, 'link')
+        self.assertEqual(nfiles, 3)
+        self.assertEqual(sourcebytes, sum(len(data) for data in self.source.values()))
+        self.assertEqual(byteswritten, 0)                       # Everything is hard- or symlinked on the same file system
+        for sourcefile in self.source:
+            self.assertTrue(os.path.samefile(sourcefile, stagefolder/sourcefile.relative_to(self.session)))
+
+
+class TestArchiveTree(TmpdirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.session = self.tmpdir/'raw'/'sub-01'/'ses-01'
+        self.session.mkdir(parents=True)
+        packfolder   = self.tmpdir/'pack'
+        for n in (3, 1, 2):
+            make_dicomfile(packfolder/f"IM_000{n}.dcm", seriesnr=2, seriesdescr='ep2d_bold', instancenr=n)
+            make_dicomfile(packfolder/'003-dwi'/f"IM_000{n}.dcm", seriesnr=3, seriesdescr='dwi', instancenr=n)
+        with zipfile.ZipFile(self.session/'bold.zip', 'w', zipfile.ZIP_DEFLATED) as zip_fid:
+            for n in (3, 1, 2):
+                zip_fid.write(packfolder/f"IM_000{n}.dcm", f"IM_000{n}.dcm")
+        with tarfile.open(self.session/'dwi.tar.gz', 'w:gz') as tar_fid:
+            tar_fid.add(packfolder/'003-dwi', '003-dwi')
+
+    def tearDown(self):
+        bids.archivetree.unmount(self.session)
+
+    def test_mount(self):
+        session, unpacked = bids.unpack(self.session, virtual=True)
+        self.assertEqual((session, unpacked), (self.session, False))
+        self.assertTrue(bids.archivetree.is_mounted(self.session))
+        self.assertEqual(sorted(self.session.iterdir()), [self.session/'bold.zip', self.session/'dwi.tar.gz'])      # Nothing is extracted
+        self.assertEqual(bids.lsdirs(self.session), [self.session/'002-ep2d_bold', self.session/'003-dwi'])
+        self.assertEqual(bids.get_dataformat(self.session), 'DICOM')
+        for seriesdir in bids.lsdirs(self.session):
+            for n in range(3):
+                dicomfile = bids.get_dicomfile(seriesdir, n)
+                self.assertEqual(dicomfile, seriesdir/f"IM_000{n+1}.dcm")
+                self.assertTrue(bids.is_dicomfile(dicomfile))
+                self.assertEqual(bids.get_dicomfields(('SeriesNumber', 'InstanceNumber'), dicomfile), {'SeriesNumber': int(seriesdir.name[0:3]), 'InstanceNumber': n+1})
+                self.assertEqual(bids.read_x_protocol(dicomfile), {'sKSpace.lBaseResolution': '256'})
+            self.assertEqual(bids.get_dicomfile(seriesdir, 3), Path())
+
+        # Extract a provenance sample and clean up
+        dicomfile  = bids.get_dicomfile(self.session/'003-dwi', 1)
+        targetfile = bids.archivetree.extract(dicomfile, self.tmpdir/'IM_0002.dcm')
+        self.assertEqual(targetfile.read_bytes(), (self.tmpdir/'pack'/'003-dwi'/'IM_0002.dcm').read_bytes())
+        bids.archivetree.unmount(self.session)
+        self.assertEqual(bids.lsdirs(self.session), [])
+        self.assertIsNone(bids.archivetree.get(dicomfile))
+
+    def test_read(self):
+        packfolder = self.tmpdir/'pack'/'004-func'
+        for n in range(1, 9):
+            make_dicomfile(packfolder/f"IM_000{n}.dcm", seriesnr=4, seriesdescr='func', instancenr=n)
+        with tarfile.open(self.session/'func.tar.gz', 'w:gz') as tar_fid:
+            tar_fid.add(packfolder, '004-func')
+        bids.unpack(self.session, virtual=True)
+        dicomfiles = [self.session/'004-func'/f"IM_000{n}.dcm" for n in range(1, 9)]
+        totalsize  = sum(dicomfile.stat().st_size for dicomfile in packfolder.iterdir())
+
+        # Reading the members in archive order takes a single pass over the tarball
+        bytesread = bids.archivetree.bytesread
+        for dicomfile in dicomfiles:
+            self.assertEqual(bids.get_dicomfield('InstanceNumber', dicomfile), int(dicomfile.stem[-1]))
+        self.assertLessEqual(bids.archivetree.bytesread - bytesread, totalsize)
+        self.assertEqual(bids.archivetree.extract(dicomfiles[-1], self.tmpdir/'IM_0008.dcm').read_bytes(), (packfolder/'IM_0008.dcm').read_bytes())
+
+        # Reading the members in reverse order restarts the stream for every member
+        bytesread = bids.archivetree.bytesread
+        for dicomfile in reversed(dicomfiles[1:]):
+            bids.archivetree.read(dicomfile)
+        self.assertGreater(bids.archivetree.bytesread - bytesread, 3 * totalsize)
+
+    def test_fallback(self):
+        with zipfile.ZipFile(self.session/'bold.zip', 'a') as zip_fid:
+            zip_fid.writestr('scan.PAR', '')
+        workfolder        = self.tmpdir/'work'
+        session, unpacked = bids.unpack(self.session, workfolder=workfolder, virtual=True)
+        self.assertEqual(unpacked, workfolder)                  # Non-DICOM archives are unpacked as usual
+        self.assertFalse(bids.archivetree.is_mounted(self.session))
+        self.assertEqual(bids.lsdirs(session), [session/'002-ep2d_bold', session/'003-dwi'])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+import sys
+import subprocess
+import tarfile
+from unittest import mock
+from pathlib import Path
+
+from tests.helpers import TmpdirTestCase, make_dicomfile
+
+
+class TestBidsmapper(TmpdirTestCase):
+
+    def test_headless(self):
+        """The non-interactive bidsmapper must not import (or initialize) Qt"""
+
+        rawfolder  = self.tmpdir/'raw'
+        bidsfolder = self.tmpdir/'bids'
+        for seriesnr, seriesdescr in enumerate(('t1_mprage', 'ep2d_bold'), 1):
+            make_dicomfile(rawfolder/'sub-01'/'ses-01'/f"00{seriesnr}-{seriesdescr}"/'IM_0001.dcm', seriesnr=seriesnr, seriesdescr=seriesdescr)
+
+        code    = ('import sys\n'
+                   'from bidscoin import bidsmapper\n'
+                   f"bidsmapper.bidsmapper('{rawfolder.as_posix()}', '{bidsfolder.as_posix()}', 'bidsmap.yaml', 'bidsmap_dccn.yaml', interactive=0)\n"
+                   "print(sorted(module for module in sys.modules if module.split('.')[0] == 'PyQt5' or module.endswith('bidseditor')))")
+        process = subprocess.run([sys.executable, '-c', code], cwd=Path(__file__).parents[1], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(process.returncode, 0, process.stderr)
+        self.assertEqual(process.stdout.strip().splitlines()[-1], '[]')
+        self.assertTrue((bidsfolder/'code'/'bidscoin'/'bidsmap.yaml').is_file())
+
+    def test_archived(self):
+        """The bidsmapper reads the headers of archived DICOM data straight from the archives"""
+
+        from bidscoin import bids, bidsmapper
+
+        rawfolder  = self.tmpdir/'raw'
+        bidsfolder = self.tmpdir/'bids'
+        packfolder = self.tmpdir/'pack'
+        session    = rawfolder/'sub-01'/'ses-01'
+        session.mkdir(parents=True)
+        for seriesnr, seriesdescr in enumerate(('t1_mprage', 'ep2d_bold'), 1):
+            make_dicomfile(packfolder/f"00{seriesnr}-{seriesdescr}"/'IM_0001.dcm', seriesnr=seriesnr, seriesdescr=seriesdescr)
+        with tarfile.open(session/'dicoms.tar.gz', 'w:gz') as tar_fid:
+            tar_fid.add(packfolder, '.')
+
+        with mock.patch('tempfile.mkdtemp', side_effect=AssertionError('The archive must not be extracted')):
+            bidsmapper.bidsmapper(str(rawfolder), str(bidsfolder), 'bidsmap.yaml', 'bidsmap_dccn.yaml', interactive=0)
+        self.assertFalse(bids.archivetree.is_mounted(session))
+
+        bidsmap, _  = bids.load_bidsmap(bidsfolder/'code'/'bidscoin'/'bidsmap.yaml')
+        provenances = [run['provenance'] for modality in bids.bidsmodalities + (bids.unknownmodality, bids.ignoremodality) for run in bidsmap['DICOM'][modality] or []]
+        self.assertEqual(len(provenances), 2)
+        for provenance in provenances:
+            self.assertTrue(Path(provenance).is_file())    # The samples are extracted in the provenance store
+            self.assertTrue(bids.is_dicomfile(Path(provenance)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,202 @@
+import unittest
+import copy
+import os
+import time
+import threading
+import multiprocessing
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from bidscoin import bids
+from tests.helpers import TmpdirTestCase, make_dicomfile
+
+
+BIDSNAMES = [   # (subid, sesid, modality, provenance, run['bids'], runindex, bidsname). NB: The provenance file is sub-02/ses-03/001-t1_mprage/IM_0001.dcm with ProtocolName 't1 mprage_0' and InstanceNumber 1
+    ('sub-01', 'ses-01', 'anat', False, dict(acq='mprage', ce='gad', rec='norm', run='1', mod='flair', suffix='T1w'), '', 'sub-01_ses-01_acq-mprage_ce-gad_rec-norm_run-1_mod-flair_T1w'),
+    ('sub-01', '', 'anat', False, dict(acq='', ce=None, run='', suffix='T1w'), '', 'sub-01_T1w'),                                        # Empty values
+    ('sub-01', 'ses-01', 'anat', False, dict(acq='a.b-c d', suffix='T1w'), '2', 'sub-01_ses-01_acq-abcd_run-2_T1w'),                     # Cleaned-up value and runindex
+    ('<<SourceFilePath>>', '<<SourceFilePath>>', 'anat', True, dict(acq='<ProtocolName>', suffix='T1w'), '', 'sub-02_ses-03_acq-t1mprage0_T1w'),    # Dynamic values
+    ('<<SourceFilePath>>', '', 'anat', True, dict(acq='<ProtocolName>', run='<InstanceNumber>', suffix='T1w'), '', 'sub-02_acq-t1mprage0_run-1_T1w'),
+    ('sub-01', 'ses-01', 'anat', False, dict(run='<<1>>', suffix='T1w'), '', 'sub-01_ses-01_run-1_T1w'),
+    ('sub-01', 'ses-01', 'func', False, dict(task="Joe's reward_task", acq='mb', ce='', dir='AP', rec='', run=2, echo=1, suffix='bold'), '', 'sub-01_ses-01_task-Joesrewardtask_acq-mb_dir-AP_run-2_echo-1_bold'),   # Int values
+    ('sub-01', 'ses-01', 'func', False, dict(task='rest', run='1', suffix='sbref', mod='ignored'), '<<1>>', 'sub-01_ses-01_task-rest_run-<<1>>_sbref'),
+    ('sub-01', 'ses-01', 'dwi', False, dict(acq='b1000', dir='PA', run='', task='ignored', echo=2, suffix='dwi'), '3', 'sub-01_ses-01_acq-b1000_dir-PA_run-3_dwi'),
+    ('sub-01', '', 'fmap', False, dict(acq='gre', ce='', dir='AP', run=1, suffix='magnitude1'), '', 'sub-01_acq-gre_dir-AP_run-1_magnitude1'),
+    ('sub-01', 'ses-01', 'beh', False, dict(task='nback', acq='ignored', suffix='events'), '', 'sub-01_ses-01_task-nback_events'),
+    ('sub-01', 'ses-01', 'pet', False, dict(task='rest', acq='fdg', rec='ac', run='', suffix='pet'), '<<1>>', 'sub-01_ses-01_task-rest_acq-fdg_rec-ac_run-<<1>>_pet'),
+    ('sub-01', 'ses-01', 'extra_data', False, dict(task='rest', acq='localizer', ce='', rec='', dir='', run='', echo='', mod='', suffix='T2w'), '', 'sub-01_ses-01_task-rest_acq-localizer_T2w'),
+    ('sub-01', '', 'leave_out', False, dict(task='t', acq='scout', ce='c', rec='r', dir='d', run=1, echo=1, mod='m', suffix='SBRef'), '', 'sub-01_task-t_acq-scout_ce-c_rec-r_dir-d_run-1_echo-1_mod-m_SBRef')]
+
+
+BIDSVALUES = [  # (bidsfile, bidskey, newvalue, the parsed value or the updated bidsfile). NB: New values of keys that are not in the name are appended to the acq-value
+    ('sub-01_ses-01_task-rest_acq-mb_run-1_echo-2_bold', 'task',   '',           'rest'),
+    ('sub-01_ses-01_task-rest_acq-mb_run-1_echo-2_bold', 'echo',   '',           '2'),
+    ('sub-01_ses-01_task-rest_acq-mb_run-1_echo-2_bold', 'suffix', '',           'bold'),
+    ('sub-01_ses-01_task-rest_acq-mb_run-1_echo-2_bold', 'dir',    '',           ''),
+    ('sub-01_ses-01_task-rest_acq-mb_run-1_echo-2_bold', 'run',    '3',          'sub-01_ses-01_task-rest_acq-mb_run-3_echo-2_bold'),
+    ('sub-01_ses-01_task-rest_acq-mb_run-1_echo-2_bold', 'echo',   '[CE][0-9]*', 'sub-01_ses-01_task-rest_acq-mb_run-1_echo-[CE][0-9]*_bold'),
+    ('sub-01_ses-01_task-rest_acq-mb_run-1_echo-2_bold', 'dir',    'AP',         'sub-01_ses-01_task-rest_acq-mbAP_run-1_echo-2_bold'),
+    ('sub-01_ses-01_task-rest_acq-mb_run-1_echo-2_bold', 'acq',    'C1',         'sub-01_ses-01_task-rest_acq-C1_run-1_echo-2_bold'),
+    ('sub-01_T1w',                                       'suffix', '',           'T1w'),
+    ('sub-01_T1w',                                       'sub',    '',           '01'),
+    ('sub-01_T1w',                                       'ses',    '',           ''),
+    ('sub-01_T1w',                                       'run',    '2',          'sub-01_acq-2_T1w'),
+    ('sub-01_ses-01_T1w.nii',                            'suffix', 'T2w',        'sub-01_ses-01_T2w.nii'),
+    ('sub-01_ses-01_T1w.nii',                            'sub',    '02',         'sub-02_ses-01_T1w.nii'),
+    ('sub-01_ses-02_dir-AP_epi.nii.gz',                  'dir',    '',           'AP'),
+    ('sub-01_ses-02_dir-AP_epi.nii.gz',                  'dir',    'PA',         'sub-01_ses-02_dir-PA_epi.nii.gz'),
+    ('sub-01_ses-02_dir-AP_epi.nii.gz',                  'echo',   'C1',         'sub-01_ses-02_acq-C1_dir-AP_epi.nii.gz'),
+    ('sub-01_ses-02_dir-AP_epi.nii.gz',                  'suffix', '',           'epi'),
+    ('/bids/sub-01/fmap/sub-01_run-[0-9]*_magnitude*',   'run',    '',           '[0-9]*'),
+    ('/bids/sub-01/fmap/sub-01_run-[0-9]*_magnitude*',   'run',    '1',          '/bids/sub-01/fmap/sub-01_run-1_magnitude*'),
+    ('/bids/sub-01/fmap/sub-01_run-[0-9]*_magnitude*',   'suffix', '',           'magnitude*'),
+    ('sub-01_acq-fast_run-2_magnitude1.json',            'acq',    '',           'fast'),
+    ('sub-01_acq-fast_run-2_magnitude1.json',            'echo',   'C1',         'sub-01_acq-fastC1_run-2_magnitude1.json'),
+    ('sub-01_acq-fast_run-2_magnitude1.json',            'run',    '',           '2'),
+    ('sub-01_acq-fast_run-2_magnitude1.json',            'dummy',  '',           '')]
+
+
+def allocate_runindices(folder: Path, count: int) -> list:
+    """Allocates runindices and writes the output files, like a bidscoiner worker does"""
+
+    bidsnames = []
+    for n in range(count):
+        bidsname = bids.increment_runindex(folder, 'sub-01_run-1_bold')
+        (folder/f"{bidsname}.nii").touch()
+        bidsnames.append(bidsname)
+        if n % 3 == 0:                                                  # NB: The files are already on disk when the reservations are released
+            bids.release_runindices()
+    bids.release_runindices()
+
+    return bidsnames
+
+
+class TestBidsname(TmpdirTestCase):
+
+    def test_get_bidsname(self):
+        dicomfile = make_dicomfile(self.tmpdir/'sub-02'/'ses-03'/'001-t1_mprage'/'IM_0001.dcm', seriesdescr='t1 mprage_0')
+        for subid, sesid, modality, provenance, bidsvalues, runindex, bidsname in BIDSNAMES:
+            run      = dict(provenance=str(dicomfile) if provenance else '', attributes={}, bids=bidsvalues)
+            original = copy.deepcopy(run)
+            self.assertEqual(bids.get_bidsname(subid, sesid, modality, run, runindex), bidsname)
+            self.assertEqual(run, original)                             # The run is not modified
+
+    def test_bidsname(self):
+        bidsname = bids.BidsName('/bids/sub-01/ses-01/func/sub-01_ses-01_task-rest_echo-1_bold.nii.gz')
+        self.assertEqual(list(bidsname.entities), ['sub', 'ses', 'task', 'echo'])
+        self.assertEqual((bidsname['echo'], bidsname['suffix'], bidsname['run'], bidsname.extension), ('1', 'bold', '', '.nii.gz'))
+        bidsname['echo'] = '2'
+        bidsname.extend_acq('C1')
+        self.assertEqual(str(bidsname), '/bids/sub-01/ses-01/func/sub-01_ses-01_acq-C1_task-rest_echo-2_bold.nii.gz')
+        self.assertEqual(bidsname.with_extension('.json'), Path('/bids/sub-01/ses-01/func/sub-01_ses-01_acq-C1_task-rest_echo-2_bold.json'))
+        del bidsname['echo']
+        self.assertEqual(bidsname.copy().filename, 'sub-01_ses-01_acq-C1_task-rest_bold.nii.gz')
+
+    def test_get_bidsvalue(self):
+        for bidsfile, bidskey, newvalue, expected in BIDSVALUES:
+            self.assertEqual(bids.get_bidsvalue(bidsfile, bidskey, newvalue), expected, (bidsfile, bidskey, newvalue))
+            self.assertEqual(bids.get_bidsvalue(Path(bidsfile), bidskey, newvalue), Path(expected) if newvalue else expected, (bidsfile, bidskey, newvalue))
+
+    def test_increment_runindex(self):
+        for runindex in (1, 2):
+            (self.tmpdir/f"sub-01_run-{runindex}_T1w.nii").touch()
+        self.assertEqual(bids.increment_runindex(self.tmpdir, 'sub-01_run-1_T1w'), 'sub-01_run-3_T1w')
+        self.assertEqual(bids.increment_runindex(self.tmpdir, 'sub-01_run-1_T1w', '.json'), 'sub-01_run-1_T1w')
+        self.assertEqual(bids.increment_runindex(self.tmpdir, 'sub-01_T1w'), 'sub-01_T1w')
+
+    def test_runindexallocator_threads(self):
+        def allocate(n: int) -> str:
+            bidsname = bids.increment_runindex(self.tmpdir, 'sub-01_run-1_bold')
+            (self.tmpdir/f"{bidsname}.nii").touch()
+            bids.release_runindices()                                   # NB: Each thread releases its own reservations
+            return bidsname
+        with ThreadPoolExecutor(8) as executor:
+            bidsnames = list(executor.map(allocate, range(200)))
+        self.assertEqual(len(set(bidsnames)), 200)
+        self.assertEqual(sorted(path.name for path in self.tmpdir.iterdir()), sorted(f"{bidsname}.nii" for bidsname in bidsnames))
+
+    def test_runindexallocator_processes(self):
+        with multiprocessing.Pool(4) as pool:
+            bidsnames = [bidsname for bidsnames in pool.starmap(allocate_runindices, [(self.tmpdir, 25)]*4) for bidsname in bidsnames]
+        self.assertEqual(len(set(bidsnames)), 100)
+        self.assertEqual(sorted(path.name for path in self.tmpdir.iterdir()), sorted(f"{bidsname}.nii" for bidsname in bidsnames))   # No reservation files are left behind
+
+    def test_runindexallocator_reservation(self):
+        allocator = bids.RunIndexAllocator(self.tmpdir)
+        other     = bids.RunIndexAllocator(self.tmpdir)                # E.g. in another bidscoiner worker
+        self.assertEqual(allocator.allocate('sub-01_run-1_bold'), 'sub-01_run-1_bold')
+        self.assertEqual(other.allocate('sub-01_run-1_bold'), 'sub-01_run-2_bold')
+        self.assertEqual(allocator.allocate('sub-01_run-1_bold', '.json'), 'sub-01_run-1_bold')
+        self.assertEqual(allocator.allocate('sub-01_bold'), 'sub-01_bold')
+        allocator.release()
+        self.assertEqual(len(list(self.tmpdir.iterdir())), 1)
+
+    def test_runindexallocator_bidsfolder(self):
+        (self.tmpdir/'code'/'bidscoin').mkdir(parents=True)
+        anat      = self.tmpdir/'sub-01'/'anat'
+        anat.mkdir(parents=True)
+        allocator = bids.RunIndexAllocator(anat)
+        other     = bids.RunIndexAllocator(anat)
+        self.assertEqual(allocator.allocate('sub-01_run-1_T1w'), 'sub-01_run-1_T1w')
+        self.assertEqual(other.allocate('sub-01_run-1_T1w'), 'sub-01_run-2_T1w')
+        self.assertEqual(list(anat.iterdir()), [])                     # The reservations are kept outside the data folders
+        self.assertEqual(sorted(path.name for path in (self.tmpdir/'code'/'bidscoin'/'reservations').iterdir()),
+                         ['sub-01+anat+sub-01_run-1_T1w.%.reserved', 'sub-01+anat+sub-01_run-2_T1w.%.reserved'])
+
+        # No output file was written for run-1, so the run index can be handed out again
+        allocator.release('sub-01_run-1_T1w')
+        self.assertEqual(other.allocate('sub-01_run-1_T1w'), 'sub-01_run-1_T1w')
+        other.release()
+        self.assertEqual(list((self.tmpdir/'code'/'bidscoin'/'reservations').iterdir()), [])
+
+    def test_runindexallocator_listing(self):
+        (self.tmpdir/'code'/'bidscoin').mkdir(parents=True)
+        anat = self.tmpdir/'sub-01'/'anat'
+        anat.mkdir(parents=True)
+        os.utime(anat, (time.time() - 60,)*2)
+        allocator = bids.RunIndexAllocator(anat)
+        with mock.patch.object(bids.os, 'scandir', wraps=os.scandir) as scandir:
+            for runindex in range(1, 6):
+                self.assertEqual(allocator.allocate('sub-01_run-1_T1w'), f"sub-01_run-{runindex}_T1w")
+            self.assertEqual(scandir.call_count, 0)                     # The folder was not modified, so it is not listed again
+            (anat/'sub-01_run-6_T1w.nii').touch()                       # E.g. written (and released) by another worker
+            self.assertEqual(allocator.allocate('sub-01_run-1_T1w'), 'sub-01_run-7_T1w')
+            self.assertGreater(scandir.call_count, 0)
+        allocator.release()
+
+    def test_runindexallocator_stale(self):
+        reservations = self.tmpdir/'code'/'bidscoin'/'reservations'
+        reservations.mkdir(parents=True)
+        anat = self.tmpdir/'sub-01'/'anat'
+        anat.mkdir(parents=True)
+        reservation = reservations/'sub-01+anat+sub-01_run-1_T1w.%.reserved'
+        reservation.write_text('otherhost 1234')                       # E.g. left behind by a crashed worker on another node
+        allocator = bids.RunIndexAllocator(anat)
+        self.assertEqual(allocator.allocate('sub-01_run-1_T1w'), 'sub-01_run-2_T1w')
+        allocator.release()
+        os.utime(reservation, (time.time() - bids.RESERVATION_AGE - 60,)*2)
+        self.assertEqual(allocator.allocate('sub-01_run-1_T1w'), 'sub-01_run-1_T1w')
+        self.assertEqual(reservation.read_text().split()[0], bids.socket.gethostname())
+        allocator.release()
+        self.assertEqual(list(reservations.iterdir()), [])
+
+    def test_release_runindices_thread(self):
+        self.assertEqual(bids.increment_runindex(self.tmpdir, 'sub-01_run-1_T1w'), 'sub-01_run-1_T1w')
+        thread = threading.Thread(target=bids.release_runindices)      # E.g. another bidscoiner worker that is done
+        thread.start()
+        thread.join()
+        self.assertEqual(bids.increment_runindex(self.tmpdir, 'sub-01_run-1_T1w'), 'sub-01_run-2_T1w')
+        bids.release_runindices()
+        self.assertEqual(list(self.tmpdir.iterdir()), [])
+
+    def test_release_runindex(self):
+        self.assertEqual(bids.increment_runindex(self.tmpdir, 'sub-01_run-1_T1w'), 'sub-01_run-1_T1w')
+        self.assertEqual(bids.increment_runindex(self.tmpdir, 'sub-01_run-1_T1w'), 'sub-01_run-2_T1w')
+        bids.release_runindex(self.tmpdir, 'sub-01_run-1_T1w')
+        self.assertEqual(bids.increment_runindex(self.tmpdir, 'sub-01_run-1_T1w'), 'sub-01_run-1_T1w')
+        bids.release_runindices()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+import shutil
+from pathlib import Path
+
+import pydicom
+
+from tests.helpers import TmpdirTestCase, make_dicomfile
+from bidscoin import dicomsort
+
+
+class TestDicomsort(TmpdirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.session = self.tmpdir/'flat'
+        for seriesnr, seriesdescr in enumerate(('t1_mprage', 'ep2d_bold', 'dwi/b1000'), 1):
+            for instancenr in range(1, 6):
+                make_dicomfile(self.session/f"IM_{seriesnr}{instancenr:04}.dcm", seriesnr=seriesnr, seriesdescr=seriesdescr, instancenr=instancenr)
+        (self.session/'README.dcm').write_text('Not a DICOM file')
+
+    def listing(self, folder: Path) -> list:
+        return sorted(str(path.relative_to(folder)) for path in folder.rglob('*'))
+
+    def test_get_sortfields(self):
+        dicomfile = self.session/'IM_20003.dcm'
+        self.assertEqual(dicomsort.get_sortfields(dicomfile), (dicomfile, {'seriesnr': 2, 'seriesdescr': 'ep2d_bold'}))
+        self.assertEqual(dicomsort.get_sortfields(dicomfile, rename=True)[1], {'seriesnr': 2, 'seriesdescr': 'ep2d_bold', 'acquisitionnr': 1, 'instancenr': 3, 'patientname': 'Doe^John'})
+        self.assertEqual(dicomsort.get_sortfields(self.session/'README.dcm'), (self.session/'README.dcm', {}))
+
+    def test_get_sortfields_fallback(self):
+        dicomfile = self.session/'IM_20003.dcm'
+        dataset   = pydicom.dcmread(str(dicomfile))
+        item      = pydicom.Dataset()
+        item.ImageComments = 'nested'
+        dataset.ReferencedImageSequence = pydicom.Sequence([item])
+        dataset.save_as(str(dicomfile))
+        self.assertEqual(dicomsort.get_sortfields(dicomfile, "Patient's Age")[1]['seriesdescr'], '030Y')    # An element name instead of a keyword
+        self.assertEqual(dicomsort.get_sortfields(dicomfile, 'ImageComments')[1]['seriesdescr'], 'nested')  # A nested keyword
+        self.assertEqual(dicomsort.get_sortfields(dicomfile, 'StudyComments')[1]['seriesdescr'], 'ep2d_bold')
+
+    def test_sortsessions(self):
+        listings = []
+        for jobs in (1, 3):
+            session = self.tmpdir/f"jobs{jobs}"
+            shutil.copytree(str(self.session), str(session))
+            dicomsort.sortsessions(session, jobs=jobs)
+            listings.append(self.listing(session))
+        self.assertEqual(listings[0], listings[1])
+        self.assertIn('001-t1_mprage/IM_10001.dcm', listings[0])
+        self.assertIn('003-dwib1000/IM_30005.dcm', listings[0])
+        self.assertIn('README.dcm', listings[0])                    # Non-DICOM files are left where they are
+        self.assertEqual(len(listings[0]), 3 + 15 + 1)
+
+    def test_rename(self):
+        make_dicomfile(self.session/'IM_duplicate.dcm', seriesnr=1, seriesdescr='t1_mprage', instancenr=1)    # This file has the same new name as IM_10001.dcm
+        with self.assertLogs('bidscoin', 'WARNING') as logs:
+            dicomsort.sortsessions(self.session, rename=True, ext='.dcm', jobs=2)
+        self.assertIn('Doe^John_001_t1_mprage_00001_00001.dcm', self.listing(self.session/'001-t1_mprage'))
+        self.assertEqual(len(list((self.session/'001-t1_mprage').iterdir())), 5)
+        leftovers = sorted(path.name for path in self.session.iterdir() if path.is_file())
+        self.assertEqual(len(leftovers), 2)                         # Either IM_10001.dcm or IM_duplicate.dcm is not renamed
+        self.assertIn('README.dcm', leftovers)
+        self.assertTrue(any('File already exists' in message for message in logs.output))
+
+    def test_dryrun(self):
+        before = self.listing(self.session)
+        dicomsort.sortsessions(self.session, dryrun=True, jobs=2)
+        self.assertEqual(self.listing(self.session), before)
+
+
+if __name__ == '__main__':
+    unittest.main()
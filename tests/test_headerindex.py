@@ -0,0 +1,145 @@
+import unittest
+import shutil
+from unittest import mock
+from pathlib import Path
+
+from bidscoin import bids
+from bidscoin import headerindex
+from bidscoin import rawmapper
+from bidscoin.headerindex import HeaderIndex, buildindex
+from tests.helpers import TmpdirTestCase, make_dicomfile
+
+
+class TestHeaderIndex(TmpdirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.dicomfile = make_dicomfile(self.tmpdir/'raw'/'sub-01'/'001-t1_mprage'/'IM_0001.dcm')
+        self.dbfile    = self.tmpdir/'bids'/'code'/'bidscoin'/'headerindex.db'
+
+    def tearDown(self):
+        bids.close_headerindex()
+
+    def test_index(self):
+        index = HeaderIndex(self.dbfile)
+        index.put(self.dicomfile, 'SeriesNumber', 1)
+        index.put(self.dicomfile, 'PatientComments', '')
+        self.assertEqual(index.get(self.dicomfile, 'SeriesNumber'), (True, 1))
+        self.assertEqual(index.get(self.dicomfile, 'PatientComments'), (True, ''))
+        self.assertEqual(index.get(self.dicomfile, 'EchoTime'), (False, None))
+        index.close()
+
+        # A new session should see the stored values, unless the file changed
+        index = HeaderIndex(self.dbfile)
+        self.assertEqual(index.get(self.dicomfile, 'SeriesNumber'), (True, 1))
+        index.close()
+        make_dicomfile(self.dicomfile, seriesnr=2)
+        index = HeaderIndex(self.dbfile)
+        self.assertEqual(index.get(self.dicomfile, 'SeriesNumber'), (False, None))
+        index.close()
+
+    def test_revalidation(self):
+        index = HeaderIndex(self.dbfile)
+        index.put(self.dicomfile, 'SeriesNumber', 1)
+        self.assertEqual(index.get_many(self.dicomfile, ['SeriesNumber', 'EchoTime']), {'SeriesNumber': 1})
+        make_dicomfile(self.dicomfile, seriesnr=2)
+        self.assertEqual(index.get(self.dicomfile, 'SeriesNumber'), (False, None))     # The file changed during the session
+        index.close()
+
+    def test_exclude(self):
+        index = bids.open_headerindex(self.dbfile)
+        index.exclude(self.dicomfile.parents[1])
+        index.put(self.dicomfile, 'SeriesNumber', 1)
+        self.assertEqual(index.get(self.dicomfile, 'SeriesNumber'), (False, None))
+        self.assertEqual(index._db.execute('SELECT COUNT(*) FROM files').fetchone()[0], 0)
+        session = self.tmpdir/'zipped'/'sub-02'
+        shutil.make_archive(str(session/'dicoms'), 'zip', str(self.dicomfile.parent))
+        worksubses, unpacked = bids.unpack(session, scratchdir=self.tmpdir)
+        self.assertEqual(bids.get_dicomfield('SeriesNumber', bids.get_dicomfile(worksubses/'001-t1_mprage')), 1)
+        self.assertEqual(index._db.execute('SELECT COUNT(*) FROM files').fetchone()[0], 0)     # The temporary workfolder is never indexed
+
+    def test_put_many(self):
+        index = HeaderIndex(self.dbfile)
+        index.put_many(self.dicomfile, {'SeriesNumber': 1, 'EchoTime': '2.98'})
+        self.assertEqual(index.get(self.dicomfile, 'EchoTime'), (True, '2.98'))
+        index._db.execute("CREATE TRIGGER abort BEFORE INSERT ON attributes WHEN NEW.tagname='Abort' BEGIN SELECT RAISE(ABORT, 'abort'); END")
+        with self.assertLogs('bidscoin', 'WARNING'):
+            index.put_many(self.dicomfile, {'SeriesDescription': 't1_mprage', 'Abort': ''})
+        self.assertFalse(index._db.in_transaction)
+        self.assertEqual(index.get(self.dicomfile, 'SeriesDescription'), (False, None))     # The whole batch is rolled back
+        index.close()
+
+    def test_transactions(self):
+        index      = HeaderIndex(self.dbfile)
+        statements = []
+        index._db.set_trace_callback(statements.append)
+        self.assertEqual(index.get_many(self.dicomfile, ['SeriesNumber']), {})
+        index.put_many(self.dicomfile, {'SeriesNumber': 1})
+        self.assertEqual(statements.count('BEGIN IMMEDIATE'), 1)           # A newly seen file is stored in a single write transaction
+        make_dicomfile(self.dicomfile, seriesnr=2)
+        self.assertEqual(index.get_many(self.dicomfile, ['SeriesNumber']), {})
+        index.put_many(self.dicomfile, {'SeriesNumber': 2})
+        self.assertEqual(statements.count('BEGIN IMMEDIATE'), 2)
+        self.assertEqual(index.get(self.dicomfile, 'SeriesNumber'), (True, 2))
+        index.close()
+
+    def test_schema(self):
+        index = HeaderIndex(self.dbfile)
+        index.put(self.dicomfile, 'SeriesNumber', 1)
+        self.assertEqual(index._db.execute('PRAGMA user_version').fetchone()[0], headerindex.SCHEMA)
+        index._db.execute(f"PRAGMA user_version={headerindex.SCHEMA + 1}")     # E.g. written by another BIDScoin version
+        index.close()
+        with self.assertLogs('bidscoin', 'INFO'):
+            index = HeaderIndex(self.dbfile)
+        self.assertEqual(index._db.execute('PRAGMA user_version').fetchone()[0], headerindex.SCHEMA)
+        self.assertEqual(index.get(self.dicomfile, 'SeriesNumber'), (False, None))
+        index.close()
+
+    def test_rawmapper(self):
+        with mock.patch.object(bids, 'get_dicomfield', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                rawmapper.rawmapper(self.tmpdir/'raw', self.tmpdir, dryrun=True, headerindex=str(self.dbfile))
+        self.assertIsNone(bids._HEADERINDEX)                                # The index is closed, also when the mapping failed
+
+    def test_get_dicomfield(self):
+        bids.open_headerindex(self.dbfile)
+        self.assertEqual(bids.get_dicomfield('SeriesDescription', self.dicomfile), 't1_mprage')
+        bids.headercache.clear()
+        bids.close_headerindex()
+
+        index = bids.open_headerindex(self.dbfile)
+        self.assertEqual(bids.get_dicomfield('SeriesDescription', self.dicomfile), 't1_mprage')
+        self.assertEqual((index.hits, len(bids.headercache)), (1, 0))      # The header was not parsed again
+
+    def test_journal_mode(self):
+        index = HeaderIndex(self.dbfile)
+        self.assertEqual(index._db.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        index.close()
+        self.assertFalse(headerindex.is_networkfs(self.tmpdir))
+        with mock.patch('builtins.open', mock.mock_open(read_data='/dev/sda1 / ext4 rw 0 0\nserver:/export /mnt/nfs nfs4 rw 0 0\n')):
+            self.assertTrue(headerindex.is_networkfs(Path('/mnt/nfs/project')))
+            self.assertFalse(headerindex.is_networkfs(Path('/mnt/nfs2')))
+        with mock.patch.object(headerindex, 'is_networkfs', return_value=True):
+            index = HeaderIndex(self.dbfile)
+        self.assertEqual(index._db.execute('PRAGMA journal_mode').fetchone()[0], 'delete')
+        index.close()
+
+    def test_buildindex(self):
+        with mock.patch.object(bids, 'get_sourcefields', wraps=bids.get_sourcefields) as get_sourcefields:
+            buildindex(str(self.tmpdir/'raw'), str(self.tmpdir/'bids'))
+        self.assertEqual(get_sourcefields.call_count, 1)                    # All attributes of a file are read in one go
+        index = HeaderIndex(self.dbfile)
+        self.assertEqual(index.get(self.dicomfile, 'SeriesDescription'), (True, 't1_mprage'))
+        self.assertEqual(index.get(self.dicomfile, 'PatientAge'), (True, '030Y'))
+        index.close()
+
+    def test_prune(self):
+        index = HeaderIndex(self.dbfile)
+        index.put(self.dicomfile, 'SeriesNumber', 1)
+        self.dicomfile.unlink()
+        self.assertEqual(index.prune(), 1)
+        index.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+import re
+import sys
+import subprocess
+from pathlib import Path
+
+HEAVY = ('pydicom', 'nibabel', 'pandas', 'numpy', 'ruamel', 'coloredlogs', 'distutils', 'dateutil', 'drmaa', 'multiecho', 'pydeface')
+
+
+def get_consolescripts() -> dict:
+    """Reads the console scripts from the setup.py entry points, e.g. {'bidscoiner': 'bidscoin.bidscoiner'}"""
+
+    setup = (Path(__file__).parents[1]/'setup.py').read_text()
+
+    return dict(re.findall(r"'(\w+)\s*=\s*([\w.]+):main'", setup))
+
+
+def get_imports(module: str) -> tuple:
+    """
+    Imports the module in a fresh interpreter and lists the heavy dependencies that are in sys.modules afterwards
+
+    :param module:  The name of the module, e.g. 'bidscoin.bidscoiner'
+    :return:        A (list of imported HEAVY modules or None if the import failed, stderr) tuple
+    """
+
+    code    = (f"import sys, {module}\n"
+               f"print(sorted({{name.split('.')[0] for name in sys.modules}}.intersection({HEAVY!r})))")
+    process = subprocess.run([sys.executable, '-c', code], cwd=Path(__file__).parents[1], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+    return (process.stdout.strip().splitlines()[-1] if process.returncode == 0 else None), process.stderr
+
+
+class TestImportTime(unittest.TestCase):
+
+    def test_consolescripts(self):
+        consolescripts = get_consolescripts()
+        self.assertIn('bidscoiner', consolescripts)
+        for script, module in consolescripts.items():
+            with self.subTest(script=script):
+                imports, stderr = get_imports(module)
+                if imports is None and 'ModuleNotFoundError' in stderr:
+                    self.skipTest(stderr.strip().splitlines()[-1])                  # E.g. PyQt5 is not installed
+                self.assertIsNotNone(imports, stderr)
+                self.assertEqual(imports, '[]', f"{module} imports heavy dependencies on startup")
+
+
+if __name__ == '__main__':
+    unittest.main()
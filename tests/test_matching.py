@@ -0,0 +1,247 @@
+import unittest
+import copy
+import random
+from pathlib import Path
+
+from bidscoin import bids
+from tests.helpers import TmpdirTestCase, make_dicomfile
+
+
+MATCHES = [     # (source value, bidsmap attribute value, match)
+    ('',                    '',                                         True),      # Empty values
+    (None,                  '',                                         True),
+    ('',                    None,                                       True),
+    (0,                     '',                                         True),
+    ('',                    'name',                                     False),
+    ('',                    '*',                                        False),     # An empty source value never matches a wildcard
+    ('name',                '',                                         False),
+    (0,                     0,                                          True),      # Integer values
+    (2,                     2,                                          True),
+    ('2',                   2,                                          True),
+    (2,                     '2',                                        True),
+    (2,                     3,                                          False),
+    (2,                     '*',                                        True),
+    (2,                     '[1, 2]',                                   True),      # Lists of values
+    (2,                     [1, 2],                                     True),
+    (3,                     '[1, 2]',                                   False),
+    ('[1, 2]',              '[1, 2]',                                   True),
+    ([1, 2],                '[1, 2]',                                   True),
+    ('[1, 2]',              [1, 2],                                     True),
+    ('[1, 3]',              '[1, 2]',                                   False),
+    ('T1_MPRAGE',           "['T1w', 'T1_MPRAGE']",                     True),
+    ('T1w_MPRAGE',          "['T1w', 'T1_MPRAGE']",                     False),
+    ("['ORIGINAL', 'PRIMARY', 'M', 'ND']", "['ORIGINAL', 'PRIMARY', 'M', 'ND']",   True),      # List-valued source attributes
+    ("['ORIGINAL', 'PRIMARY', 'M', 'ND']", "['ORIGINAL', 'PRIMARY', 'M', 'NORM']", False),
+    ("['ORIGINAL', 'PRIMARY', 'M', 'ND']", 'ND',                        True),
+    ("['ORIGINAL', 'PRIMARY', 'M', 'ND']", '*PRIMARY*',                 True),
+    ("['ORIGINAL', 'PRIMARY', 'M', 'ND']", 'SECONDARY',                 False),
+    ('my_pulse_sequence_name', '*name*',                                True),      # Wildcards
+    ('my_pulse_sequence_name', 'name',                                  False),
+    ('my_pulse_sequence_name', 'my_*_name',                             True),
+    ('ep2d_bold_moco',      '*bold*',                                   True),
+    ('ep2d_bold_moco',      'ep2d_bold',                                False),
+    ('ep2d_bold_moco',      'ep2d_bold_mo?o',                           True),
+    ('T1_MPRAGE',           "['*T1w*', '*MPRAGE*']",                    True),
+    ('ep2d_bold',           "['*T1w*', '*MPRAGE*']",                    False),
+    ('ab',                  'a[b]',                                     True),      # Character sets
+    ('a[b]',                'a[b]',                                     True),
+    ('ac',                  'a[b]',                                     False),
+    ('[bad',                '[bad',                                     True),      # Malformed lists are plain strings
+    ('[bad',                '*bad',                                     True),
+    ('bad',                 '[bad',                                     False),
+    ('3D',                  '3D',                                       True),
+    ('3D',                  '2D',                                       False)]
+
+
+SERIES = ('t1_mprage', 'T1w_MPRAGE', 'ep2d_bold', 'ep2d_bold_SBRef', 'cmrr_mbep2d_bold', 'gre_field_mapping', 'AAHead_Scout', 'localizer',
+          'DTI_b1000', 'ep2d_diff_mddw', 't2_tse', 'flair', 'ASL_pcasl', 'unknown')
+
+RUNS = {        # SeriesDescription: (modality, index, suffix, acq) of the matching run in bidsmap_dccn.yaml (NB: the test files have no ScanningSequence or SequenceName)
+    't1_mprage':         ('anat',       1,    'T1w',                't1mprage'),
+    'T1w_MPRAGE':        ('anat',       1,    'T1w',                'T1wMPRAGE'),
+    'ep2d_bold':         ('func',       2,    'bold',               '<SequenceName>'),
+    'ep2d_bold_SBRef':   ('func',       1,    'sbref',              '<SequenceName>'),
+    'cmrr_mbep2d_bold':  ('func',       2,    'bold',               '<SequenceName>'),
+    'gre_field_mapping': ('extra_data', None, '<ScanningSequence>', 'grefieldmapping'),
+    'AAHead_Scout':      ('leave_out',  1,    '<ScanningSequence>', 'AAHeadScout'),
+    'localizer':         ('leave_out',  1,    '<ScanningSequence>', 'localizer'),
+    'DTI_b1000':         ('dwi',        2,    'dwi',                'DTIb1000'),
+    'ep2d_diff_mddw':    ('extra_data', None, '<ScanningSequence>', 'ep2ddiffmddw'),
+    't2_tse':            ('extra_data', None, '<ScanningSequence>', 't2tse'),
+    'flair':             ('extra_data', None, '<ScanningSequence>', 'flair'),
+    'ASL_pcasl':         ('extra_data', None, '<ScanningSequence>', 'ASLpcasl'),
+    'unknown':           ('extra_data', None, '<ScanningSequence>', 'unknown')}
+
+
+class TestMatching(TmpdirTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.bidsmap, _ = bids.load_bidsmap(Path('bidsmap_dccn.yaml'), Path(), report=False)
+
+    def test_match_attribute(self):
+        for source, value, match in MATCHES:
+            self.assertEqual(bids.match_attribute(source, value), match, f"match_attribute({source!r}, {value!r})")
+        for modality in bids.bidsmodalities + (bids.unknownmodality, bids.ignoremodality):
+            for run in self.bidsmap['DICOM'][modality] or []:
+                for value in run['attributes'].values():
+                    self.assertTrue(bids.match_attribute(value, value), value)      # Including the wildcard and list values
+
+    def test_get_matching_run(self):
+        for seriesdescr, expected in (('t1_mprage', 'anat'), ('ep2d_bold', 'func'), ('unknown', bids.unknownmodality)):
+            dicomfile = make_dicomfile(self.tmpdir/f"{seriesdescr}.dcm", seriesdescr=seriesdescr)
+            _, modality, _ = bids.get_matching_run(dicomfile, self.bidsmap, 'DICOM')
+            self.assertEqual(modality, expected, seriesdescr)
+
+    def test_runindex(self):
+        template, _ = bids.load_bidsmap(Path(), Path(), report=False)
+        for n, seriesdescr in enumerate(SERIES, 1):
+            dicomfile = make_dicomfile(self.tmpdir/f"{seriesdescr}.dcm", seriesnr=n, seriesdescr=seriesdescr)
+            run, modality, index = bids.get_matching_run(dicomfile, self.bidsmap, 'DICOM')
+            self.assertEqual((modality, index, run['bids']['suffix'], run['bids']['acq']), RUNS[seriesdescr], seriesdescr)
+            self.assertEqual(run['provenance'], str(dicomfile.resolve()))
+            if index is not None:
+                self.assertEqual(list(run['attributes']), list(self.bidsmap['DICOM'][modality][index]['attributes']))
+                self.assertEqual(run['attributes']['SeriesDescription'], seriesdescr)
+            self.assertEqual(bids.get_matching_run(dicomfile, template, 'DICOM')[1:], (bids.unknownmodality, None))     # The template runs match on e.g. the ScanningSequence
+
+        # The index must follow changes in the bidsmap
+        runindex = bids.get_runindex(self.bidsmap, 'DICOM', bids.bidsmodalities)
+        self.assertIs(bids.get_runindex(self.bidsmap, 'DICOM', bids.bidsmodalities), runindex)
+        run      = self.bidsmap['DICOM']['anat'][0]
+        oldvalue = run['attributes']['MRAcquisitionType']
+        run['attributes']['MRAcquisitionType'] = '2D'
+        self.assertIsNot(bids.get_runindex(self.bidsmap, 'DICOM', bids.bidsmodalities), runindex)
+        run['attributes']['MRAcquisitionType'] = oldvalue
+
+    def test_matchmemo(self):
+        dicomfiles = [make_dicomfile(self.tmpdir/f"sub-{n}"/'IM_0001.dcm', seriesdescr='ep2d_bold_rest') for n in range(3)]
+        hits       = bids.matchmemo.hits
+        results    = [bids.get_matching_run(dicomfile, self.bidsmap, 'DICOM') for dicomfile in dicomfiles]
+        self.assertEqual(bids.matchmemo.hits - hits, 2)                 # The same scan protocol is matched only once
+        self.assertEqual({(modality, index) for _, modality, index in results}, {('func', 2)})
+        self.assertEqual([run['provenance'] for run, _, _ in results], [str(dicomfile.resolve()) for dicomfile in dicomfiles])
+
+    def test_get_matching_runs(self):
+        template, _ = bids.load_bidsmap(Path(), Path(), report=False)
+        dicomfiles = [make_dicomfile(self.tmpdir/f"{seriesdescr}.dcm", seriesnr=n, seriesdescr=seriesdescr) for n, seriesdescr in enumerate(SERIES, 1)]
+        for bidsmap in (self.bidsmap, template):
+            self.assertEqual(bids.get_matching_runs(dicomfiles, bidsmap, 'DICOM'), [bids.get_matching_run(dicomfile, bidsmap, 'DICOM') for dicomfile in dicomfiles])
+
+        # Scale the table up to many series (i.e. when the headers are available)
+        runindex    = bids.get_runindex(self.bidsmap, 'DICOM', (bids.ignoremodality,) + bids.bidsmodalities + (bids.unknownmodality,))
+        sourcetable = bids.get_sourcetable(dicomfiles, runindex.tagnames, 'DICOM')
+        positions   = bids.match_sourcetable(sourcetable, self.bidsmap, 'DICOM')
+        largetable  = sourcetable.iloc[[n % len(dicomfiles) for n in range(20000)]]
+        self.assertEqual(list(bids.match_sourcetable(largetable, self.bidsmap, 'DICOM')), [positions[n % len(dicomfiles)] for n in range(20000)])
+
+    def test_exist_run(self):
+        bidsmap_new = copy.deepcopy(self.bidsmap)
+        for modality in bids.bidsmodalities + (bids.unknownmodality, bids.ignoremodality):
+            bidsmap_new['DICOM'][modality] = None
+
+        def exist_run_reference(run_item: dict) -> bool:
+            return any(bids.match_run(run, run_item) for modality in bids.bidsmodalities + (bids.unknownmodality, bids.ignoremodality)
+                                                     for run in bidsmap_new['DICOM'][modality] or [])
+
+        # Collect runs from the bidsmap and from variations on them (including empty, list and wildcard attribute values)
+        rng      = random.Random(0)
+        runitems = []
+        for modality in bids.bidsmodalities + (bids.unknownmodality, bids.ignoremodality):
+            for run in self.bidsmap['DICOM'][modality] or []:
+                for values in (['', None, 'T1_MPRAGE', 'ep2d_bold', '3D', 2], ['', 'T1_MPRAGE', "['M', 'ND']", None], [None, '*MPRAGE*', '3D']):
+                    run_item = dict(provenance=f"/raw/{len(runitems)}.dcm", attributes=dict(run['attributes']), bids=dict(run['bids']))
+                    for key in run_item['attributes']:
+                        run_item['attributes'][key] = rng.choice(values)
+                    runitems.append((modality, run_item))
+        for modality, run_item in rng.sample(runitems, 50):                 # Add runs that are (or will be) existing runs
+            runitems.append((modality, dict(run_item, provenance=f"/raw/{len(runitems)}.dcm")))
+        rng.shuffle(runitems)
+
+        for n, (modality, run_item) in enumerate(runitems):
+            self.assertEqual(bids.exist_run(bidsmap_new, 'DICOM', '', run_item), exist_run_reference(run_item), run_item)
+            bids.append_run(bidsmap_new, 'DICOM', modality, run_item)
+            if n % 7 == 0:
+                bids.delete_run(bidsmap_new, 'DICOM', modality, runitems[n//2][1]['provenance'])
+            if n % 11 == 0:
+                bids.update_bidsmap(bidsmap_new, modality, run_item['provenance'], 'anat' if modality!='anat' else 'func', run_item, 'DICOM')
+
+    def test_exist_run_inplace(self):
+        bidsmap  = copy.deepcopy(self.bidsmap)
+        run_item = copy.deepcopy(bidsmap['DICOM']['anat'][0])
+        run_item['provenance'] = '/raw/t1_mprage.dcm'
+        run_item['attributes'].update(SeriesDescription='t1_mprage', MRAcquisitionType='3D')
+        bidsmap['DICOM']['anat'] = []
+        bids.append_run(bidsmap, 'DICOM', 'anat', run_item)
+        run = bidsmap['DICOM']['anat'][-1]
+        self.assertTrue(bids.exist_run(bidsmap, 'DICOM', 'anat', run_item))
+
+        # Edit the attributes of the run in-place and store it with update_bidsmap (as in the bidseditor)
+        for key in run['attributes']:
+            run['attributes'][key] = 'edited' if key == 'SeriesDescription' else None
+        bids.update_bidsmap(bidsmap, 'anat', run['provenance'], 'anat', run, 'DICOM')
+        self.assertFalse(bids.exist_run(bidsmap, 'DICOM', 'anat', run_item))
+        self.assertTrue(bids.exist_run(bidsmap, 'DICOM', 'anat', copy.deepcopy(run)))
+
+        # Edit the attributes of the run in-place and invalidate the index
+        run['attributes']['SeriesDescription'] = 'edited_again'
+        bids.get_bidsmapindex(bidsmap, 'DICOM').invalidate('anat')
+        self.assertFalse(bids.exist_run(bidsmap, 'DICOM', 'anat', dict(run_item, attributes=dict(run['attributes'], SeriesDescription='edited'))))
+        self.assertTrue(bids.exist_run(bidsmap, 'DICOM', 'anat', copy.deepcopy(run)))
+
+    def test_bidsmapindex_scaling(self):
+
+        class RunList(list):
+            """A list of runs that counts how often it is iterated over"""
+            iterations = 0
+            def __iter__(self):
+                RunList.iterations += 1
+                return super().__iter__()
+
+        bidsmap  = copy.deepcopy(self.bidsmap)
+        template = bidsmap['DICOM']['anat'][0]
+        bidsmap['DICOM']['anat'] = RunList(dict(provenance=f"/raw/{n}.dcm", attributes=dict(template['attributes'], SeriesDescription=f"series_{n}"), bids=dict(template['bids']))
+                                           for n in range(2000))
+        self.assertEqual(bids.find_run(bidsmap, 'DICOM', '/raw/0.dcm', 'anat'), ('DICOM', 'anat', 0))
+        iterations = RunList.iterations                                 # The index has been built
+
+        # The look-ups and updates do not walk through the runs
+        for n in range(500):
+            run = dict(provenance=f"/raw/new_{n}.dcm", attributes=dict(template['attributes'], SeriesDescription=f"new_{n}"), bids=dict(template['bids']))
+            self.assertFalse(bids.exist_run(bidsmap, 'DICOM', 'anat', run))
+            bids.append_run(bidsmap, 'DICOM', 'anat', run)
+            self.assertTrue(bids.exist_run(bidsmap, 'DICOM', 'anat', run))
+            self.assertEqual(bids.find_run(bidsmap, 'DICOM', f"/raw/{3*n}.dcm", 'anat')[1:], ('anat', 3*n - n))
+            bids.delete_run(bidsmap, 'DICOM', 'anat', f"/raw/{3*n}.dcm")
+            bids.update_bidsmap(bidsmap, 'anat', run['provenance'], 'anat', dict(run, attributes=dict(run['attributes'], SeriesDescription=f"updated_{n}")), 'DICOM')
+        self.assertEqual(RunList.iterations, iterations)
+        self.assertEqual(len(bidsmap['DICOM']['anat']), 2000)
+
+    def test_find_run(self):
+        bidsmap   = copy.deepcopy(self.bidsmap)
+        reference = lambda: sorted((modality, index, run['provenance']) for modality in bids.bidsmodalities + (bids.unknownmodality, bids.ignoremodality)
+                                                                         for index, run in enumerate(bidsmap['DICOM'][modality] or []))
+        rng = random.Random(0)
+        for n in range(100):
+            modality = rng.choice(bids.bidsmodalities)
+            run      = copy.deepcopy(rng.choice(bidsmap['DICOM']['anat']))
+            run['provenance'] = f"/raw/{rng.randrange(100)}.dcm"
+            action   = rng.randrange(3)
+            if action == 0 and not bids.exist_run(bidsmap, 'DICOM', modality, run, True):
+                bids.append_run(bidsmap, 'DICOM', modality, run)
+            elif action == 1:
+                bids.delete_run(bidsmap, 'DICOM', modality, run['provenance'])
+            else:
+                dataformat, modality, index = bids.find_run(bidsmap, 'DICOM', run['provenance'])
+                if index is not None:
+                    bids.update_bidsmap(bidsmap, modality, run['provenance'], rng.choice(bids.bidsmodalities), run, 'DICOM')
+
+            # The provenance index must be consistent with the runs in the bidsmap
+            for modality_, index, provenance in reference():
+                dataformat, found, index_ = bids.find_run(bidsmap, 'DICOM', provenance, modality_)
+                self.assertEqual((dataformat, found, bidsmap['DICOM'][found][index_]['provenance']), ('DICOM', modality_, provenance))
+            self.assertEqual(bids.find_run(bidsmap, 'DICOM', '/raw/none.dcm'), ('DICOM', '', None))
+
+
+if __name__ == '__main__':
+    unittest.main()